@@ -16,12 +16,17 @@ from telegram.ext import (
     ConversationHandler,
 )
 from telegram.constants import ParseMode
-from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.error import BadRequest
 from telegram.helpers import escape_markdown
 
+import broadcast
 import db_supabase as db
+import invite_pool
+import kick_engine
+import metrics
+import rate_limiter
 import scheduler
-from utils import send_access_links, format_date_br
+from utils import send_access_links, format_date_br, get_member_status, ProgressReporter
 
 logger = logging.getLogger(__name__)
 
@@ -102,6 +107,10 @@ async def show_main_admin_menu(update: Update, context: ContextTypes.DEFAULT_TYP
             InlineKeyboardButton("🛡️ Auditar Membros", callback_data="admin_audit"),
             InlineKeyboardButton("⚙️ Configurações", callback_data="admin_settings")
         ],
+        [
+            InlineKeyboardButton("📈 Desempenho do Banco", callback_data="admin_db_metrics"),
+            InlineKeyboardButton("📬 Envios em Massa", callback_data="admin_broadcast_jobs")
+        ],
         [InlineKeyboardButton("✖️ Fechar Painel", callback_data="admin_cancel")],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -149,6 +158,8 @@ async def view_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await query.edit_message_text("📊 Carregando estatísticas...")
     try:
         stats = await db.get_system_stats()
+        updated_at = stats.get('updated_at')
+        updated_text = updated_at.astimezone(TIMEZONE_BR).strftime('%d/%m/%Y %H:%M:%S') if updated_at else "indisponível"
         text = (
             "📊 *Estatísticas do Sistema*\n\n"
             f"👥 *Usuários Totais:* {stats.get('total_users', 0)}\n"
@@ -162,7 +173,17 @@ async def view_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             f"🏢 *Grupos Cadastrados:* {stats.get('total_groups', 0)}\n"
             f"🎟️ *Cupons Ativos:* {stats.get('active_coupons', 0)}\n\n"
             f"📈 *Taxa de Conversão:* {stats.get('conversion_rate', 0.0):.1f}%\n"
-            f"📅 *Última atualização:* {datetime.now(TIMEZONE_BR).strftime('%d/%m/%Y %H:%M')}"
+            f"📅 *Última atualização:* {updated_text}"
+        )
+        cache = db.get_cache_stats()
+        snapshot_line = lambda label, s: f"{label}: {s['hits']} da memória | {s['coalesced']} coalescidas | {s['loads']} ao banco\n"
+        text += (
+            "\n\n⚡ *Leituras desde o início*\n"
+            + snapshot_line("Produtos", cache['products'])
+            + snapshot_line("Configurações", cache['settings'])
+            + snapshot_line("Grupos", cache['groups'])
+            + f"Cupons: {cache['coupons']['coalesced']} coalescidas | {cache['coupons']['calls']} ao banco\n"
+            + f"Assinaturas: {cache['active_subscriptions']['hits']} da memória | {cache['active_subscriptions']['misses']} ao banco"
         )
         keyboard = [
             [InlineKeyboardButton("🔄 Atualizar", callback_data="admin_stats")],
@@ -174,6 +195,66 @@ async def view_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await query.edit_message_text("❌ Erro ao carregar estatísticas.")
     return SELECTING_ACTION
 
+@admin_only
+async def view_db_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Mostra as funções do banco que mais consomem tempo, com latência e erros desde o início do processo."""
+    query = update.callback_query
+    await query.answer()
+    snapshot = metrics.snapshot()
+    lines = ["📈 *Desempenho do Banco* (desde o início)\n", "`função: chamadas | p50/p95 ms | erros`"]
+    for name, stats in list(snapshot.items())[:15]:
+        lines.append(
+            f"`{name.removeprefix('db.')}`: {stats['calls']} | "
+            f"{stats['p50_ms']:.0f}/{stats['p95_ms']:.0f} | {stats['errors']}"
+        )
+    if not snapshot:
+        lines.append("Nenhuma chamada registrada ainda.")
+    total_errors = sum(s['errors'] for s in snapshot.values())
+    lines.append(f"\n❌ *Erros totais:* {total_errors} | 🐢 *Limite de lentidão:* {metrics.SLOW_CALL_MS:.0f} ms")
+    keyboard = [
+        [InlineKeyboardButton("🔄 Atualizar", callback_data="admin_db_metrics")],
+        [InlineKeyboardButton("⬅️ Voltar", callback_data="admin_back_to_menu")]
+    ]
+    try:
+        await query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    except BadRequest as e:
+        if "message is not modified" not in str(e):
+            logger.error(f"Erro ao mostrar métricas do banco: {e}")
+    return SELECTING_ACTION
+
+BROADCAST_JOB_STATUS = {'running': '🔄 Em andamento', 'completed': '✅ Concluído', 'interrupted': '⚠️ Interrompido'}
+BROADCAST_JOB_KIND = {'message': '📢 Mensagem global', 'new_group': '✉️ Convite de grupo'}
+
+@admin_only
+async def view_broadcast_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Mostra os envios em massa mais recentes, com status e contadores do último checkpoint."""
+    query = update.callback_query
+    await query.answer()
+    jobs = await db.get_recent_broadcast_jobs(limit=5)
+    lines = ["📬 *Envios em Massa* (mais recentes)\n"]
+    for job in jobs:
+        counts = job.get('counts') or {}
+        processed = sum(counts.values())
+        lines.append(
+            f"*#{job['id']}* {BROADCAST_JOB_KIND.get(job['kind'], job['kind'])} — {BROADCAST_JOB_STATUS.get(job['status'], job['status'])}\n"
+            f"Processados: {processed}/{max(job.get('total') or 0, processed)} | ✅ {counts.get('sent', 0)} | "
+            f"🚫 {counts.get('blocked', 0)} | ❌ {counts.get('failed', 0)}"
+            + (f" | 👤 {counts['already_in']}" if counts.get('already_in') else "")
+            + f"\n📅 {format_date_br(job.get('created_at'))}\n"
+        )
+    if not jobs:
+        lines.append("Nenhum envio registrado.")
+    keyboard = [
+        [InlineKeyboardButton("🔄 Atualizar", callback_data="admin_broadcast_jobs")],
+        [InlineKeyboardButton("⬅️ Voltar", callback_data="admin_back_to_menu")]
+    ]
+    try:
+        await query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN)
+    except BadRequest as e:
+        if "message is not modified" not in str(e):
+            logger.error(f"Erro ao mostrar envios em massa: {e}")
+    return SELECTING_ACTION
+
 @admin_only
 async def manage_referrals_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Mostra o painel de estatísticas de indicações."""
@@ -341,8 +422,8 @@ async def admin_audit_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     text = (
         "🛡️ *Auditoria de Membros*\n\n"
         "⚠️ *ATENÇÃO: AÇÃO DE ALTO IMPACTO*\n\n"
-        "Esta função irá verificar **todos os usuários que já interagiram com o bot** contra a lista de assinantes ativos.\n\n"
-        "Qualquer usuário encontrado nos grupos que **não possua uma assinatura ativa** será **REMOVIDO IMEDIATAMENTE**.\n\n"
+        "Esta função irá verificar **os membros que o bot já viu em cada grupo** (roster de membros) contra a lista de assinantes ativos.\n\n"
+        "Qualquer membro presente nos grupos que **não possua uma assinatura ativa** será **REMOVIDO IMEDIATAMENTE**.\n\n"
         "Este processo pode demorar vários minutos, dependendo do número de usuários e grupos. Você será notificado sobre o progresso.\n\n"
         "Deseja continuar?"
     )
@@ -366,67 +447,69 @@ async def admin_audit_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 async def run_audit(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, admin_message_id: int):
-    """Executa a lógica de auditoria, com feedback de progresso para o admin."""
-    logger.info("[AUDIT] Iniciando varredura completa de membros...")
+    """
+    Executa a auditoria a partir do roster de membros de cada grupo, com feedback de progresso para o admin.
+    Só quem o roster registra como presente no grupo e não tem assinatura ativa é removido; o relatório
+    compara as chamadas à API feitas com as que a varredura de todos os usuários sem assinatura faria.
+    """
+    logger.info("[AUDIT] Iniciando auditoria de membros a partir do roster...")
     start_time = datetime.now()
-    removed_count = 0
-    checked_count = 0
-    error_count = 0
 
     try:
-        # 1. Pega a lista de permissões (assinantes ativos)
-        active_subscriber_ids = set(await db.get_all_active_tg_user_ids())
-        logger.info(f"[AUDIT] Encontrados {len(active_subscriber_ids)} assinantes ativos.")
-
-        # 2. Pega a lista de todos os usuários conhecidos
-        all_known_user_ids = await db.get_all_user_ids_from_db()
-        logger.info(f"[AUDIT] Verificando contra {len(all_known_user_ids)} usuários conhecidos.")
+        # 1. Assinantes ativos em memória (só os IDs). Se a leitura falhar, a auditoria é abortada:
+        #    uma lista incompleta removeria assinantes.
+        active_ids = set()
+        async for user_ids in db.iter_active_tg_user_id_pages():
+            active_ids.update(user_ids)
+        group_ids = await db.get_all_group_ids()
+
+        # 2. Para cada grupo, apenas os membros presentes segundo o roster; os não assinantes viram pares
+        #    (usuário, grupo) removidos em paralelo pelo kick_engine
+        checked_count = 0
+        pairs = []
+        for group_id in group_ids:
+            for user_id in db.get_present_group_members(group_id):
+                checked_count += 1
+                if user_id not in active_ids and user_id not in ADMIN_IDS and user_id != context.bot.id:
+                    pairs.append((user_id, group_id))
+
+        run = kick_engine.KickRun('audit')
+        reporter = ProgressReporter(context.bot, admin_chat_id, admin_message_id, lambda: (
+            f"🛡️ *Progresso da Auditoria...*\n\n"
+            f"Membros verificados: {checked_count}\n"
+            f"Remoções: {run.counts[kick_engine.REMOVED]} ({run.processed}/{len(pairs)} tentadas)\n"
+            f"Erros: {run.counts[kick_engine.FAILED] + run.counts[kick_engine.FORBIDDEN]}\n"
+            f"{reporter.eta_text()}"
+        ), parse_mode=ParseMode.MARKDOWN)
+
+        async def on_result(run: kick_engine.KickRun, user_id: int, group_id: int, outcome: str) -> None:
+            reporter.update(run.processed, len(pairs))
+
+        reporter.start()
+        try:
+            await kick_engine.kick_pairs(context.bot, pairs, on_result=on_result, run=run)
+        finally:
+            await reporter.stop()
+        removed_count = run.counts[kick_engine.REMOVED]
+        error_count = run.counts[kick_engine.FAILED] + run.counts[kick_engine.FORBIDDEN]
+        api_calls = run.api_calls
 
-        # 3. Determina quem precisa ser verificado/removido
-        users_to_check = [uid for uid in all_known_user_ids if uid not in active_subscriber_ids]
-        total_to_check = len(users_to_check)
-        logger.info(f"[AUDIT] {total_to_check} usuários sem assinatura ativa serão verificados.")
+        logger.info(f"[AUDIT] {checked_count} membros verificados em {len(group_ids)} grupo(s); {api_calls} chamadas à API.")
 
-        # 4. Itera e remove
-        for i, user_id in enumerate(users_to_check):
-            try:
-                # A função kick_user_from_all_groups já é perfeita para isso
-                # Ela retorna quantos grupos o usuário foi removido
-                kicked_from = await scheduler.kick_user_from_all_groups(user_id, context.bot)
-                if kicked_from > 0:
-                    removed_count += 1
-                    logger.info(f"[AUDIT] Usuário {user_id} removido de {kicked_from} grupo(s).")
-
-                checked_count += 1
-                await asyncio.sleep(0.2) # Delay para evitar rate limiting
-
-                # Atualiza o admin a cada 25 usuários verificados
-                if i > 0 and i % 25 == 0:
-                    progress_text = (
-                        f"🛡️ *Progresso da Auditoria...*\n\n"
-                        f"Verificados: {i}/{total_to_check}\n"
-                        f"Usuários Removidos: {removed_count}\n"
-                        f"Erros: {error_count}"
-                    )
-                    await context.bot.edit_message_text(text=progress_text, chat_id=admin_chat_id, message_id=admin_message_id, parse_mode=ParseMode.MARKDOWN)
-
-            except Exception as e_inner:
-                logger.error(f"[AUDIT] Erro ao processar o usuário {user_id} na varredura: {e_inner}")
-                error_count += 1
-                continue
-
-        # 5. Relatório final
+        # 3. Relatório final, com a economia em relação à varredura de todos os usuários sem assinatura
+        estimated_calls = await db.count_inactive_users() * len(group_ids) * 2
         elapsed_time = (datetime.now() - start_time).seconds
         final_report = (
             f"🛡️ *Auditoria Concluída!*\n\n"
-            f"✅ *Usuários verificados:* {checked_count}\n"
-            f"🚫 *Usuários removidos (encontrados em grupos):* {removed_count}\n"
+            f"👥 *Membros verificados (roster):* {checked_count}\n"
+            f"🚫 *Remoções de não assinantes:* {removed_count}\n"
             f"❌ *Erros no processo:* {error_count}\n"
+            f"📡 *Chamadas à API:* {api_calls} (varredura completa: ~{estimated_calls}, economia de ~{max(0, estimated_calls - api_calls)})\n"
             f"⏱️ *Duração total:* {elapsed_time // 60}m {elapsed_time % 60}s\n\n"
-            "O sistema agora está sincronizado."
+            "Membros que entraram antes do roster existir só aparecem nele quando o bot os vê (entrada, saída ou consulta de links)."
         )
-        await context.bot.edit_message_text(text=final_report, chat_id=admin_chat_id, message_id=admin_message_id, parse_mode=ParseMode.MARKDOWN)
-        await db.create_log('audit_complete', f"Auditoria concluída. {removed_count} usuários removidos.")
+        await reporter.finish(final_report, parse_mode=ParseMode.MARKDOWN)
+        await db.create_log('audit_complete', f"Auditoria concluída. {removed_count} remoções, {api_calls} chamadas à API (estimativa da varredura completa: {estimated_calls}).")
 
     except Exception as e:
         logger.critical(f"[AUDIT] Erro CRÍTICO durante a execução da auditoria: {e}", exc_info=True)
@@ -437,7 +520,7 @@ async def run_audit(context: ContextTypes.DEFAULT_TYPE, admin_chat_id: int, admi
 async def _redraw_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Função interna para desenhar/redesenhar o menu de configurações.
-    Busca o estado MAIS RECENTE do banco de dados e atualiza a mensagem.
+    Lê o estado do cache de configurações, que é atualizado em write-through a cada alteração.
     """
     query = update.callback_query
 
@@ -496,6 +579,8 @@ async def _redraw_settings_menu(update: Update, context: ContextTypes.DEFAULT_TY
 async def settings_menu_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Ponto de entrada para o menu de configurações."""
     logger.info("[SETTINGS] Iniciando menu de configurações...")
+    # Ao abrir o menu, garante que o cache reflete o banco (ex: alterações feitas fora do bot)
+    await db.refresh_settings()
     return await _redraw_settings_menu(update, context)
 
 
@@ -996,6 +1081,90 @@ async def revoke_access_confirm(update: Update, context: ContextTypes.DEFAULT_TY
     await show_main_admin_menu(update, context, is_edit=True)
     return SELECTING_ACTION
 
+# --- ENVIOS EM MASSA DURÁVEIS (broadcast_jobs) ---
+# Cada envio é registrado no banco com um cursor sobre users.id. O cursor e os contadores são gravados a
+# cada página totalmente processada; se o app reiniciar no meio, resume_broadcast_jobs retoma o envio
+# do cursor, repetindo no máximo as páginas que estavam em andamento.
+
+async def _run_broadcast_job(bot, job: dict, send, progress_text, final_text) -> broadcast.BroadcastStats:
+    """Percorre os assinantes ativos a partir do cursor do job, enviando com `send` e gravando checkpoints."""
+    admin_chat_id, admin_message_id = job['admin_chat_id'], job['admin_message_id']
+    page_last_ids: list[int] = []  # Último users.id de cada página lida nesta execução
+
+    async def recipients():
+        async for rows in db.iter_active_user_pages(page_size=broadcast.BROADCAST_CHECKPOINT_EVERY, after_id=job.get('last_user_id') or 0):
+            page_last_ids.append(rows[-1]['id'])
+            yield [row['telegram_user_id'] for row in rows]
+
+    async def checkpoint(stats: broadcast.BroadcastStats, page_index: int) -> None:
+        if job.get('id'):
+            await db.checkpoint_broadcast_job(job['id'], page_last_ids[page_index], dict(stats.checkpoint_counts))
+
+    # A mensagem do admin é editada em segundo plano no ritmo do ProgressReporter, nunca pelos workers
+    last_stats: list = []
+
+    def render() -> str | None:
+        return f"{progress_text(last_stats[0])}\n{reporter.eta_text()}" if last_stats else None
+
+    reporter = ProgressReporter(bot, admin_chat_id, admin_message_id, render)
+
+    def report_progress(stats: broadcast.BroadcastStats) -> None:
+        last_stats[:] = [stats]
+        reporter.update(stats.processed, stats.total)
+
+    reporter.start()
+    try:
+        stats = await broadcast.broadcast(
+            recipients(), send, total=job.get('total') or 0, on_progress=report_progress,
+            on_checkpoint=checkpoint, counts=job.get('counts'),
+        )
+    finally:
+        await reporter.stop()
+    if job.get('id'):
+        await db.finish_broadcast_job(job['id'], 'interrupted' if stats.interrupted else 'completed', dict(stats.counts))
+    await reporter.finish(final_text(stats), parse_mode=ParseMode.MARKDOWN)
+    return stats
+
+# Envios em andamento neste processo: a retomada periódica nunca os inicia uma segunda vez
+_active_broadcast_jobs: set = set()
+
+async def run_broadcast_job(bot, job: dict) -> None:
+    """Executa (ou retoma) um envio em massa de acordo com o tipo do job."""
+    _active_broadcast_jobs.add(job.get('id'))
+    try:
+        if job['kind'] == 'new_group':
+            await run_new_group_broadcast(bot, job)
+        else:
+            await run_broadcast(bot, job)
+    except Exception as e:
+        logger.error(f"[BROADCAST] Erro no envio em massa {job.get('id')}: {e}", exc_info=True)
+    finally:
+        _active_broadcast_jobs.discard(job.get('id'))
+
+async def start_broadcast_job(bot, kind: str, payload: dict, admin_chat_id: int, admin_message_id: int, total: int) -> None:
+    """Registra o envio no banco e o inicia em segundo plano."""
+    job = await db.create_broadcast_job(kind, payload, admin_chat_id, admin_message_id, total)
+    if not job:
+        logger.warning("[BROADCAST] Não foi possível registrar o envio no banco; ele seguirá sem retomada após reinício.")
+        job = {'id': None, 'kind': kind, 'payload': payload, 'admin_chat_id': admin_chat_id,
+               'admin_message_id': admin_message_id, 'total': total, 'last_user_id': 0, 'counts': {}}
+    asyncio.create_task(run_broadcast_job(bot, job))
+
+async def resume_broadcast_jobs(bot, at_startup: bool = False) -> int:
+    """
+    Retoma os envios 'running' que esta instância conseguiu reivindicar (sem dono ou com heartbeat
+    vencido), no início do app e periodicamente. Retorna quantos foram retomados.
+    Sem as colunas do lease, retoma todos os 'running', e só no início do app, como antes.
+    """
+    jobs = await db.claim_broadcast_jobs()
+    if jobs is None:
+        jobs = await db.get_running_broadcast_jobs() if at_startup else []
+    jobs = [job for job in jobs if job['id'] not in _active_broadcast_jobs]
+    for job in jobs:
+        logger.info(f"[BROADCAST] Retomando envio {job['id']} ({job['kind']}) a partir do usuário {job['last_user_id']}.")
+        asyncio.create_task(run_broadcast_job(bot, job))
+    return len(jobs)
+
 @admin_only
 async def broadcast_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Inicia o fluxo de envio de mensagem global."""
@@ -1028,56 +1197,35 @@ async def broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await show_main_admin_menu(update, context, is_edit=True)
         return SELECTING_ACTION
     await query.edit_message_text("📊 Buscando usuários... O envio começará em breve.")
-    user_ids = await db.get_all_active_tg_user_ids()
-    total_users = len(user_ids)
+    total_users = await db.count_active_tg_users()
     if total_users == 0:
         await query.edit_message_text("Nenhum usuário ativo encontrado para o broadcast.")
         await show_main_admin_menu(update, context, is_edit=True)
         return SELECTING_ACTION
     await query.edit_message_text(f"📤 Iniciando envio para {total_users} usuários...\n\nVocê será notificado sobre o progresso.")
     await db.create_log('admin_action', f"Admin {update.effective_user.id} iniciou broadcast para {total_users} usuários")
-    asyncio.create_task(run_broadcast(context, message_to_send, user_ids, query.message.chat_id, query.message.message_id))
+    payload = {'from_chat_id': message_to_send.chat_id, 'message_id': message_to_send.message_id}
+    await start_broadcast_job(context.bot, 'message', payload, query.message.chat_id, query.message.message_id, total_users)
     context.user_data.clear()
     return ConversationHandler.END
 
-async def run_broadcast(context: ContextTypes.DEFAULT_TYPE, message_to_send, user_ids, admin_chat_id, admin_message_id):
-    """Executa o envio do broadcast em si, com controle de rate limit e feedback de progresso."""
-    sent, failed, blocked = 0, 0, 0
-    total = len(user_ids)
-    start_time = datetime.now()
-    for i, user_id in enumerate(user_ids, 1):
-        try:
-            await context.bot.copy_message(chat_id=user_id, from_chat_id=message_to_send.chat_id, message_id=message_to_send.message_id)
-            sent += 1
-            await asyncio.sleep(0.1)
-        except RetryAfter as e:
-            await asyncio.sleep(e.retry_after)
-            try:
-                await context.bot.copy_message(chat_id=user_id, from_chat_id=message_to_send.chat_id, message_id=message_to_send.message_id)
-                sent += 1
-            except Exception:
-                failed += 1
-        except Forbidden: blocked += 1
-        except BadRequest: failed += 1
-        except Exception as e:
-            logger.error(f"Erro inesperado no broadcast para {user_id}: {e}")
-            failed += 1
-        if i % 50 == 0 or i == total:
-            try:
-                elapsed = (datetime.now() - start_time).seconds
-                remaining = ((elapsed / i) * (total - i)) if i > 0 else 0
-                await context.bot.edit_message_text(
-                    chat_id=admin_chat_id, message_id=admin_message_id,
-                    text=f"📊 Progresso: {i}/{total}\n✅ Enviados: {sent} | 🚫 Bloqueados: {blocked} | ❌ Falhas: {failed}\n⏱️ Restante: ~{int(remaining // 60)} min"
-                )
-            except BadRequest: pass
-    elapsed_time = (datetime.now() - start_time).seconds
-    await context.bot.edit_message_text(
-        chat_id=admin_chat_id, message_id=admin_message_id,
-        text=f"📢 *Broadcast Concluído!*\n\n✅ Enviados: {sent}\n🚫 Bloquearam: {blocked}\n❌ Falhas: {failed}\n⏱️ Duração: {elapsed_time // 60}m {elapsed_time % 60}s",
-        parse_mode=ParseMode.MARKDOWN
-    )
-    await db.create_log('broadcast_complete', f"Broadcast concluído: {sent}/{total} enviados")
+async def run_broadcast(bot, job: dict) -> None:
+    """Envia a mensagem global do job (cópia da mensagem do admin) para todos os assinantes ativos."""
+    payload = job['payload']
+
+    async def send(user_id: int) -> None:
+        await bot.copy_message(chat_id=user_id, from_chat_id=payload['from_chat_id'], message_id=payload['message_id'], rate_limit_args=rate_limiter.BULK)
+
+    def progress_text(stats: broadcast.BroadcastStats) -> str:
+        return f"📊 Progresso: {stats.processed}/{stats.total}\n✅ Enviados: {stats.sent} | 🚫 Bloqueados: {stats.blocked} | ❌ Falhas: {stats.failed}"
+
+    def final_text(stats: broadcast.BroadcastStats) -> str:
+        elapsed_time = int(stats.elapsed)
+        title = "⚠️ *Broadcast Interrompido!*" if stats.interrupted else "📢 *Broadcast Concluído!*"
+        return f"{title}\n\n✅ Enviados: {stats.sent}\n🚫 Bloquearam: {stats.blocked}\n❌ Falhas: {stats.failed}\n⏱️ Duração: {elapsed_time // 60}m {elapsed_time % 60}s"
+
+    stats = await _run_broadcast_job(bot, job, send, progress_text, final_text)
+    await db.create_log('broadcast_complete', f"Broadcast concluído: {stats.sent}/{stats.total} enviados")
 
 @admin_only
 async def grant_new_group_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1101,12 +1249,7 @@ async def grant_new_group_select_group(update: Update, context: ContextTypes.DEF
     await query.answer()
     chat_id = int(query.data.split('_')[-1])
     context.user_data['new_group_chat_id'] = chat_id
-    try:
-        chat = await context.bot.get_chat(chat_id)
-        group_name = chat.title
-    except Exception as e:
-        logger.error(f"Não foi possível obter informações do grupo {chat_id}: {e}")
-        group_name = f"ID {chat_id}"
+    group_name = (await db.get_group_titles()).get(chat_id) or f"ID {chat_id}"
     keyboard = [
         [InlineKeyboardButton("✅ SIM, ENVIAR CONVITES", callback_data="new_group_confirm")],
         [InlineKeyboardButton("❌ NÃO, CANCELAR", callback_data="admin_back_to_menu")]
@@ -1124,46 +1267,37 @@ async def grant_new_group_confirm(update: Update, context: ContextTypes.DEFAULT_
         await query.edit_message_text("❌ Erro: ID do grupo não encontrado.")
         return SELECTING_ACTION
     await query.edit_message_text("📊 Buscando usuários ativos... O envio começará em breve.")
-    user_ids = await db.get_all_active_tg_user_ids()
-    if not user_ids:
+    total_users = await db.count_active_tg_users()
+    if total_users == 0:
         await query.edit_message_text("❌ Nenhum usuário com assinatura ativa foi encontrado.")
         return SELECTING_ACTION
-    await query.edit_message_text(f"📤 Iniciando envio de convites para {len(user_ids)} usuários...")
+    await query.edit_message_text(f"📤 Iniciando envio de convites para {total_users} usuários...")
     await db.create_log('admin_action', f"Admin {update.effective_user.id} iniciou envio de links do grupo {chat_id}")
-    asyncio.create_task(run_new_group_broadcast(context, chat_id, user_ids, query.message.chat_id, query.message.message_id))
+    await start_broadcast_job(context.bot, 'new_group', {'chat_id': chat_id}, query.message.chat_id, query.message.message_id, total_users)
     context.user_data.clear()
     return ConversationHandler.END
 
-async def run_new_group_broadcast(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_ids: list[int], admin_chat_id: int, admin_message_id: int):
-    """Executa o envio de convites em si, com verificação de membros e feedback de progresso."""
-    sent, failed, already_in = 0, 0, 0
-    total = len(user_ids)
-    start_time = datetime.now()
-    try:
-        group_name = (await context.bot.get_chat(chat_id)).title
-    except Exception:
-        group_name = f"o grupo (ID: {chat_id})"
-    for i, user_id in enumerate(user_ids, 1):
-        try:
-            member = await context.bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                already_in += 1
-                continue
-            link = await context.bot.create_chat_invite_link(chat_id=chat_id, member_limit=1)
-            await context.bot.send_message(chat_id=user_id, text=f"✨ Como nosso assinante, você ganhou acesso ao novo grupo:\n📁 *{group_name}*\n\nClique para entrar: {link.invite_link}", parse_mode=ParseMode.MARKDOWN)
-            sent += 1
-            await asyncio.sleep(0.5)
-        except (BadRequest, Forbidden):
-            failed += 1
-        except Exception as e:
-            logger.error(f"Erro ao processar usuário {user_id} para grupo {chat_id}: {e}")
-            failed += 1
-        if i % 30 == 0 or i == total:
-            try:
-                await context.bot.edit_message_text(chat_id=admin_chat_id, message_id=admin_message_id, text=f"📊 Progresso: {i}/{total}\n✅ Enviados: {sent} | 👤 Já membros: {already_in} | ❌ Falhas: {failed}")
-            except BadRequest: pass
-    elapsed = (datetime.now() - start_time).seconds
-    await context.bot.edit_message_text(chat_id=admin_chat_id, message_id=admin_message_id, text=f"✉️ *Envio de Convites Concluído!*\n\n✅ Enviados: {sent}\n👤 Já eram membros: {already_in}\n❌ Falhas: {failed}\n⏱️ Duração: {elapsed//60}m {elapsed%60}s", parse_mode=ParseMode.MARKDOWN)
+async def run_new_group_broadcast(bot, job: dict) -> None:
+    """Envia um convite do grupo do job para cada assinante ativo que ainda não é membro."""
+    chat_id = job['payload']['chat_id']
+    group_name = (await db.get_group_titles()).get(chat_id) or f"o grupo (ID: {chat_id})"
+
+    async def send(user_id: int) -> str | None:
+        if await get_member_status(bot, chat_id, user_id) in db.MEMBER_STATUSES:
+            return 'already_in'
+        invite_link = await invite_pool.pool.get_link(bot, chat_id, bulk=True)
+        await bot.send_message(chat_id=user_id, text=f"✨ Como nosso assinante, você ganhou acesso ao novo grupo:\n📁 *{group_name}*\n\nClique para entrar: {invite_link}\n\nO link é de uso único e expira em breve; se expirar, use /suporte para receber um novo.", parse_mode=ParseMode.MARKDOWN, rate_limit_args=rate_limiter.BULK)
+        return None
+
+    def progress_text(stats: broadcast.BroadcastStats) -> str:
+        return f"📊 Progresso: {stats.processed}/{stats.total}\n✅ Enviados: {stats.sent} | 👤 Já membros: {stats.counts['already_in']} | ❌ Falhas: {stats.failed + stats.blocked}"
+
+    def final_text(stats: broadcast.BroadcastStats) -> str:
+        elapsed = int(stats.elapsed)
+        title = "⚠️ *Envio de Convites Interrompido!*" if stats.interrupted else "✉️ *Envio de Convites Concluído!*"
+        return f"{title}\n\n✅ Enviados: {stats.sent}\n👤 Já eram membros: {stats.counts['already_in']}\n❌ Falhas: {stats.failed + stats.blocked}\n⏱️ Duração: {elapsed//60}m {elapsed%60}s"
+
+    await _run_broadcast_job(bot, job, send, progress_text, final_text)
 
 @admin_only
 async def manage_coupons_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1391,6 +1525,8 @@ def get_admin_conversation_handler() -> ConversationHandler:
         states={
             SELECTING_ACTION: [
                 CallbackQueryHandler(view_stats, pattern="^admin_stats$"),
+                CallbackQueryHandler(view_db_metrics, pattern="^admin_db_metrics$"),
+                CallbackQueryHandler(view_broadcast_jobs, pattern="^admin_broadcast_jobs$"),
                 CallbackQueryHandler(manage_referrals_start, pattern="^admin_referrals$"),
                 CallbackQueryHandler(check_user_start, pattern="^admin_check_user$"),
                 CallbackQueryHandler(search_transactions_start, pattern="^admin_transactions$"),
@@ -17,12 +17,16 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatInv
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes, JobQueue, ConversationHandler, ChatMemberHandler
 from telegram.constants import ParseMode
 from telegram.error import BadRequest, Forbidden
-from telegram.request import HTTPXRequest
 
 import db_supabase as db
+import http_pool
+import invite_pool
+import kick_engine
+import metrics
+import rate_limiter
 import scheduler
-from admin_handlers import get_admin_conversation_handler, ADMIN_IDS, states_list
-from utils import format_date_br, send_access_links, alert_admins
+from admin_handlers import get_admin_conversation_handler, ADMIN_IDS, states_list, resume_broadcast_jobs
+from utils import format_date_br, send_access_links, alert_admins, refresh_group_metadata
 
 # --- CONFIGURAÇÃO DE LOGGING ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', stream=sys.stdout)
@@ -58,8 +62,13 @@ TIMEZONE_BR = timezone(timedelta(hours=-3))
 
 # --- INICIALIZAÇÃO DO BOT ---
 request_config = {'connect_timeout': 10.0, 'read_timeout': 20.0}
-httpx_request = HTTPXRequest(**request_config)
-bot_app = Application.builder().token(TELEGRAM_BOT_TOKEN).request(httpx_request).job_queue(JobQueue()).build()
+# Tamanho do pool, keep-alive e HTTP/2 vêm do pool 'telegram' do http_pool (TELEGRAM_POOL_SIZE, ...)
+httpx_request = http_pool.PooledHTTPXRequest(**request_config)
+# Todo envio passa pelo limitador global (orçamentos do Telegram por segundo, por chat e por grupo)
+bot_app = (
+    Application.builder().token(TELEGRAM_BOT_TOKEN).request(httpx_request)
+    .rate_limiter(rate_limiter.limiter).job_queue(JobQueue()).build()
+)
 app = Quart(__name__)
 
 # --- HANDLERS DE COMANDOS DO USUÁRIO ---
@@ -615,11 +624,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await query.edit_message_text("Você já possui uma assinatura ativa! Não é necessário iniciar a degustação.")
             return
 
-        can_start_trial = await db.check_and_set_trial_used(db_user['id'])
+        # Resgata e cria a degustação em uma única chamada atômica (protege contra cliques duplicados)
+        can_start_trial, trial_sub = await db.claim_trial(db_user['id'])
 
         if can_start_trial:
             await query.edit_message_text("✅ Você é elegível! Gerando seu acesso temporário...")
-            trial_sub = await db.create_trial_subscription(db_user['id'])
 
             if trial_sub:
                 await send_access_links(context.bot, tg_user.id, trial_sub['mp_payment_id'], access_type='trial')
@@ -732,9 +741,9 @@ async def create_pix_payment(tg_user: TelegramUser, product: dict, final_price:
     }
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=payload, timeout=10)
-            response.raise_for_status()
+        client = http_pool.pool.client('mercadopago')
+        response = await client.post(url, headers=headers, json=payload, timeout=10)
+        response.raise_for_status()
         data = response.json()
         mp_payment_id = str(data.get('id'))
 
@@ -782,7 +791,12 @@ async def process_approved_payment(payment_id: str):
     activated_subscription = await db.activate_subscription(payment_id)
 
     if not activated_subscription:
-        logger.warning(f"[{payment_id}] A ativação da assinatura falhou ou já estava ativa.")
+        logger.warning(f"[{payment_id}] A ativação da assinatura falhou.")
+        return
+
+    # Webhook duplicado: outra chamada já ativou a assinatura, enviou os links e tratou a indicação.
+    if activated_subscription.get('already_active'):
+        logger.info(f"[{payment_id}] Assinatura já estava ativa. Nenhuma ação repetida.")
         return
 
     # Envia links de acesso para o usuário que pagou
@@ -897,7 +911,7 @@ async def send_third_reminder(context: ContextTypes.DEFAULT_TYPE):
 
 
 async def on_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handler para verificar novos membros em tempo real."""
+    """Handler para verificar novos membros em tempo real e manter o roster local de membros dos grupos."""
     result = update.chat_member
     if not result:
         return
@@ -944,6 +958,47 @@ async def on_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TY
         else:
             logger.info(f"[GATEKEEPER] ACESSO PERMITIDO para {user.id} no grupo {chat.id}. Assinatura ativa encontrada.")
 
+    # Toda entrada, saída ou remoção em um grupo cadastrado atualiza o roster local, depois da decisão
+    # do gatekeeper: o índice muda na hora e o banco é gravado em lote, em segundo plano.
+    if await db.get_group_by_chat_id(chat.id):
+        db.record_group_member(chat.id, user.id, new_status)
+
+
+# --- METADADOS DOS GRUPOS ---
+# Os títulos dos grupos ficam no registro de grupos (db); estes handlers e o job periódico os mantêm
+# atualizados, para que o envio de links não precise chamar get_chat.
+GROUP_METADATA_REFRESH_INTERVAL = int(os.getenv("GROUP_METADATA_REFRESH_INTERVAL", 6 * 3600))  # Segundos
+
+async def on_bot_membership_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Atualiza os metadados de um grupo cadastrado quando o status do próprio bot muda nele (my_chat_member)."""
+    result = update.my_chat_member
+    if not result:
+        return
+    chat = result.chat
+    if not await db.get_group_by_chat_id(chat.id):
+        return
+    if result.new_chat_member.status in ['left', 'kicked']:
+        logger.warning(f"[GROUPS] O bot foi removido do grupo cadastrado {chat.id} ('{chat.title}').")
+        await alert_admins(context.bot, f"O bot foi removido do grupo cadastrado *{chat.title}* (`{chat.id}`). Links de acesso e remoções nesse grupo vão falhar até ele ser readicionado como admin.")
+    await db.update_group_metadata(chat.id, chat.title, chat.type, chat.username)
+
+async def on_group_title_change(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Grava o novo título quando um grupo cadastrado é renomeado."""
+    chat = update.effective_chat
+    if chat:
+        await db.update_group_metadata(chat.id, chat.title, chat.type, chat.username)
+
+async def refresh_group_metadata_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job periódico: confere no Telegram os títulos/metadados de todos os grupos cadastrados."""
+    updated = await refresh_group_metadata(context.bot)
+    logger.info(f"[GROUPS] Metadados dos grupos conferidos ({updated} atualizado(s)).")
+
+async def resume_broadcast_jobs_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job periódico: retoma envios em massa cuja instância dona parou de renovar o heartbeat."""
+    resumed = await resume_broadcast_jobs(context.bot)
+    if resumed:
+        logger.info(f"🔄 [BROADCAST] {resumed} envio(s) em massa sem heartbeat retomado(s).")
+
 
 # --- WEBHOOKS E CICLO DE VIDA ---
 
@@ -967,6 +1022,8 @@ bot_app.add_handler(get_admin_conversation_handler())
 bot_app.add_handler(cupom_handler)
 
 bot_app.add_handler(ChatMemberHandler(on_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+bot_app.add_handler(ChatMemberHandler(on_bot_membership_update, ChatMemberHandler.MY_CHAT_MEMBER))
+bot_app.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_TITLE, on_group_title_change))
 
 # 3. Comandos regulares
 bot_app.add_handler(CommandHandler("start", start))
@@ -998,18 +1055,42 @@ async def run_scheduler_webhook():
     async def run_tasks():
         logger.info("--- Iniciando verificação do scheduler ---")
         await scheduler.find_and_process_expiring_subscriptions(db.supabase, bot_app.bot)
-        await scheduler.find_and_process_expired_subscriptions(db.supabase, bot_app.bot)
+        await scheduler.find_and_process_expired_subscriptions(bot_app.bot)
         logger.info("--- Verificação do scheduler concluída ---")
 
     asyncio.create_task(run_tasks())
     return "Scheduler tasks triggered.", 200
 
 
+# --- ROTA DE MÉTRICAS DO BANCO ---
+METRICS_SECRET_TOKEN = os.getenv("METRICS_SECRET_TOKEN")
+
+@app.route("/metrics/db", methods=['GET'])
+async def db_metrics():
+    """Exporta em JSON as métricas por função do db_supabase, os contadores de cache e o uso dos pools HTTP."""
+    auth_token = request.headers.get("Authorization")
+    if not METRICS_SECRET_TOKEN or auth_token != f"Bearer {METRICS_SECRET_TOKEN}":
+        abort(403)
+    return {
+        "functions": metrics.snapshot(),
+        "caches": db.get_cache_stats(),
+        "http_pools": http_pool.pool.stats(),
+        "telegram_rate_limiter": rate_limiter.limiter.stats(),
+        "invite_pool": invite_pool.pool.stats(),
+        "kick_engine": kick_engine.stats(),
+        "slow_call_ms": metrics.SLOW_CALL_MS,
+    }, 200
+
+
 @app.before_serving
 async def startup():
+    await http_pool.pool.start()
     await bot_app.initialize()
     await bot_app.start()
     await db.initialize_default_settings()
+    await db.warm_up_caches()
+    # Logs, roster e confirmações de expiração são gravados em lote, no ritmo dos buffers
+    db.start_write_behind()
 
     # Define a lista de comandos que aparecerão no menu
     commands = [
@@ -1024,13 +1105,33 @@ async def startup():
     await bot_app.bot.set_my_commands(commands)
     logger.info("✅ Comandos do menu registrados com sucesso.")
 
-    await bot_app.bot.set_webhook(url=TELEGRAM_WEBHOOK_URL, secret_token=TELEGRAM_SECRET_TOKEN)
+    # chat_member só é entregue se pedido explicitamente; sem ele o gatekeeper e o roster não recebem nada
+    await bot_app.bot.set_webhook(url=TELEGRAM_WEBHOOK_URL, secret_token=TELEGRAM_SECRET_TOKEN, allowed_updates=Update.ALL_TYPES)
     logger.info("✅ Bot inicializado e webhook registrado com sucesso.")
 
+    bot_app.job_queue.run_repeating(
+        refresh_group_metadata_job, interval=GROUP_METADATA_REFRESH_INTERVAL, first=60, name="refresh_group_metadata"
+    )
+
+    # Estoque de links de convite de uso único: a entrega após o pagamento não espera a API
+    invite_pool.pool.start(bot_app.bot)
+
+    # Envios em massa interrompidos por um reinício continuam de onde pararam; a revisão periódica pega
+    # os que ficaram sem heartbeat depois (ex.: a instância antiga de um deploy parou no meio do envio)
+    resumed = await resume_broadcast_jobs(bot_app.bot, at_startup=True)
+    if resumed:
+        logger.info(f"🔄 {resumed} envio(s) em massa retomado(s).")
+    bot_app.job_queue.run_repeating(
+        resume_broadcast_jobs_job, interval=db.BROADCAST_LEASE_SECONDS, first=db.BROADCAST_LEASE_SECONDS, name="resume_broadcast_jobs"
+    )
+
 @app.after_serving
 async def shutdown():
+    await invite_pool.pool.stop()
     await bot_app.stop()
     await bot_app.shutdown()
+    await db.close_db_client()
+    await http_pool.pool.close()
     logger.info("Bot desligado.")
 
 @app.route("/")
@@ -1060,10 +1161,10 @@ async def mercadopago_webhook():
         payment_id = data.get("data", {}).get("id")
         if payment_id:
             try:
-                async with httpx.AsyncClient() as client:
-                    headers = {"Authorization": f"Bearer {MERCADO_PAGO_ACCESS_TOKEN}"}
-                    response = await client.get(f"https://api.mercadopago.com/v1/payments/{payment_id}", headers=headers)
-                    payment_info = response.json()
+                client = http_pool.pool.client('mercadopago')
+                headers = {"Authorization": f"Bearer {MERCADO_PAGO_ACCESS_TOKEN}"}
+                response = await client.get(f"/v1/payments/{payment_id}", headers=headers)
+                payment_info = response.json()
 
                 if response.status_code == 200 and payment_info.get("status") == "approved":
                     logger.info(f"Pagamento {payment_id} confirmado como 'approved'. Agendando processamento.")
@@ -0,0 +1,112 @@
+# --- benchmarks/bench_broadcast.py (VAZÃO DO BROADCAST CONTRA UMA API DO TELEGRAM SIMULADA) ---
+#
+# Compara o envio sequencial antigo (um copy_message por vez + sleep de 0.1s) com o motor do
+# broadcast.py em várias concorrências. Os destinatários vêm do fake_supabase e cada chamada à
+# "API" passa pelo rate_limiter real, como no bot.
+#
+#     python benchmarks/bench_broadcast.py --users 2000 --api-latency 0.08 --concurrency 1 4 16 32
+#
+# Mostra, por cenário, o tempo total e as mensagens por segundo.
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SUPABASE_URL", "http://fake-supabase.local")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.fake")
+
+from telegram.error import Forbidden
+
+import broadcast
+import db_supabase as db
+import fake_supabase
+import rate_limiter
+
+
+class FakeBotAPI:
+    """Bot mínimo: cada chamada passa pelo limitador, espera `latency` segundos e pode falhar como usuário bloqueado."""
+
+    def __init__(self, limiter: rate_limiter.TelegramRateLimiter, latency: float, blocked_ratio: float):
+        self.limiter = limiter
+        self.latency = latency
+        self.blocked_ratio = blocked_ratio
+        self.calls = 0
+        self._rng = random.Random(7)
+
+    async def _api(self, chat_id: int):
+        self.calls += 1
+        await asyncio.sleep(self.latency * self._rng.uniform(0.5, 1.5))
+        if self._rng.random() < self.blocked_ratio:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        return True
+
+    async def copy_message(self, chat_id: int, from_chat_id: int, message_id: int, rate_limit_args=None):
+        return await self.limiter.process_request(
+            self._api, (chat_id,), {}, 'copyMessage', {'chat_id': chat_id}, rate_limit_args
+        )
+
+
+async def sequential(bot: FakeBotAPI) -> broadcast.BroadcastStats:
+    """O laço de antes: um envio por vez com sleep fixo de 0.1s."""
+    stats = broadcast.BroadcastStats()
+    async for user_ids in db.iter_active_tg_user_id_pages():
+        for user_id in user_ids:
+            try:
+                await bot.copy_message(chat_id=user_id, from_chat_id=1, message_id=1)
+                stats.counts['sent'] += 1
+                await asyncio.sleep(0.1)
+            except Forbidden:
+                stats.counts['blocked'] += 1
+            stats.processed += 1
+    return stats
+
+
+async def concurrent(bot: FakeBotAPI, concurrency: int) -> broadcast.BroadcastStats:
+    async def send(user_id: int) -> None:
+        await bot.copy_message(chat_id=user_id, from_chat_id=1, message_id=1, rate_limit_args=rate_limiter.BULK)
+    return await broadcast.broadcast(db.iter_active_tg_user_id_pages(), send, concurrency=concurrency)
+
+
+def report(name: str, stats: broadcast.BroadcastStats, elapsed: float) -> None:
+    print(f"{name:<32} {elapsed:>8.2f}s {stats.processed / elapsed:>8.1f} msg/s   "
+          f"enviados={stats.sent} bloqueados={stats.blocked} falhas={stats.failed}")
+
+
+async def main(args):
+    fake_db = fake_supabase.install(db)
+    fake_supabase.seed(fake_db, users=args.users, active_ratio=1.0, expired_ratio=0.0)
+    print(f"{args.users} destinatários, latência da API ~{args.api_latency * 1000:.0f} ms, "
+          f"orçamento global {args.global_rate:.0f} req/s (fatia em massa {rate_limiter.TG_BULK_SHARE:.0%})\n")
+
+    def new_bot() -> FakeBotAPI:
+        limiter = rate_limiter.TelegramRateLimiter(global_rate=args.global_rate, min_global_rate=args.global_rate)
+        return FakeBotAPI(limiter, args.api_latency, args.blocked_ratio)
+
+    if not args.skip_sequential:
+        start = time.perf_counter()
+        stats = await sequential(new_bot())
+        report("sequencial (antes)", stats, time.perf_counter() - start)
+
+    for concurrency in args.concurrency:
+        start = time.perf_counter()
+        stats = await concurrent(new_bot(), concurrency)
+        report(f"motor, {concurrency} workers", stats, time.perf_counter() - start)
+
+    await db.close_db_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--api-latency", type=float, default=0.08, help="latência por chamada ao Telegram, em segundos")
+    parser.add_argument("--global-rate", type=float, default=rate_limiter.TG_GLOBAL_RATE, help="orçamento global do limitador (req/s)")
+    parser.add_argument("--blocked-ratio", type=float, default=0.05, help="fração de destinatários que bloquearam o bot")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--skip-sequential", action="store_true", help="não roda o cenário sequencial (lento com muitos usuários)")
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(main(parser.parse_args()))
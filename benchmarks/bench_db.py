@@ -0,0 +1,103 @@
+# --- benchmarks/bench_db.py (CARGA DO db_supabase CONTRA O BACKEND EM MEMÓRIA) ---
+#
+# Exercita as leituras e rotinas mais pesadas do bot contra o fake_supabase, sem tocar no Supabase real.
+#
+#     python benchmarks/bench_db.py --users 100000 --latency 0.02
+#
+# Para cada cenário, mostra o tempo total e quantas idas ao "banco" foram feitas.
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SUPABASE_URL", "http://fake-supabase.local")
+os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.fake")
+
+import db_supabase as db
+import fake_supabase
+import scheduler
+
+
+class FakeBot:
+    """Bot mínimo: cada chamada à API espera `latency` segundos e é contada."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def _call(self, *args, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    ban_chat_member = unban_chat_member = send_message = _call
+
+
+async def scenario(name: str, fake_db: fake_supabase.FakeDatabase, coro):
+    before = sum(fake_db.calls.values())
+    start = time.perf_counter()
+    result = await coro
+    elapsed = time.perf_counter() - start
+    round_trips = sum(fake_db.calls.values()) - before
+    print(f"{name:<48} {elapsed:>8.2f}s {round_trips:>8} chamadas")
+    return result
+
+
+async def count_pages(pages) -> int:
+    total = 0
+    async for page in pages:
+        total += len(page)
+    return total
+
+
+async def main(args):
+    fake_db = fake_supabase.install(db, latency=args.latency, jitter=args.latency / 4)
+    start = time.perf_counter()
+    fake_supabase.seed(fake_db, users=args.users, groups=args.groups)
+    print(f"Banco em memória populado com {args.users} usuários em {time.perf_counter() - start:.1f}s "
+          f"(latência simulada {args.latency * 1000:.0f} ms)\n")
+
+    await scenario("warm_up_caches", fake_db, db.warm_up_caches())
+    total = await scenario("iter_user_id_pages (todos os usuários)", fake_db, count_pages(db.iter_user_id_pages()))
+    print(f"  -> {total} IDs")
+    total = await scenario("iter_active_tg_user_id_pages", fake_db, count_pages(db.iter_active_tg_user_id_pages()))
+    print(f"  -> {total} IDs")
+    total = await scenario("iter_inactive_user_id_pages", fake_db, count_pages(db.iter_inactive_user_id_pages()))
+    print(f"  -> {total} IDs")
+    await scenario("get_system_stats (frio)", fake_db, db.get_system_stats())
+    await scenario("get_system_stats (snapshot)", fake_db, db.get_system_stats())
+
+    tg_ids = [100_000_000 + i for i in range(min(args.burst, args.users))]
+    await scenario(f"{len(tg_ids)}x get_user_active_subscription (frio)", fake_db,
+                   asyncio.gather(*(db.get_user_active_subscription(uid) for uid in tg_ids)))
+    await scenario(f"{len(tg_ids)}x get_user_active_subscription (cache)", fake_db,
+                   asyncio.gather(*(db.get_user_active_subscription(uid) for uid in tg_ids)))
+    await scenario(f"{args.burst}x get_product_by_id", fake_db,
+                   asyncio.gather(*(db.get_product_by_id(1) for _ in range(args.burst))))
+
+    bot = FakeBot(args.bot_latency)
+    # Expira uma amostra de assinaturas ativas para o scheduler processar
+    now = db.datetime.now(db.TIMEZONE_BR)
+    sample = [r for r in fake_db.table('subscriptions').find('status', 'active')][:args.expire]
+    for row in sample:
+        fake_db.table('subscriptions').change(row, {'end_date': (now - db.timedelta(minutes=1)).isoformat()})
+    await scenario(f"scheduler: {len(sample)} assinaturas vencidas", fake_db,
+                   scheduler.find_and_process_expired_subscriptions(bot))
+    print(f"  -> {bot.calls} chamadas à API do Telegram")
+
+    await db.close_db_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.02, help="latência por chamada ao banco, em segundos")
+    parser.add_argument("--bot-latency", type=float, default=0.0, help="latência por chamada ao Telegram, em segundos")
+    parser.add_argument("--burst", type=int, default=1000, help="chamadas concorrentes nos cenários de rajada")
+    parser.add_argument("--expire", type=int, default=200, help="assinaturas vencidas para o scheduler")
+    logging.getLogger().setLevel(logging.WARNING)  # O scheduler configura o logging em INFO ao ser importado
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,168 @@
+# --- broadcast.py (MOTOR DE ENVIO EM MASSA COM WORKERS CONCORRENTES) ---
+#
+# Lê os destinatários página a página e os distribui entre um número limitado de workers.
+# O ritmo real é ditado pelo rate_limiter (os envios devem usar rate_limit_args=BULK);
+# a concorrência só serve para esconder a latência de cada chamada à API do Telegram.
+
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 16))  # Envios em voo ao mesmo tempo
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", 100))  # Destinatários por página/checkpoint
+
+_DONE = object()  # Sentinela que encerra cada worker
+
+
+class BroadcastStats:
+    """
+    Contadores de um envio em massa. `counts` guarda o resultado de cada destinatário ('sent', 'blocked', 'failed'...).
+    `checkpoint_counts` soma só as páginas já confirmadas por checkpoint: é o que pode ser gravado junto
+    com o cursor, já que as páginas seguintes (mesmo as terminadas fora de ordem) são refeitas na retomada.
+    """
+
+    def __init__(self, total: int = 0, counts: Optional[Dict[str, int]] = None):
+        self.counts: Counter = Counter(counts or {})
+        self.checkpoint_counts: Counter = Counter(counts or {})
+        self.processed = sum(self.counts.values())
+        self.total = max(total, self.processed)
+        self.interrupted = False
+        self.started = time.monotonic()
+
+    @property
+    def sent(self) -> int:
+        return self.counts['sent']
+
+    @property
+    def blocked(self) -> int:
+        return self.counts['blocked']
+
+    @property
+    def failed(self) -> int:
+        return self.counts['failed']
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+
+async def _deliver(send: Callable[[int], Awaitable[Any]], user_id: int) -> str:
+    """Executa o envio para um destinatário e classifica o resultado."""
+    try:
+        outcome = await send(user_id)
+        return outcome or 'sent'
+    except RetryAfter as e:
+        # O rate_limiter já tentou de novo; se ainda assim veio RetryAfter, espera o pedido e tenta uma última vez
+        await asyncio.sleep(e.retry_after)
+        try:
+            return await send(user_id) or 'sent'
+        except Exception:
+            return 'failed'
+    except Forbidden:
+        return 'blocked'
+    except BadRequest:
+        return 'failed'
+    except Exception as e:
+        logger.error(f"Erro inesperado no broadcast para {user_id}: {e}")
+        return 'failed'
+
+
+async def broadcast(
+    recipients: AsyncIterator[List[int]],
+    send: Callable[[int], Awaitable[Optional[str]]],
+    total: int = 0,
+    concurrency: int = BROADCAST_CONCURRENCY,
+    on_progress: Optional[Callable[[BroadcastStats], None]] = None,
+    on_checkpoint: Optional[Callable[[BroadcastStats, int], Awaitable[None]]] = None,
+    counts: Optional[Dict[str, int]] = None,
+) -> BroadcastStats:
+    """
+    Envia para todos os destinatários com até `concurrency` envios simultâneos.
+    - `recipients`: gerador de páginas de IDs (ex.: db.iter_active_tg_user_id_pages()).
+    - `send(user_id)`: faz o envio; pode retornar um resultado próprio (ex.: 'already_in'), senão conta como 'sent'.
+      Forbidden conta como 'blocked'; BadRequest e demais erros, como 'failed'.
+    - `on_progress(stats)`: chamado de forma síncrona a cada destinatário processado; não deve fazer I/O
+      (ex.: ProgressReporter.update, que só registra o andamento e deixa a edição para a sua tarefa).
+    - `on_checkpoint(stats, page_index)`: chamado, em ordem, quando todas as páginas até `page_index`
+      (contadas a partir de 0 nesta execução) foram totalmente processadas. Serve para gravar um cursor,
+      junto com `stats.checkpoint_counts` (os contadores até essa página).
+    - `counts`: contadores de uma execução anterior, ao retomar um envio.
+    Se a leitura dos destinatários falhar, os já enfileirados são enviados e `stats.interrupted` fica True.
+    """
+    stats = BroadcastStats(total, counts)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    remaining: Dict[int, int] = {}  # Página -> destinatários ainda não processados
+    page_counts: Dict[int, Counter] = {}  # Página -> resultados, até a página entrar no checkpoint
+    next_page = 0                   # Primeira página ainda não confirmada por checkpoint
+    page_count = 0
+    checkpoint_lock = asyncio.Lock()
+
+    async def advance_checkpoint() -> None:
+        nonlocal next_page
+        # O lock mantém os checkpoints em ordem mesmo com vários workers terminando páginas juntos
+        async with checkpoint_lock:
+            last_done = None
+            while remaining.get(next_page) == 0:
+                del remaining[next_page]
+                stats.checkpoint_counts.update(page_counts.pop(next_page, Counter()))
+                last_done = next_page
+                next_page += 1
+            if last_done is not None and on_checkpoint:
+                try:
+                    await on_checkpoint(stats, last_done)
+                except Exception as e:
+                    logger.error(f"[BROADCAST] Falha ao gravar checkpoint da página {last_done}: {e}", exc_info=True)
+
+    async def worker() -> None:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                return
+            page_index, user_id = item
+            outcome = await _deliver(send, user_id)
+            stats.counts[outcome] += 1
+            page_counts.setdefault(page_index, Counter())[outcome] += 1
+            stats.processed += 1
+            stats.total = max(stats.total, stats.processed)
+            remaining[page_index] -= 1
+            if remaining[page_index] == 0:
+                await advance_checkpoint()
+            if on_progress:
+                try:
+                    on_progress(stats)
+                except Exception as e:
+                    logger.error(f"[BROADCAST] Erro no callback de progresso: {e}")
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        async for page in recipients:
+            page_index = page_count
+            page_count += 1
+            remaining[page_index] = len(page)
+            if not page:
+                await advance_checkpoint()
+            for user_id in page:
+                await queue.put((page_index, user_id))
+    except asyncio.CancelledError:
+        # Desligamento do app: para na hora; o que não foi confirmado por checkpoint é refeito na retomada
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    except Exception as e:
+        logger.error(f"[BROADCAST] Leitura dos destinatários interrompida após {stats.processed + queue.qsize()} usuários: {e}", exc_info=True)
+        stats.interrupted = True
+
+    for _ in workers:
+        await queue.put(_DONE)
+    await asyncio.gather(*workers)
+
+    stats.total = stats.processed
+    return stats
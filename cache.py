@@ -0,0 +1,197 @@
+# --- cache.py (CACHES EM MEMÓRIA COMPARTILHADOS) ---
+
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Sentinela retornada por TTLCache.get quando a chave não está no cache.
+# Diferente de None, que é um valor válido (resultado negativo cacheado).
+MISSING = object()
+
+
+class SnapshotCache:
+    """
+    Mantém em memória um snapshot versionado de uma tabela pequena (produtos, configurações...).
+    - O snapshot é carregado por uma função assíncrona (`loader`) e vale por `ttl` segundos.
+    - `invalidate()` força a recarga no próximo acesso.
+    - Apenas uma recarga roda por vez: chamadas concorrentes aguardam o mesmo carregamento.
+    - Se a recarga falhar, o último snapshot válido continua sendo servido.
+    - `get_stale()` serve o snapshot expirado na hora e recarrega em segundo plano (stale-while-revalidate).
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Awaitable[Any]], ttl: float):
+        self.name = name
+        self.ttl = ttl
+        self._loader = loader
+        self._value: Any = None
+        self._loaded_at: Optional[float] = None
+        self._stale = True
+        self._lock = asyncio.Lock()
+        self._background: Optional[asyncio.Task] = None
+        self.version = 0
+        self.hits = 0        # Acessos servidos direto do snapshot
+        self.loads = 0       # Chamadas ao loader (idas ao banco)
+        self.coalesced = 0   # Acessos que aguardaram uma recarga já em andamento, sem ir ao banco
+        self.updated_at: Optional[datetime] = None
+
+    @property
+    def is_fresh(self) -> bool:
+        """Indica se o snapshot atual ainda está dentro do TTL e não foi invalidado."""
+        if self._stale or self._loaded_at is None:
+            return False
+        return time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self) -> Any:
+        """Retorna o snapshot atual, recarregando-o se estiver expirado."""
+        if self.is_fresh:
+            self.hits += 1
+            return self._value
+        return await self.refresh()
+
+    async def get_stale(self) -> Any:
+        """
+        Retorna o snapshot atual sem esperar pelo banco, mesmo que esteja expirado.
+        Se estiver expirado, agenda uma recarga em segundo plano para os próximos acessos.
+        Só aguarda o carregamento quando ainda não existe nenhum snapshot.
+        """
+        if self._loaded_at is None:
+            return await self.refresh()
+        if not self.is_fresh and (self._background is None or self._background.done()):
+            self._background = asyncio.create_task(self.refresh())
+        self.hits += 1
+        return self._value
+
+    async def refresh(self, force: bool = False) -> Any:
+        """Recarrega o snapshot. Sem `force`, reaproveita uma recarga feita enquanto aguardava o lock."""
+        async with self._lock:
+            if not force and self.is_fresh:
+                self.coalesced += 1
+                return self._value
+            self.loads += 1
+            try:
+                value = await self._loader()
+            except Exception as e:
+                logger.error(f"❌ [CACHE] Erro ao recarregar o cache '{self.name}': {e}", exc_info=True)
+                return self._value
+            self._store(value)
+            logger.debug(f"[CACHE] Cache '{self.name}' recarregado (versão {self.version}).")
+            return self._value
+
+    def set(self, value: Any) -> None:
+        """Substitui o snapshot diretamente (write-through), sem ir ao banco."""
+        self._store(value)
+
+    def invalidate(self) -> None:
+        """Marca o snapshot como expirado; o próximo acesso fará a recarga."""
+        self._stale = True
+
+    def _store(self, value: Any) -> None:
+        self._value = value
+        self._loaded_at = time.monotonic()
+        self._stale = False
+        self.version += 1
+        self.updated_at = datetime.now(timezone.utc)
+
+    def stats(self) -> Dict[str, int]:
+        """Contadores de uso do cache."""
+        return {'hits': self.hits, 'loads': self.loads, 'coalesced': self.coalesced, 'version': self.version}
+
+
+class TTLCache:
+    """
+    Cache chave → valor limitado em tamanho, com expiração por TTL.
+    - `None` é um valor válido, permitindo cachear resultados negativos.
+    - Ao atingir `maxsize`, descarta a entrada usada há mais tempo (LRU).
+    - `epoch` muda a cada invalidação: uma busca iniciada antes de uma invalidação pode passar
+      o epoch lido no início para `set()`, que descarta o resultado se ele ficou obsoleto.
+    """
+
+    def __init__(self, name: str, ttl: float, maxsize: int = 10_000):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.epoch = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Any:
+        """Retorna o valor cacheado ou `MISSING` se a chave não existir ou tiver expirado."""
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, epoch: Optional[int] = None) -> None:
+        """Armazena um valor (inclusive `None`) pelo TTL configurado."""
+        if epoch is not None and epoch != self.epoch:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """Remove uma chave do cache, se existir."""
+        self._data.pop(key, None)
+        self.epoch += 1
+
+    def clear(self) -> None:
+        """Esvazia o cache."""
+        self._data.clear()
+        self.epoch += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Contadores de uso do cache."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class SingleFlight:
+    """
+    Coalescência de leituras idênticas em andamento (single-flight).
+    Enquanto a busca de uma chave está em voo, novas chamadas com a mesma chave aguardam
+    o mesmo resultado (ou a mesma exceção) em vez de repetir a consulta.
+    O resultado é compartilhado: quem chamou não deve alterá-lo.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0       # Buscas que de fato foram executadas
+        self.coalesced = 0   # Chamadas que reaproveitaram uma busca em voo
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Executa `fn()` para a chave, ou aguarda a execução já em andamento."""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda f, k=key: self._forget(k, f))
+        # shield: o cancelamento de um chamador não cancela a busca compartilhada pelos demais
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            future.exception()  # Marca a exceção como recuperada, mesmo sem chamadores restantes
+
+    def stats(self) -> Dict[str, int]:
+        """Contadores de uso da coalescência."""
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._inflight)}
@@ -1,13 +1,25 @@
 # --- db_supabase.py (VERSÃO FINAL COMPLETA E CORRIGIDA) ---
 
 import os
+import sys
+import socket
 import asyncio
 import logging
+from collections import deque
 from datetime import datetime, timedelta, timezone
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator, Callable
+import httpx
+from postgrest import AsyncPostgrestClient
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_HEADERS
+from postgrest.exceptions import APIError
+from postgrest.types import ReturnMethod
 from supabase import create_client, Client
 from telegram import User as TelegramUser
 
+import http_pool
+import metrics
+from cache import MISSING, SingleFlight, SnapshotCache, TTLCache
+
 logger = logging.getLogger(__name__)
 
 # --- CONFIGURAÇÃO E CLIENTE SUPABASE ---
@@ -15,60 +27,300 @@ url: str = os.getenv("SUPABASE_URL")
 key: str = os.getenv("SUPABASE_KEY")
 TIMEZONE_BR = timezone(timedelta(hours=-3))
 TRIAL_PRODUCT_ID = 3 # Produto Degustação
+TRIAL_DURATION_MINUTES = 30
+RPC_NOT_FOUND = 'PGRST202' # Código do PostgREST para função (RPC) inexistente no banco
+COLUMN_NOT_FOUND = ('42703', 'PGRST204')  # Coluna inexistente (Postgres / PostgREST): migração em sql/ não aplicada
+
+# --- CONFIGURAÇÃO DO POOL DE CONEXÕES ---
+# Tamanho, keep-alive e HTTP/2 do pool ficam no http_pool (DB_POOL_SIZE, DB_KEEPALIVE_*, DB_HTTP2)
+DB_POOL_SIZE = http_pool.pool.upstreams['supabase'].pool_size     # Conexões simultâneas no pool HTTP
+DB_MAX_CONCURRENCY = int(os.getenv("DB_MAX_CONCURRENCY", DB_POOL_SIZE))  # Queries em voo ao mesmo tempo
+DB_CALL_TIMEOUT = float(os.getenv("DB_CALL_TIMEOUT", 10))          # Timeout total por chamada, em segundos
+DB_PAGE_SIZE = int(os.getenv("DB_PAGE_SIZE", 500))                 # Linhas por página nas listagens (o PostgREST limita a 1000)
+
+# --- CONFIGURAÇÃO DOS CACHES EM MEMÓRIA ---
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", 300))
+SETTINGS_CACHE_TTL = int(os.getenv("SETTINGS_CACHE_TTL", 30))
+GROUP_CACHE_TTL = int(os.getenv("GROUP_CACHE_TTL", 300))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", 60))
+SUBSCRIPTION_CACHE_MAXSIZE = int(os.getenv("SUBSCRIPTION_CACHE_MAXSIZE", 10000))
+STATS_CACHE_TTL = int(os.getenv("STATS_CACHE_TTL", 60))
+
+# --- CONFIGURAÇÃO DA GRAVAÇÃO DE LOGS EM LOTE ---
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 50))            # Grava assim que o buffer atinge N linhas
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", 5))   # ...ou a cada N segundos
+LOG_MAX_PENDING = int(os.getenv("LOG_MAX_PENDING", 10000))       # Limite de linhas retidas se o banco ficar fora
+
+# --- CONFIGURAÇÃO DA GRAVAÇÃO DO ROSTER EM LOTE ---
+ROSTER_BATCH_SIZE = int(os.getenv("ROSTER_BATCH_SIZE", 1000))    # Linhas por upsert em group_members
+
+# --- CONFIGURAÇÃO DA EXPIRAÇÃO EM LOTE ---
+EXPIRY_BATCH_SIZE = int(os.getenv("EXPIRY_BATCH_SIZE", 200))     # IDs por UPDATE ... WHERE id IN (...)
+
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    """Cliente PostgREST assíncrono que usa o pool de conexões 'supabase' do http_pool."""
+
+    def create_session(self, base_url, headers, timeout, verify=True) -> httpx.AsyncClient:
+        return http_pool.pool.create_client(
+            'supabase',
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            follow_redirects=True,
+        )
 
+
+# Cliente síncrono mantido para o scheduler, que ainda recebe um `Client` como parâmetro.
 supabase: Client = None
+# Cliente assíncrono usado por todas as funções deste módulo.
+supabase_async: AsyncPostgrestClient = None
 if not url or not key:
     logger.critical("ERRO CRÍTICO: Credenciais do Supabase (URL ou KEY) não encontradas.")
 else:
     try:
+        supabase_async = PooledPostgrestClient(
+            f"{url}/rest/v1",
+            headers={**DEFAULT_POSTGREST_CLIENT_HEADERS, "apiKey": key, "Authorization": f"Bearer {key}"},
+            timeout=DB_CALL_TIMEOUT,
+        )
         supabase: Client = create_client(url, key)
         logger.info("✅ Cliente Supabase criado com sucesso.")
     except Exception as e:
         logger.critical(f"Falha ao criar o cliente Supabase: {e}", exc_info=True)
 
-# --- FUNÇÕES DE CONFIGURAÇÕES (SETTINGS) ---
+# Limita quantas queries podem estar em voo ao mesmo tempo, protegendo o pool e o Supabase.
+_db_semaphore = asyncio.Semaphore(DB_MAX_CONCURRENCY)
 
-async def get_setting(key: str) -> Optional[Dict[str, Any]]:
-    """Busca uma configuração do banco de dados pela chave."""
+
+async def _execute(query):
+    """
+    Executa uma query do PostgREST de forma nativamente assíncrona.
+    Respeita o limite de concorrência do módulo e aplica um timeout total por chamada.
+    Erros são registrados nas métricas da função pública em andamento antes de serem repassados.
+    """
     try:
-        response = supabase.table('settings').select('value').eq('key', key).single().execute()
-        if response.data:
-            logger.info(f"[DB] Configuração '{key}' encontrada: {response.data.get('value')}")
-            return response.data.get('value', {})
-        else:
-            logger.warning(f"[DB] Configuração '{key}' não encontrada.")
-            return None
+        async with _db_semaphore:
+            return await asyncio.wait_for(query.execute(), timeout=DB_CALL_TIMEOUT)
     except Exception as e:
-        logger.error(f"[DB] Erro ao buscar configuração '{key}': {e}")
+        metrics.record_error(e)
+        raise
+
+
+async def _iter_pages(build_query: Callable[[], Any], page_size: int, after_id: int = 0) -> AsyncIterator[List[dict]]:
+    """
+    Percorre uma tabela em páginas usando paginação por chave (keyset) sobre a coluna `id`.
+    `build_query` deve retornar uma nova query já com o select e os filtros, mas sem ordenação/limite.
+    Diferente de um select único, não é cortado pelo limite de linhas do PostgREST e mantém
+    em memória apenas uma página por vez. Erros são propagados para quem consome o stream,
+    para que uma varredura incompleta não seja confundida com uma varredura completa.
+    """
+    last_id = after_id
+    while True:
+        response = await _execute(build_query().gt('id', last_id).order('id').limit(page_size))
+        rows = response.data or []
+        if not rows:
+            return
+        yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]['id']
+
+
+# Funções SQL que o banco informou não existirem (migração em sql/ ainda não aplicada).
+_missing_rpcs: set = set()
+
+
+async def _execute_rpc(name: str, params: Optional[dict] = None):
+    """
+    Chama uma função SQL (RPC) e retorna a resposta, ou None se a função não existir no banco.
+    A ausência é lembrada, para que quem chamou use direto o caminho alternativo nas próximas vezes.
+    """
+    if name in _missing_rpcs:
+        return None
+    try:
+        return await _execute(supabase_async.rpc(name, params or {}))
+    except APIError as e:
+        if e.code != RPC_NOT_FOUND:
+            raise
+        _missing_rpcs.add(name)
+        logger.warning(f"⚠️ [DB] Função SQL '{name}' não existe no banco (veja a pasta sql/). Usando o caminho alternativo.")
+        return None
+
+
+class WriteBehindBuffer:
+    """
+    Buffer de gravação assíncrona (write-behind) para uma tabela.
+    As linhas ficam em memória e são gravadas em um único insert em lote quando o buffer
+    atinge `batch_size` linhas ou a cada `flush_interval` segundos, sem que quem chamou espere
+    pelo banco. Se a gravação falhar, as linhas voltam para o buffer e são tentadas de novo.
+    Com o banco fora, o buffer retém até `max_pending` linhas e descarta as mais antigas; os descartes
+    são contados e registrados uma vez por tentativa de gravação, não a cada linha.
+    Com `on_conflict` (ex.: 'chat_id,user_id'), o lote vira um upsert por essas colunas e, dentro do
+    mesmo lote, só a linha mais recente de cada chave é enviada.
+    """
+
+    def __init__(self, table: str, batch_size: int, flush_interval: float, max_pending: int,
+                 on_conflict: Optional[str] = None):
+        self.table = table
+        self.on_conflict = on_conflict
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._rows: deque = deque(maxlen=max_pending)
+        self._dropped = 0
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def add(self, row: dict) -> None:
+        """Enfileira uma linha. Deve ser chamado de dentro do event loop."""
+        if len(self._rows) >= self.max_pending:
+            self._dropped += 1  # O deque descarta a linha mais antiga ao receber a nova
+        self._rows.append(row)
+        self.start()
+        if len(self._rows) >= self.batch_size:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        """Inicia a tarefa de fundo, se ainda não estiver rodando. Deve ser chamado de dentro do event loop."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        """Tarefa de fundo que grava o buffer por tamanho ou por tempo."""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Grava todas as linhas pendentes, em lotes de até `batch_size`."""
+        async with self._flush_lock:
+            if self._dropped:
+                logger.warning(f"[DB] Buffer de '{self.table}' cheio ({self.max_pending} linhas): {self._dropped} linha(s) mais antiga(s) descartada(s).")
+                self._dropped = 0
+            while self._rows:
+                batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+                try:
+                    await self._write(batch)
+                except Exception as e:
+                    logger.error(f"❌ [DB] Erro ao gravar lote de {len(batch)} linha(s) em '{self.table}': {e}")
+                    # Devolve o lote à frente da fila; se não couber, as linhas mais antigas são descartadas
+                    self._dropped += max(0, len(batch) + len(self._rows) - self.max_pending)
+                    self._rows = deque(batch + list(self._rows), maxlen=self.max_pending)
+                    return
+
+    async def _write(self, batch: List[dict]) -> None:
+        """Grava um lote (insert, ou upsert com `on_conflict`). Subclasses podem trocar a gravação."""
+        table = supabase_async.table(self.table)
+        if not self.on_conflict:
+            await _execute(table.insert(batch, returning=ReturnMethod.minimal))
+            return
+        # O Postgres recusa um upsert que atualize a mesma linha duas vezes: fica a última de cada chave
+        columns = self.on_conflict.split(',')
+        latest = {tuple(row[column] for column in columns): row for row in batch}
+        await _execute(table.upsert(list(latest.values()), on_conflict=self.on_conflict, returning=ReturnMethod.minimal))
+
+    async def close(self) -> None:
+        """Para a tarefa de fundo e grava o que estiver pendente."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._rows:
+            logger.error(f"❌ [DB] {len(self._rows)} linha(s) de '{self.table}' não puderam ser gravadas no desligamento.")
+
+
+log_buffer = WriteBehindBuffer('logs', LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_MAX_PENDING)
+
+
+def start_write_behind() -> None:
+    """Inicia a gravação em segundo plano de todos os buffers (chamado no início do app)."""
+    if not supabase_async: return
+    for buffer in (log_buffer, roster_buffer, expiry_confirmations):
+        buffer.start()
+
+async def close_db_client() -> None:
+    """Grava os logs, o roster e as confirmações de expiração pendentes e fecha as conexões do pool HTTP (chamado no desligamento do app)."""
+    if supabase_async:
+        await log_buffer.close()
+        await roster_buffer.close()
+        await expiry_confirmations.close()
+        await supabase_async.aclose()
+        logger.info("[DB] Pool de conexões do Supabase encerrado.")
+
+# --- FUNÇÕES DE CONFIGURAÇÕES (SETTINGS) ---
+
+async def _load_settings() -> Dict[str, Any]:
+    """Carrega todas as configurações da tabela `settings`, indexadas pela chave."""
+    response = await _execute(
+        supabase_async.table('settings').select('key, value')
+    )
+    return {row['key']: row.get('value') for row in response.data or []}
+
+# As configurações são lidas em todo /start: ficam em memória com um TTL curto e são
+# atualizadas em write-through por `update_setting`.
+settings_store = SnapshotCache('settings', _load_settings, SETTINGS_CACHE_TTL)
+
+async def get_setting(key: str) -> Optional[Dict[str, Any]]:
+    """Busca uma configuração pela chave (servida pelo cache de configurações)."""
+    if not supabase_async: return None
+    settings = await settings_store.get()
+    if settings is None:
+        logger.error(f"[DB] Erro ao buscar configuração '{key}': cache de configurações indisponível.")
         return None
+    if key in settings:
+        logger.debug(f"[DB] Configuração '{key}' encontrada: {settings[key]}")
+        return settings[key]
+    logger.warning(f"[DB] Configuração '{key}' não encontrada.")
+    return None
+
+
+async def refresh_settings() -> None:
+    """Força a recarga do cache de configurações a partir do banco de dados."""
+    if not supabase_async: return
+    await settings_store.refresh(force=True)
 
 
 async def update_setting(key: str, value: Dict[str, Any]) -> bool:
     """Atualiza ou cria uma configuração no banco de dados."""
-    if not supabase: return False
+    if not supabase_async: return False
     try:
         # 1. Verifica se a configuração já existe de forma assíncrona
-        existing_response = await asyncio.to_thread(
-            lambda: supabase.table('settings').select('key').eq('key', key).execute()
+        existing_response = await _execute(
+            supabase_async.table('settings').select('key').eq('key', key)
         )
 
         # 2. Decide entre atualizar (update) ou criar (insert)
         if existing_response.data:
             logger.info(f"[DB] Atualizando configuração '{key}' com valor: {value}")
             # CORREÇÃO: Removemos o .select() da chamada de atualização
-            response = await asyncio.to_thread(
-                lambda: supabase.table('settings').update({'value': value}).eq('key', key).execute()
+            response = await _execute(
+                supabase_async.table('settings').update({'value': value}).eq('key', key)
             )
         else:
             logger.info(f"[DB] Criando nova configuração '{key}' com valor: {value}")
             # CORREÇÃO: Removemos o .select() da chamada de inserção
-            response = await asyncio.to_thread(
-                lambda: supabase.table('settings').insert({'key': key, 'value': value}).execute()
+            response = await _execute(
+                supabase_async.table('settings').insert({'key': key, 'value': value})
             )
 
         # 3. Verifica se a operação teve sucesso
         if response.data:
             logger.info(f"[DB] Configuração '{key}' salva com sucesso!")
+            # 4. Write-through: o cache passa a refletir o novo valor imediatamente
+            if settings_store.is_fresh:
+                settings_store.set({**await settings_store.get(), key: value})
+            else:
+                settings_store.invalidate()
             return True
         else:
             # Loga a resposta completa da API em caso de falha para facilitar o debug
@@ -92,11 +344,34 @@ async def initialize_default_settings():
     except Exception as e:
         logger.error(f"[DB] Erro ao inicializar configurações: {e}")
 
+async def warm_up_caches():
+    """Pré-carrega os caches em memória na inicialização do app."""
+    if not supabase_async: return
+    products = await product_catalog.refresh(force=True) or {}
+    logger.info(f"[DB] Catálogo de produtos carregado ({len(products)} produtos).")
+    settings = await settings_store.refresh(force=True) or {}
+    logger.info(f"[DB] Configurações carregadas ({len(settings)} chaves).")
+    groups = await group_registry.refresh(force=True) or []
+    logger.info(f"[DB] Registro de grupos carregado ({len(groups)} grupos).")
+    members = await load_group_roster()
+    logger.info(f"[DB] Roster de membros dos grupos carregado ({members} registros).")
+
+def get_cache_stats() -> Dict[str, Dict[str, int]]:
+    """Contadores de cache e de coalescência das leituras mais frequentes (desde o início do processo)."""
+    return {
+        'products': product_catalog.stats(),
+        'settings': settings_store.stats(),
+        'groups': group_registry.stats(),
+        'active_subscriptions': active_subscription_cache.stats(),
+        'coupons': coupon_flight.stats(),
+        'group_roster': get_roster_stats(),
+    }
+
 # --- FUNÇÕES DE USUÁRIO ---
 
 async def get_or_create_user(tg_user: TelegramUser) -> dict | None:
     """Busca ou cria um usuário no banco de dados de forma eficiente usando upsert."""
-    if not supabase: return None
+    if not supabase_async: return None
     try:
         user_data = {
             "telegram_user_id": tg_user.id,
@@ -106,10 +381,9 @@ async def get_or_create_user(tg_user: TelegramUser) -> dict | None:
 
         # --- CORREÇÃO APLICADA AQUI ---
         # A chamada .select() foi removida. O upsert já retorna os dados por padrão.
-        response = await asyncio.to_thread(
-            lambda: supabase.table('users')
+        response = await _execute(
+            supabase_async.table('users')
             .upsert(user_data, on_conflict='telegram_user_id')
-            .execute()
         )
         # --- FIM DA CORREÇÃO ---
 
@@ -129,25 +403,25 @@ async def get_or_create_user(tg_user: TelegramUser) -> dict | None:
 
 async def find_user_by_id_or_username(identifier: str) -> dict | None:
     """Busca um usuário pelo seu Telegram ID ou username, incluindo suas assinaturas."""
-    if not supabase: return None
+    if not supabase_async: return None
     try:
-        query = supabase.table('users').select('*, subscriptions(*, product:products(*))')
+        query = supabase_async.table('users').select('*, subscriptions(*, product:products(*))')
         if identifier.isdigit():
             query = query.eq('telegram_user_id', int(identifier))
         else:
             username = identifier.lstrip('@')
             query = query.eq('username', username)
-        response = await asyncio.to_thread(lambda: query.single().execute())
+        response = await _execute(query.single())
         return response.data
     except Exception:
         return None
 
 async def find_user_by_db_id(db_id: int) -> dict | None:
     """Busca um usuário pelo seu ID do banco de dados (chave primária)."""
-    if not supabase: return None
+    if not supabase_async: return None
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('users').select('*').eq('id', db_id).single().execute()
+        response = await _execute(
+            supabase_async.table('users').select('*').eq('id', db_id).single()
         )
         return response.data
     except Exception:
@@ -155,29 +429,32 @@ async def find_user_by_db_id(db_id: int) -> dict | None:
 
 # --- FUNÇÕES DE PRODUTOS ---
 
+async def _load_product_catalog() -> Dict[int, dict]:
+    """Carrega todos os produtos, indexados por ID e já ordenados por preço."""
+    response = await _execute(
+        supabase_async.table('products').select('*').order('price')
+    )
+    return {product['id']: product for product in response.data or []}
+
+# A tabela de produtos quase nunca muda: ela fica em memória e é recarregada pelo TTL
+# ou explicitamente via `product_catalog.invalidate()`.
+product_catalog = SnapshotCache('products', _load_product_catalog, PRODUCT_CACHE_TTL)
+
 async def get_product_by_id(product_id: int) -> dict | None:
-    """Busca os detalhes de um produto pelo seu ID."""
-    if not supabase: return None
-    try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('products').select('*').eq('id', product_id).single().execute()
-        )
-        return response.data
-    except Exception as e:
-        logger.error(f"❌ [DB] Erro ao buscar produto {product_id}: {e}", exc_info=True)
+    """Busca os detalhes de um produto pelo seu ID (servido pelo catálogo em memória)."""
+    if not supabase_async: return None
+    products = await product_catalog.get() or {}
+    product = products.get(product_id)
+    if not product:
+        logger.error(f"❌ [DB] Produto {product_id} não encontrado no catálogo (versão {product_catalog.version}).")
         return None
+    return dict(product)
 
 async def get_all_products() -> List[dict]:
     """Retorna todos os produtos cadastrados, ordenados por preço."""
-    if not supabase: return []
-    try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('products').select('*').order('price').execute()
-        )
-        return response.data or []
-    except Exception as e:
-        logger.error(f"❌ [DB] Erro ao buscar todos os produtos: {e}", exc_info=True)
-        return []
+    if not supabase_async: return []
+    products = await product_catalog.get() or {}
+    return [dict(product) for product in products.values()]
 
 # --- FUNÇÕES DE ASSINATURAS ---
 
@@ -189,7 +466,7 @@ async def create_pending_subscription(
     """
     Cria uma assinatura pendente, salva a external_reference e registra o uso do cupom.
     """
-    if not supabase: return None
+    if not supabase_async: return None
     try:
         sub_data = {
             "user_id": db_user_id, "product_id": product_id, "mp_payment_id": mp_payment_id,
@@ -199,8 +476,8 @@ async def create_pending_subscription(
 
         # --- CORREÇÃO DO ERRO 1 ---
         # A chamada .select() foi removida. O insert já retorna os dados.
-        sub_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions').insert(sub_data).execute()
+        sub_response = await _execute(
+            supabase_async.table('subscriptions').insert(sub_data)
         )
         # --- FIM DA CORREÇÃO ---
 
@@ -212,13 +489,13 @@ async def create_pending_subscription(
         await create_log('subscription_pending', f"Assinatura pendente {new_subscription['id']} criada para user {db_user_id}")
 
         if coupon_id:
-            await asyncio.to_thread(
-                lambda: supabase.table('coupon_usage').insert({
+            await _execute(
+                supabase_async.table('coupon_usage').insert({
                     "coupon_id": coupon_id,
                     "user_id": db_user_id,
                     "subscription_id": new_subscription['id'],
                     "discount_applied": original_price - final_price
-                }).execute()
+                })
             )
         return new_subscription
     except Exception as e:
@@ -228,15 +505,48 @@ async def create_pending_subscription(
 async def activate_subscription(mp_payment_id: str) -> dict | None:
     """
     Ativa uma assinatura de forma robusta, sendo tolerante a erros e webhooks duplicados.
+    Toda a transição (ativar ou estender) roda no banco em uma única chamada à função
+    `activate_subscription` (sql/activate_subscription.sql), que bloqueia a linha e é idempotente.
+    O dicionário retornado traz `already_active=True` quando a assinatura já tinha sido ativada
+    por outra chamada; nesse caso quem chamou não deve repetir os efeitos colaterais.
+    """
+    if not supabase_async: return None
+    try:
+        response = await _execute_rpc('activate_subscription', {'p_mp_payment_id': mp_payment_id})
+        if response is None:
+            return await _activate_subscription_local(mp_payment_id)
+
+        if not response.data:
+            logger.warning(f"⚠️ [DB] Assinatura com mp_payment_id {mp_payment_id} não encontrada no DB.")
+            return None
+
+        subscription = response.data[0]
+        if subscription.get('already_active'):
+            logger.info(f"✅ [DB] Assinatura {subscription['id']} já estava ativa. Ignorando re-ativação.")
+            return subscription
+
+        user = subscription.get('user') or {}
+        invalidate_active_subscription(user.get('telegram_user_id'))
+        await create_log('subscription_activated', f"Assinatura {subscription['id']} ativada para usuário {user.get('telegram_user_id')}")
+        logger.info(f"✅ [DB] Assinatura {subscription['id']} ativada com sucesso.")
+        return subscription
+
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao ativar assinatura {mp_payment_id}: {e}", exc_info=True)
+        return None
+
+async def _activate_subscription_local(mp_payment_id: str) -> dict | None:
+    """
+    Versão em várias etapas de `activate_subscription`, executada pelo próprio bot.
+    Usada quando a função SQL ainda não foi criada no banco (e como referência local dela).
+    A atualização é condicional ao status, então apenas uma chamada concorrente faz a transição.
     """
-    if not supabase: return None
     try:
-        sub_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
+        sub_response = await _execute(
+            supabase_async.table('subscriptions')
             .select('*, user:users(*), product:products(*)')
             .eq('mp_payment_id', mp_payment_id)
             .maybe_single()
-            .execute()
         )
 
         if not sub_response or not sub_response.data:
@@ -247,6 +557,7 @@ async def activate_subscription(mp_payment_id: str) -> dict | None:
 
         if subscription.get('status') == 'active':
             logger.info(f"✅ [DB] Assinatura {subscription['id']} já estava ativa. Ignorando re-ativação.")
+            subscription['already_active'] = True
             return subscription
 
         user, product = subscription.get('user'), subscription.get('product')
@@ -255,8 +566,8 @@ async def activate_subscription(mp_payment_id: str) -> dict | None:
             return None
 
         start_date_base = datetime.now(TIMEZONE_BR)
-        active_sub_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions').select('id, end_date').eq('user_id', user['id']).eq('status', 'active').order('end_date', desc=True).limit(1).maybe_single().execute()
+        active_sub_response = await _execute(
+            supabase_async.table('subscriptions').select('id, end_date').eq('user_id', user['id']).eq('status', 'active').order('end_date', desc=True).limit(1).maybe_single()
         )
         existing_active_sub = active_sub_response.data if active_sub_response else None
         if existing_active_sub and existing_active_sub.get('end_date'):
@@ -274,30 +585,36 @@ async def activate_subscription(mp_payment_id: str) -> dict | None:
 
         # --- CORREÇÃO APLICADA (SUGESTÃO DO CHATGPT) ---
 
-        # 1. Atualiza a assinatura sem tentar retornar os dados
-        await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
+        # 1. Atualiza a assinatura apenas se outra chamada ainda não a ativou
+        claimed = await _execute(
+            supabase_async.table('subscriptions')
             .update(update_payload)
             .eq('id', subscription['id'])
-            .execute()
+            .neq('status', 'active')
         )
 
         # 2. Busca o registro atualizado em uma chamada separada
-        final_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
+        final_response = await _execute(
+            supabase_async.table('subscriptions')
             .select('*, user:users(*)')
             .eq('id', subscription['id'])
             .single()
-            .execute()
         )
 
         # --- FIM DA CORREÇÃO ---
 
+        invalidate_active_subscription(user['telegram_user_id'])
+
         if final_response and final_response.data:
             updated_subscription = final_response.data
+            updated_subscription['product'] = product # Adiciona a informação do produto de volta
+            if not claimed.data:
+                logger.info(f"✅ [DB] Assinatura {subscription['id']} foi ativada por outra chamada concorrente.")
+                updated_subscription['already_active'] = True
+                return updated_subscription
+            updated_subscription['already_active'] = False
             await create_log('subscription_activated', f"Assinatura {subscription['id']} ativada para usuário {user['telegram_user_id']}")
             logger.info(f"✅ [DB] Assinatura {subscription['id']} ativada com sucesso.")
-            updated_subscription['product'] = product # Adiciona a informação do produto de volta
             return updated_subscription
         else:
             logger.error(f"❌ [DB] Falha ao buscar dados da assinatura {subscription['id']} após a atualização.")
@@ -307,27 +624,49 @@ async def activate_subscription(mp_payment_id: str) -> dict | None:
         logger.error(f"❌ [DB] Erro ao ativar assinatura {mp_payment_id}: {e}", exc_info=True)
         return None
 
+# Cache de assinatura ativa por telegram_user_id, usado pelo gatekeeper, /status e suporte.
+# Também guarda resultados negativos (None). Toda função que muda o status de uma assinatura
+# deve invalidar a entrada do usuário.
+active_subscription_cache = TTLCache('active_subscriptions', SUBSCRIPTION_CACHE_TTL, SUBSCRIPTION_CACHE_MAXSIZE)
+
+def invalidate_active_subscription(telegram_user_id: int) -> None:
+    """Remove do cache a assinatura ativa de um usuário (pelo Telegram ID)."""
+    active_subscription_cache.invalidate(telegram_user_id)
+
+async def _invalidate_active_subscription_for_db_user(db_user_id: int) -> None:
+    """Invalida o cache de assinatura ativa a partir do ID do usuário no banco de dados."""
+    user = await find_user_by_db_id(db_user_id)
+    if user and user.get('telegram_user_id'):
+        invalidate_active_subscription(user['telegram_user_id'])
+
 async def get_user_active_subscription(telegram_user_id: int) -> dict | None:
     """Busca a assinatura ativa de um usuário, incluindo dados do produto."""
-    if not supabase: return None
+    if not supabase_async: return None
+    cached = active_subscription_cache.get(telegram_user_id)
+    if cached is not MISSING:
+        return dict(cached) if cached else None
+    epoch = active_subscription_cache.epoch
     try:
         # A forma mais direta é buscar na tabela de assinaturas e pedir os dados do usuário
-        response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
+        response = await _execute(
+            supabase_async.table('subscriptions')
             .select('*, product:products(*), user:users!inner(*)')
             .eq('user.telegram_user_id', telegram_user_id)
             .eq('status', 'active')
             .limit(1)
             .maybe_single()
-            .execute()
         )
-        return response.data
     except Exception:
+        # Erros não são cacheados: a próxima chamada tenta novamente
         return None
+    # maybe_single() retorna None quando não há assinatura ativa
+    subscription = response.data if response else None
+    active_subscription_cache.set(telegram_user_id, subscription, epoch=epoch)
+    return dict(subscription) if subscription else None
 
 async def create_manual_subscription(db_user_id: int, product_id: int, admin_notes: str) -> dict | None:
     """Cria uma assinatura ativa manualmente por um admin."""
-    if not supabase: return None
+    if not supabase_async: return None
     try:
         product = await get_product_by_id(product_id)
         if not product:
@@ -349,11 +688,12 @@ async def create_manual_subscription(db_user_id: int, product_id: int, admin_not
         }
 
         # --- CORREÇÃO APLICADA AQUI ---
-        response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions').insert(insert_data).execute()
+        response = await _execute(
+            supabase_async.table('subscriptions').insert(insert_data)
         )
         # --- FIM DA CORREÇÃO ---
 
+        await _invalidate_active_subscription_for_db_user(db_user_id)
         await create_log('manual_subscription', f"Assinatura manual criada para usuário {db_user_id} - {admin_notes}")
         logger.info(f"✅ [DB] Assinatura manual criada para usuário {db_user_id}.")
         return response.data[0] if response.data else None
@@ -369,7 +709,7 @@ async def grant_or_extend_manual_subscription(db_user_id: int, product_id: int,
     - Se o novo produto for vitalício, substitui qualquer assinatura existente.
     - Se o usuário já tiver uma assinatura vitalícia, não faz nada.
     """
-    if not supabase: return None
+    if not supabase_async: return None
 
     try:
         # 1. Obter detalhes do novo produto
@@ -383,14 +723,13 @@ async def grant_or_extend_manual_subscription(db_user_id: int, product_id: int,
         # 2. Encontrar a assinatura ativa do usuário (se houver) - FORMA SEGURA
         existing_active_sub = None
         try:
-            response = await asyncio.to_thread(
-                lambda: supabase.table('subscriptions')
+            response = await _execute(
+                supabase_async.table('subscriptions')
                 .select('*')
                 .eq('user_id', db_user_id)
                 .eq('status', 'active')
                 .limit(1)
                 .maybe_single() # Retorna None se não encontrar, em vez de erro
-                .execute()
             )
             # Verificação segura: garante que response e response.data existam
             if response and response.data:
@@ -412,8 +751,8 @@ async def grant_or_extend_manual_subscription(db_user_id: int, product_id: int,
         if not new_duration_days:
             if existing_active_sub:
                 # Marca a assinatura antiga como substituída
-                await asyncio.to_thread(
-                    lambda: supabase.table('subscriptions').update({'status': 'superceded'}).eq('id', existing_active_sub['id']).execute()
+                await _execute(
+                    supabase_async.table('subscriptions').update({'status': 'superceded'}).eq('id', existing_active_sub['id'])
                 )
             # Cria a nova assinatura vitalícia
             return await create_manual_subscription(db_user_id, product_id, admin_notes)
@@ -428,14 +767,14 @@ async def grant_or_extend_manual_subscription(db_user_id: int, product_id: int,
 
             new_end_date = base_date + timedelta(days=new_duration_days)
 
-            update_response = await asyncio.to_thread(
-                lambda: supabase.table('subscriptions')
+            update_response = await _execute(
+                supabase_async.table('subscriptions')
                 .update({'end_date': new_end_date.isoformat(), 'updated_at': datetime.now(TIMEZONE_BR).isoformat()})
                 .eq('id', existing_active_sub['id'])
                 .select('*')
                 .single()
-                .execute()
             )
+            await _invalidate_active_subscription_for_db_user(db_user_id)
             logger.info(f"[DB] grant_or_extend: Assinatura {existing_active_sub['id']} estendida para {new_end_date.isoformat()}.")
             return update_response.data
 
@@ -449,15 +788,15 @@ async def grant_or_extend_manual_subscription(db_user_id: int, product_id: int,
 
 async def revoke_subscription(db_user_id: int, admin_notes: str) -> bool:
     """Revoga a assinatura ativa de um usuário."""
-    if not supabase: return False
+    if not supabase_async: return False
     try:
-        await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
+        await _execute(
+            supabase_async.table('subscriptions')
             .update({"status": "revoked_by_admin", "end_date": datetime.now(TIMEZONE_BR).isoformat()})
             .eq('user_id', db_user_id)
             .eq('status', 'active')
-            .execute()
         )
+        await _invalidate_active_subscription_for_db_user(db_user_id)
         await create_log('subscription_revoked', f"Assinatura revogada para usuário {db_user_id} - {admin_notes}")
         logger.info(f"✅ [DB] Assinatura do usuário {db_user_id} revogada.")
         return True
@@ -465,55 +804,391 @@ async def revoke_subscription(db_user_id: int, admin_notes: str) -> bool:
         logger.error(f"❌ [DB] Erro ao revogar assinatura: {e}", exc_info=True)
         return False
 
+async def iter_active_user_pages(page_size: int = DB_PAGE_SIZE, after_id: int = 0) -> AsyncIterator[List[dict]]:
+    """
+    Gera, página a página, os usuários com assinatura ativa ({'id', 'telegram_user_id'}), em ordem de ID.
+    Pagina pela tabela 'users' (cada usuário aparece uma única vez), com um join interno
+    nas assinaturas ativas. `after_id` permite retomar a partir de um ID interno de usuário.
+    Sem o cliente do Supabase, levanta um erro em vez de gerar uma lista vazia: quem consome a lista
+    (ex.: a auditoria) não pode confundir "banco indisponível" com "nenhum assinante ativo".
+    """
+    if not supabase_async:
+        raise RuntimeError("Cliente do Supabase indisponível: não é possível listar os usuários ativos.")
+    try:
+        async for rows in _iter_pages(
+            lambda: supabase_async.table('users')
+            .select('id, telegram_user_id, subscriptions!inner(id)')
+            .eq('subscriptions.status', 'active'),
+            page_size, after_id
+        ):
+            yield [{'id': row['id'], 'telegram_user_id': row['telegram_user_id']} for row in rows]
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao paginar usuários ativos: {e}", exc_info=True)
+        raise
+
+async def iter_active_tg_user_id_pages(page_size: int = DB_PAGE_SIZE, after_id: int = 0) -> AsyncIterator[List[int]]:
+    """Gera, página a página, os Telegram User IDs dos usuários com assinatura ativa."""
+    async for rows in iter_active_user_pages(page_size, after_id):
+        yield [row['telegram_user_id'] for row in rows]
+
+async def count_active_tg_users() -> int:
+    """Conta quantos usuários possuem ao menos uma assinatura ativa."""
+    if not supabase_async: return 0
+    try:
+        response = await _execute(
+            supabase_async.table('users')
+            .select('id, subscriptions!inner(id)', count='exact')
+            .eq('subscriptions.status', 'active')
+            .limit(1)
+        )
+        return response.count or 0
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao contar usuários ativos: {e}", exc_info=True)
+        return 0
+
+async def count_inactive_users() -> int:
+    """Conta quantos usuários cadastrados não possuem assinatura ativa."""
+    if not supabase_async: return 0
+    try:
+        users_resp, active = await asyncio.gather(
+            _execute(supabase_async.table('users').select('id', count='exact').limit(1)),
+            count_active_tg_users(),
+        )
+        return max(0, (users_resp.count or 0) - active)
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao contar usuários sem assinatura ativa: {e}", exc_info=True)
+        return 0
+
 async def get_all_active_tg_user_ids() -> list[int]:
     """Retorna uma lista de Telegram User IDs de todos os usuários com assinatura ativa."""
-    if not supabase: return []
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
-            .select('user:users(telegram_user_id)')
-            .eq('status', 'active')
-            .execute()
-        )
-        if not response.data: return []
-        # Usa um set para garantir IDs únicos e depois converte para lista
-        user_ids = {item['user']['telegram_user_id'] for item in response.data if item.get('user')}
-        return list(user_ids)
+        return [uid async for page in iter_active_tg_user_id_pages() for uid in page]
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao buscar usuários ativos: {e}", exc_info=True)
         return []
 
-# --- FUNÇÕES DE GRUPOS ---
+# --- FUNÇÕES DE EXPIRAÇÃO EM LOTE ---
+# O scheduler transiciona as assinaturas vencidas em blocos e só depois executa os efeitos no Telegram
+# (remoção dos grupos e aviso). Cada linha expirada fica com `expiry_processed_at` nulo até os efeitos
+# dela serem confirmados (confirm_expiry_processed), então uma execução interrompida é retomada na
+# próxima sem perder ninguém e sem repetir quem já foi confirmado.
+# Requer a migração sql/expiry_processed_at.sql. Sem ela, vale a ordem antiga: as vencidas são só lidas,
+# e cada uma passa a 'expired' na confirmação, depois da remoção; um processo que cair antes disso
+# deixa a assinatura 'active', e ela é encontrada de novo na próxima execução.
+_expiry_tracking_available = True
+
+
+def _expiry_column_missing(e: Exception) -> bool:
+    """Se o erro indicar que a coluna expiry_processed_at não existe, desliga o rastreio por linha e retorna True."""
+    global _expiry_tracking_available
+    if not (isinstance(e, APIError) and e.code in COLUMN_NOT_FOUND):
+        return False
+    _expiry_tracking_available = False
+    logger.warning("⚠️ [DB] Coluna 'expiry_processed_at' ausente (aplique sql/expiry_processed_at.sql). Expiração seguirá sem retomada.")
+    return True
 
-async def get_all_group_ids() -> list[int]:
-    """Busca os IDs de todos os grupos cadastrados."""
-    if not supabase: return []
+
+def _expiry_row(row: dict) -> dict:
+    return {
+        'id': row['id'],
+        'product_id': row.get('product_id'),
+        'telegram_user_id': (row.get('user') or {}).get('telegram_user_id'),
+    }
+
+
+async def get_unprocessed_expired_subscriptions() -> List[dict]:
+    """
+    Retorna as assinaturas já marcadas como 'expired' cujos efeitos no Telegram ainda não foram
+    confirmados (sobras de uma execução interrompida). Cada item tem id, product_id e telegram_user_id.
+    É a primeira consulta da expiração: também é ela que descobre se a migração foi aplicada.
+    """
+    if not supabase_async or not _expiry_tracking_available: return []
+    pending = []
+    try:
+        async for rows in _iter_pages(
+            lambda: supabase_async.table('subscriptions')
+            .select('id, product_id, user:users(telegram_user_id)')
+            .eq('status', 'expired')
+            .is_('expiry_processed_at', 'null'),
+            DB_PAGE_SIZE
+        ):
+            pending.extend(_expiry_row(row) for row in rows)
+    except Exception as e:
+        if not _expiry_column_missing(e):
+            logger.error(f"❌ [DB] Erro ao buscar expirações pendentes: {e}", exc_info=True)
+    return pending
+
+
+async def expire_due_subscriptions(now_iso: str) -> List[dict]:
+    """
+    Marca como 'expired' todas as assinaturas ativas com end_date anterior a `now_iso`.
+    Lê as vencidas por paginação e atualiza em blocos de EXPIRY_BATCH_SIZE com `in_`, em vez de um
+    UPDATE por assinatura. O filtro status='active' no UPDATE faz com que cada linha seja reivindicada
+    por uma única execução: só as linhas devolvidas pelo banco são retornadas para processamento.
+    Sem a migração de expiry_processed_at, só lê as vencidas: o status muda na confirmação.
+    """
+    if not supabase_async: return []
+    claimed = []
+    try:
+        async for rows in _iter_pages(
+            lambda: supabase_async.table('subscriptions')
+            .select('id, product_id, user:users(telegram_user_id)')
+            .eq('status', 'active')
+            .lt('end_date', now_iso),
+            EXPIRY_BATCH_SIZE
+        ):
+            if not _expiry_tracking_available:
+                claimed.extend(_expiry_row(row) for row in rows)
+                continue
+            by_id = {row['id']: row for row in rows}
+            response = await _execute(
+                supabase_async.table('subscriptions')
+                .update({'status': 'expired'})
+                .in_('id', list(by_id))
+                .eq('status', 'active')
+            )
+            for updated in response.data or []:
+                row = _expiry_row(by_id.get(updated['id'], updated))
+                if row['telegram_user_id']:
+                    invalidate_active_subscription(row['telegram_user_id'])
+                claimed.append(row)
+    except Exception as e:
+        # O que já foi transicionado é devolvido; sobras com o rastreio ativo são retomadas na próxima execução
+        logger.error(f"❌ [DB] Erro ao expirar assinaturas em lote: {e}", exc_info=True)
+    if claimed and _expiry_tracking_available:
+        logger.info(f"✅ [DB] {len(claimed)} assinaturas marcadas como 'expired' em lote.")
+    return claimed
+
+
+class _ExpiryConfirmations(WriteBehindBuffer):
+    """
+    Fila das assinaturas cujos efeitos da expiração já rodaram. Cada lote vira um único UPDATE com `in_`:
+    expiry_processed_at com a migração, ou status 'expired' (só das ainda 'active') sem ela.
+    """
+
+    async def _write(self, batch: List[dict]) -> None:
+        ids = [row['id'] for row in batch]
+        if _expiry_tracking_available:
+            try:
+                await _execute(
+                    supabase_async.table('subscriptions')
+                    .update({'expiry_processed_at': datetime.now(TIMEZONE_BR).isoformat()}, returning=ReturnMethod.minimal)
+                    .in_('id', ids)
+                )
+                return
+            except Exception as e:
+                if not _expiry_column_missing(e):
+                    raise
+        response = await _execute(
+            supabase_async.table('subscriptions')
+            .update({'status': 'expired'})
+            .in_('id', ids)
+            .eq('status', 'active')
+        )
+        by_id = {row['id']: row for row in batch}
+        for updated in response.data or []:
+            user_id = by_id.get(updated['id'], {}).get('telegram_user_id')
+            if user_id:
+                invalidate_active_subscription(user_id)
+        logger.info(f"✅ [DB] {len(response.data or [])} assinaturas marcadas como 'expired' em lote.")
+
+
+expiry_confirmations = _ExpiryConfirmations('subscriptions', EXPIRY_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_MAX_PENDING)
+
+
+def confirm_expiry_processed(subscription: dict) -> None:
+    """
+    Confirma que os efeitos da expiração desta assinatura (item de expire_due_subscriptions) já rodaram.
+    Não espera pelo banco: a confirmação entra na fila e é gravada em lote, em segundo plano.
+    """
+    if not supabase_async: return
+    expiry_confirmations.add({'id': subscription['id'], 'telegram_user_id': subscription.get('telegram_user_id')})
+
+
+async def flush_expiry_confirmations() -> None:
+    """Grava agora as confirmações pendentes (ex.: ao fim de cada bloco da expiração)."""
+    if not supabase_async: return
+    await expiry_confirmations.flush()
+
+# --- FUNÇÕES DE BROADCAST (ENVIOS EM MASSA DURÁVEIS) ---
+# Requer a tabela de sql/broadcast_jobs.sql. Sem ela, create_broadcast_job retorna None e o envio
+# roda só em memória, como antes (sem retomada após reinício).
+# Cada envio tem um dono (owner = INSTANCE_ID) e um heartbeat renovado a cada checkpoint; as outras
+# instâncias só o retomam depois de BROADCAST_LEASE_SECONDS sem heartbeat. Sem as colunas do lease,
+# os envios seguem sem dono e só são retomados no início do app, como antes.
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+BROADCAST_LEASE_SECONDS = int(os.getenv("BROADCAST_LEASE_SECONDS", 300))
+_broadcast_lease_available = True
+
+
+def _broadcast_lease_missing(e: Exception) -> bool:
+    """Se o erro indicar que as colunas do lease não existem, desliga o lease e retorna True."""
+    global _broadcast_lease_available
+    if not (isinstance(e, APIError) and e.code in COLUMN_NOT_FOUND):
+        return False
+    _broadcast_lease_available = False
+    logger.warning("⚠️ [DB] Colunas owner/heartbeat_at ausentes em broadcast_jobs (aplique sql/broadcast_jobs.sql). Envios seguirão sem lease.")
+    return True
+
+
+def _broadcast_lease() -> Dict[str, str]:
+    return {'owner': INSTANCE_ID, 'heartbeat_at': datetime.now(TIMEZONE_BR).isoformat()}
+
+
+async def create_broadcast_job(kind: str, payload: dict, admin_chat_id: int, admin_message_id: int, total: int) -> dict | None:
+    """Registra um novo envio em massa com status 'running', cursor no início e esta instância como dona."""
+    if not supabase_async: return None
+    row = {
+        'kind': kind,
+        'status': 'running',
+        'payload': payload,
+        'admin_chat_id': admin_chat_id,
+        'admin_message_id': admin_message_id,
+        'total': total,
+        'last_user_id': 0,
+        'counts': {},
+    }
+    try:
+        try:
+            response = await _execute(
+                supabase_async.table('broadcast_jobs').insert(row | _broadcast_lease() if _broadcast_lease_available else row)
+            )
+        except APIError as e:
+            if not _broadcast_lease_available or not _broadcast_lease_missing(e):
+                raise
+            response = await _execute(supabase_async.table('broadcast_jobs').insert(row))
+        return response.data[0] if response.data else None
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao registrar broadcast: {e}", exc_info=True)
+        return None
+
+async def checkpoint_broadcast_job(job_id: int, last_user_id: int, counts: Dict[str, int]) -> bool:
+    """
+    Grava o cursor (último users.id já processado) e os contadores de um envio em andamento, renovando
+    o heartbeat. Só grava se esta instância ainda for a dona do envio.
+    """
+    if not supabase_async: return False
+    changes = {
+        'last_user_id': last_user_id,
+        'counts': counts,
+        'updated_at': datetime.now(TIMEZONE_BR).isoformat(),
+    }
+    try:
+        query = supabase_async.table('broadcast_jobs').update(
+            changes | _broadcast_lease() if _broadcast_lease_available else changes, returning=ReturnMethod.minimal
+        ).eq('id', job_id).eq('status', 'running')
+        if _broadcast_lease_available:
+            query = query.eq('owner', INSTANCE_ID)
+        await _execute(query)
+        return True
+    except Exception as e:
+        if _broadcast_lease_available and _broadcast_lease_missing(e):
+            return await checkpoint_broadcast_job(job_id, last_user_id, counts)
+        logger.error(f"❌ [DB] Erro ao gravar checkpoint do broadcast {job_id}: {e}", exc_info=True)
+        return False
+
+async def finish_broadcast_job(job_id: int, status: str, counts: Dict[str, int]) -> bool:
+    """Encerra um envio ('completed' ou 'interrupted'), gravando os contadores finais (só se esta instância for a dona)."""
+    if not supabase_async: return False
+    now_iso = datetime.now(TIMEZONE_BR).isoformat()
+    try:
+        query = supabase_async.table('broadcast_jobs').update(
+            {'status': status, 'counts': counts, 'updated_at': now_iso, 'finished_at': now_iso}, returning=ReturnMethod.minimal
+        ).eq('id', job_id)
+        if _broadcast_lease_available:
+            query = query.eq('owner', INSTANCE_ID)
+        await _execute(query)
+        return True
+    except Exception as e:
+        if _broadcast_lease_available and _broadcast_lease_missing(e):
+            return await finish_broadcast_job(job_id, status, counts)
+        logger.error(f"❌ [DB] Erro ao encerrar o broadcast {job_id}: {e}", exc_info=True)
+        return False
+
+async def claim_broadcast_jobs() -> List[dict] | None:
+    """
+    Reivindica para esta instância os envios 'running' sem dono ou com heartbeat vencido, cada um com
+    um UPDATE condicional: só as linhas devolvidas pelo banco foram de fato reivindicadas e podem ser
+    retomadas. Retorna None se as colunas do lease não existirem (quem chamou decide o que retomar).
+    """
+    if not supabase_async: return []
+    if not _broadcast_lease_available: return None
+    cutoff = (datetime.now(TIMEZONE_BR) - timedelta(seconds=BROADCAST_LEASE_SECONDS)).isoformat()
+    claimed: Dict[int, dict] = {}
     try:
-        response = await asyncio.to_thread(lambda: supabase.table('groups').select('telegram_chat_id').execute())
-        return [item['telegram_chat_id'] for item in response.data] if response.data else []
+        for condition in (lambda q: q.is_('owner', 'null'), lambda q: q.lt('heartbeat_at', cutoff)):
+            response = await _execute(condition(
+                supabase_async.table('broadcast_jobs').update(_broadcast_lease()).eq('status', 'running')
+            ))
+            claimed.update((job['id'], job) for job in response.data or [])
     except Exception as e:
-        logger.error(f"❌ [DB] Erro ao buscar IDs dos grupos: {e}", exc_info=True)
+        if _broadcast_lease_missing(e):
+            return None
+        logger.error(f"❌ [DB] Erro ao reivindicar broadcasts em andamento: {e}", exc_info=True)
+    return [claimed[job_id] for job_id in sorted(claimed)]
+
+async def get_running_broadcast_jobs() -> List[dict]:
+    """Retorna os envios que ainda constam como 'running' (ex.: interrompidos por um reinício)."""
+    if not supabase_async: return []
+    try:
+        response = await _execute(
+            supabase_async.table('broadcast_jobs').select('*').eq('status', 'running').order('id')
+        )
+        return response.data or []
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao buscar broadcasts em andamento: {e}", exc_info=True)
         return []
 
-async def get_all_groups_with_names() -> list[dict]:
-    """Busca os IDs e nomes de todos os grupos cadastrados."""
-    if not supabase: return []
+async def get_recent_broadcast_jobs(limit: int = 5) -> List[dict]:
+    """Retorna os envios mais recentes, do mais novo para o mais antigo."""
+    if not supabase_async: return []
     try:
-        response = await asyncio.to_thread(lambda: supabase.table('groups').select('telegram_chat_id, name, created_at').order('name').execute())
+        response = await _execute(
+            supabase_async.table('broadcast_jobs').select('*').order('id', desc=True).limit(limit)
+        )
         return response.data or []
     except Exception as e:
-        logger.error(f"❌ [DB] Erro ao buscar todos os grupos: {e}", exc_info=True)
+        logger.error(f"❌ [DB] Erro ao buscar broadcasts recentes: {e}", exc_info=True)
         return []
 
+# --- FUNÇÕES DE GRUPOS ---
+
+async def _load_group_registry() -> List[dict]:
+    """Carrega todos os grupos cadastrados, na ordem em que foram adicionados."""
+    response = await _execute(
+        supabase_async.table('groups').select('*').order('id')
+    )
+    return response.data or []
+
+# Registro único de grupos (IDs, títulos e metadados do chat) compartilhado por todos os fluxos:
+# envio de links, expulsões do scheduler e telas de admin. É invalidado por
+# `add_group` / `remove_group` / `update_group_metadata` e recarregado pelo TTL.
+group_registry = SnapshotCache('groups', _load_group_registry, GROUP_CACHE_TTL)
+
+async def get_all_group_ids() -> list[int]:
+    """Busca os IDs de todos os grupos cadastrados."""
+    if not supabase_async: return []
+    groups = await group_registry.get() or []
+    return [group['telegram_chat_id'] for group in groups]
+
+async def get_all_groups_with_names() -> list[dict]:
+    """Busca os IDs e nomes de todos os grupos cadastrados, ordenados por nome."""
+    if not supabase_async: return []
+    groups = await group_registry.get() or []
+    return sorted(
+        ({'telegram_chat_id': g['telegram_chat_id'], 'name': g.get('name'), 'created_at': g.get('created_at')} for g in groups),
+        key=lambda g: g['name'] or ''
+    )
+
 async def add_group(chat_id: int, name: str) -> bool:
     """Adiciona um novo grupo ao banco de dados."""
-    if not supabase: return False
+    if not supabase_async: return False
     try:
-        await asyncio.to_thread(
-            lambda: supabase.table('groups')
+        await _execute(
+            supabase_async.table('groups')
             .upsert({"telegram_chat_id": chat_id, "name": name}, on_conflict='telegram_chat_id')
-            .execute()
         )
+        group_registry.invalidate()
         logger.info(f"✅ [DB] Grupo {name} ({chat_id}) adicionado/atualizado com sucesso.")
         return True
     except Exception as e:
@@ -522,14 +1197,15 @@ async def add_group(chat_id: int, name: str) -> bool:
 
 async def remove_group(chat_id: int) -> bool:
     """Remove um grupo do banco de dados pelo seu telegram_chat_id."""
-    if not supabase: return False
+    if not supabase_async: return False
     try:
-        await asyncio.to_thread(
-            lambda: supabase.table('groups')
+        await _execute(
+            supabase_async.table('groups')
             .delete()
             .eq('telegram_chat_id', chat_id)
-            .execute()
         )
+        group_registry.invalidate()
+        _group_roster.pop(chat_id, None)
         logger.info(f"✅ [DB] Grupo com chat_id {chat_id} removido com sucesso.")
         return True
     except Exception as e:
@@ -538,32 +1214,175 @@ async def remove_group(chat_id: int) -> bool:
 
 async def get_group_by_chat_id(chat_id: int) -> dict | None:
     """Busca os detalhes de um grupo pelo seu telegram_chat_id."""
-    if not supabase: return None
+    if not supabase_async: return None
+    groups = await group_registry.get() or []
+    group = next((g for g in groups if g['telegram_chat_id'] == chat_id), None)
+    return dict(group) if group else None
+
+async def get_group_titles() -> Dict[int, str]:
+    """
+    Mapa telegram_chat_id -> título, lido do registro de grupos em memória.
+    Substitui as chamadas a bot.get_chat só para descobrir o nome de um grupo.
+    """
+    if not supabase_async: return {}
+    groups = await group_registry.get() or []
+    return {g['telegram_chat_id']: g['name'] for g in groups if g.get('name')}
+
+# Colunas de sql/group_metadata.sql. Desligadas na primeira vez que o banco informar que não existem,
+# para que as atualizações seguintes gravem só o título sem tentar (e falhar) de novo.
+_group_metadata_available = True
+
+async def update_group_metadata(chat_id: int, title: str | None, chat_type: str | None = None, username: str | None = None) -> bool:
+    """
+    Atualiza o título e os metadados de um grupo cadastrado, apenas se algo mudou.
+    Chamado pela atualização periódica e pelos eventos do Telegram (my_chat_member, novo título).
+    Retorna True se gravou alguma alteração. Sem a migração sql/group_metadata.sql, grava só o título.
+    """
+    global _group_metadata_available
+    if not supabase_async: return False
+    group = await get_group_by_chat_id(chat_id)
+    if not group:
+        return False
+    changes = {}
+    if title and title != group.get('name'):
+        changes['name'] = title
+    if _group_metadata_available:
+        if chat_type and chat_type != group.get('chat_type'):
+            changes['chat_type'] = chat_type
+        if username != group.get('chat_username'):
+            changes['chat_username'] = username
+        if changes:
+            changes['metadata_updated_at'] = datetime.now(TIMEZONE_BR).isoformat()
+    if not changes:
+        return False
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('groups').select('*').eq('telegram_chat_id', chat_id).single().execute()
-        )
-        return response.data
-    except Exception:
-        return None
+        try:
+            await _execute(
+                supabase_async.table('groups').update(changes, returning=ReturnMethod.minimal).eq('telegram_chat_id', chat_id)
+            )
+        except APIError as e:
+            if e.code not in COLUMN_NOT_FOUND or not _group_metadata_available:
+                raise
+            _group_metadata_available = False
+            logger.warning("⚠️ [DB] Colunas de metadados dos grupos ausentes (aplique sql/group_metadata.sql). Só o título será gravado.")
+            if 'name' not in changes:
+                return False
+            changes = {'name': changes['name']}
+            await _execute(
+                supabase_async.table('groups').update(changes, returning=ReturnMethod.minimal).eq('telegram_chat_id', chat_id)
+            )
+        group_registry.invalidate()
+        logger.info(f"✅ [DB] Metadados do grupo {chat_id} atualizados: {', '.join(k for k in changes if k != 'metadata_updated_at')}.")
+        return True
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao atualizar metadados do grupo {chat_id}: {e}", exc_info=True)
+        return False
+
+
+# --- ROSTER DE MEMBROS DOS GRUPOS ---
+# Último status conhecido de cada usuário em cada grupo (tabela de sql/group_members.sql), com um
+# índice em memória chat_id -> {user_id: status} carregado na inicialização. É alimentado pelos
+# eventos chat_member e pelas consultas get_chat_member feitas quando o roster não conhecia o par.
+# O índice é atualizado na hora; o banco, em segundo plano, por upserts em lote (roster_buffer).
+# Sem a tabela, o índice vive só em memória e os pares desconhecidos continuam indo à API.
+
+MEMBER_STATUSES = ('member', 'administrator', 'creator')  # Status que contam como "está no grupo"
+
+_group_roster: Dict[int, Dict[int, str]] = {}
+_roster_stats = {'hits': 0, 'misses': 0}
+
+roster_buffer = WriteBehindBuffer(
+    'group_members', ROSTER_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_MAX_PENDING, on_conflict='chat_id,user_id'
+)
+
+async def load_group_roster() -> int:
+    """Carrega o roster do banco para o índice em memória. Retorna quantas linhas foram lidas."""
+    if not supabase_async: return 0
+    roster: Dict[int, Dict[int, str]] = {}
+    loaded = 0
+    try:
+        async for rows in _iter_pages(
+            lambda: supabase_async.table('group_members').select('id, chat_id, user_id, status'), DB_PAGE_SIZE
+        ):
+            for row in rows:
+                roster.setdefault(row['chat_id'], {})[row['user_id']] = row['status']
+            loaded += len(rows)
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao carregar o roster de membros dos grupos: {e}", exc_info=True)
+        return 0
+    # Eventos recebidos durante a carga são mais novos que o que veio do banco
+    for chat_id, members in _group_roster.items():
+        roster.setdefault(chat_id, {}).update(members)
+    _group_roster.clear()
+    _group_roster.update(roster)
+    return loaded
+
+def get_group_member_status(chat_id: int, user_id: int) -> str | None:
+    """Último status conhecido do usuário no grupo, lido do índice em memória (None = desconhecido)."""
+    status = _group_roster.get(chat_id, {}).get(user_id)
+    _roster_stats['hits' if status is not None else 'misses'] += 1
+    return status
+
+def record_group_member(chat_id: int, user_id: int, status: str) -> None:
+    """
+    Atualiza o status do usuário no grupo no índice em memória e enfileira o upsert no banco
+    (chat_id + user_id). Não espera pelo banco: deve ser chamado de dentro do event loop.
+    """
+    _group_roster.setdefault(chat_id, {})[user_id] = status
+    if not supabase_async: return
+    roster_buffer.add({
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'status': status,
+        'updated_at': datetime.now(TIMEZONE_BR).isoformat(),
+    })
+
+async def flush_group_members() -> None:
+    """Grava agora, em lote, as mudanças de roster pendentes (ex.: ao fim de uma rodada de remoções)."""
+    if not supabase_async: return
+    await roster_buffer.flush()
+
+def get_present_group_members(chat_id: int, statuses: tuple = ('member', 'restricted')) -> List[int]:
+    """IDs dos usuários que o roster registra como presentes no grupo com um dos `statuses` (por padrão, sem admins)."""
+    return [user_id for user_id, status in _group_roster.get(chat_id, {}).items() if status in statuses]
+
+def get_roster_stats() -> Dict[str, int]:
+    """Tamanho do roster em memória e quantas consultas ele respondeu (hits) ou não conhecia (misses)."""
+    return {
+        'groups': len(_group_roster),
+        'entries': sum(len(members) for members in _group_roster.values()),
+        **_roster_stats,
+    }
+
 
 # --- FUNÇÕES DE CUPONS ---
 
+# Buscas idênticas de cupom em andamento (ex.: um código divulgado em promoção) compartilham uma única query.
+coupon_flight = SingleFlight('coupons')
+
+async def _fetch_coupon(code: str, include_inactive: bool) -> dict | None:
+    query = supabase_async.table('coupons').select('*').eq('code', code)
+
+    # Adiciona o filtro de 'is_active' apenas se não for para incluir os inativos
+    if not include_inactive:
+        query = query.eq('is_active', True)
+
+    response = await _execute(query.single())
+    return response.data
+
 async def get_coupon_by_code(code: str, include_inactive: bool = False) -> dict | None:
     """
     Busca um cupom pelo código.
     Por padrão, busca apenas cupons ativos. Se 'include_inactive' for True, busca também os inativos.
+    Chamadas simultâneas para o mesmo código são coalescidas em uma única consulta.
     """
-    if not supabase: return None
+    if not supabase_async: return None
     try:
-        query = supabase.table('coupons').select('*').eq('code', code.upper())
-
-        # Adiciona o filtro de 'is_active' apenas se não for para incluir os inativos
-        if not include_inactive:
-            query = query.eq('is_active', True)
-
-        response = await asyncio.to_thread(lambda: query.single().execute())
-        return response.data
+        code = code.upper()
+        coupon = await coupon_flight.do(
+            (code, include_inactive), lambda: _fetch_coupon(code, include_inactive)
+        )
+        return dict(coupon) if coupon else None
     except Exception:
         # Retorna None se o cupom não for encontrado (o que é um comportamento esperado)
         return None
@@ -574,7 +1393,7 @@ async def create_coupon(
     usage_limit: Optional[int] = None
 ) -> dict | None:
     """Cria um novo cupom de desconto com todos os campos."""
-    if not supabase: return None
+    if not supabase_async: return None
     try:
         insert_data = {
             "code": code.upper(), "discount_type": discount_type, "discount_value": discount_value,
@@ -585,8 +1404,8 @@ async def create_coupon(
 
         # --- CORREÇÃO APLICADA AQUI ---
         # O retorno dos dados é solicitado dentro do .execute()
-        response = await asyncio.to_thread(
-            lambda: supabase.table('coupons').insert(insert_data).execute()
+        response = await _execute(
+            supabase_async.table('coupons').insert(insert_data)
         )
         # --- FIM DA CORREÇÃO ---
 
@@ -598,9 +1417,9 @@ async def create_coupon(
 
 async def deactivate_coupon(code: str) -> bool:
     """Desativa um cupom."""
-    if not supabase: return False
+    if not supabase_async: return False
     try:
-        await asyncio.to_thread(lambda: supabase.table('coupons').update({"is_active": False}).eq('code', code.upper()).execute())
+        await _execute(supabase_async.table('coupons').update({"is_active": False}).eq('code', code.upper()))
         await create_log('coupon_deactivated', f"Cupom desativado: {code}")
         return True
     except Exception as e:
@@ -609,9 +1428,9 @@ async def deactivate_coupon(code: str) -> bool:
 
 async def reactivate_coupon(code: str) -> bool:
     """Reativa um cupom."""
-    if not supabase: return False
+    if not supabase_async: return False
     try:
-        await asyncio.to_thread(lambda: supabase.table('coupons').update({"is_active": True}).eq('code', code.upper()).execute())
+        await _execute(supabase_async.table('coupons').update({"is_active": True}).eq('code', code.upper()))
         await create_log('coupon_reactivated', f"Cupom reativado: {code}")
         return True
     except Exception as e:
@@ -620,12 +1439,12 @@ async def reactivate_coupon(code: str) -> bool:
 
 async def get_all_coupons(include_inactive: bool = False) -> List[dict]:
     """Busca todos os cupons, opcionalmente incluindo os inativos."""
-    if not supabase: return []
+    if not supabase_async: return []
     try:
-        query = supabase.table('coupons').select('*').order('created_at', desc=True)
+        query = supabase_async.table('coupons').select('*').order('created_at', desc=True)
         if not include_inactive:
             query = query.eq('is_active', True)
-        response = await asyncio.to_thread(lambda: query.execute())
+        response = await _execute(query)
         return response.data or []
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao buscar todos os cupons: {e}", exc_info=True)
@@ -635,30 +1454,29 @@ async def get_all_coupons(include_inactive: bool = False) -> List[dict]:
 
 async def ensure_referral_code_exists(telegram_user_id: int, code: str) -> None:
     """Garante que o código de indicação de um usuário esteja salvo na tabela `users`."""
-    if not supabase: return
+    if not supabase_async: return
     try:
-        await asyncio.to_thread(
-            lambda: supabase.table('users')
+        await _execute(
+            supabase_async.table('users')
             .update({'referral_code': code})
             .eq('telegram_user_id', telegram_user_id)
             .is_('referral_code', 'NULL')
-            .execute()
         )
     except Exception as e:
         logger.error(f"❌ [DB] Erro em ensure_referral_code_exists para user {telegram_user_id}: {e}", exc_info=True)
 
 async def find_user_by_referral_code(code: str) -> dict | None:
     """Encontra o usuário dono de um código de referência."""
-    if not supabase: return None
+    if not supabase_async: return None
     try:
-        response = await asyncio.to_thread(lambda: supabase.table('users').select('id, telegram_user_id').eq('referral_code', code.upper()).single().execute())
+        response = await _execute(supabase_async.table('users').select('id, telegram_user_id').eq('referral_code', code.upper()).single())
         return response.data
     except Exception:
         return None
 
 async def create_referral_record(referrer_id: int, referred_id: int, code: str) -> dict | None:
     """Cria um registro na tabela de indicações."""
-    if not supabase: return None
+    if not supabase_async: return None
     try:
         insert_data = {
             "referrer_id": referrer_id,
@@ -667,8 +1485,8 @@ async def create_referral_record(referrer_id: int, referred_id: int, code: str)
         }
 
         # --- CORREÇÃO APLICADA AQUI ---
-        response = await asyncio.to_thread(
-            lambda: supabase.table('referrals').insert(insert_data).execute()
+        response = await _execute(
+            supabase_async.table('referrals').insert(insert_data)
         )
         # --- FIM DA CORREÇÃO ---
 
@@ -679,10 +1497,11 @@ async def create_referral_record(referrer_id: int, referred_id: int, code: str)
 
 async def grant_referral_reward(referral_id: int, referrer_id: int) -> bool:
     """Concede a recompensa de 7 dias e marca a indicação como concluída."""
-    if not supabase: return False
+    if not supabase_async: return False
     try:
-        await asyncio.to_thread(lambda: supabase.rpc('extend_subscription_days', {'p_user_id': referrer_id, 'p_days': 7}).execute())
-        await asyncio.to_thread(lambda: supabase.table('referrals').update({"reward_granted": True}).eq("id", referral_id).execute())
+        await _execute(supabase_async.rpc('extend_subscription_days', {'p_user_id': referrer_id, 'p_days': 7}))
+        await _invalidate_active_subscription_for_db_user(referrer_id)
+        await _execute(supabase_async.table('referrals').update({"reward_granted": True}).eq("id", referral_id))
         logger.info(f"✅ [DB] Recompensa de indicação (ID: {referral_id}) concedida ao usuário {referrer_id}.")
         return True
     except Exception as e:
@@ -692,12 +1511,15 @@ async def grant_referral_reward(referral_id: int, referrer_id: int) -> bool:
 # --- FUNÇÕES DE LOGS E ESTATÍSTICAS ---
 
 async def create_log(log_type: str, message: str, user_id: Optional[int] = None) -> None:
-    """Cria um registro de log no banco de dados."""
-    if not supabase: return
-    try:
-        await asyncio.to_thread(lambda: supabase.table('logs').insert({"type": log_type, "message": message, "user_id": user_id}).execute())
-    except Exception as e:
-        logger.error(f"❌ [DB] Erro ao criar log: {e}", exc_info=True)
+    """
+    Registra um log no banco de dados de forma write-behind.
+    O log entra no buffer e é gravado em lote em segundo plano; quem chama não espera o banco.
+    """
+    if not supabase_async: return
+    log_buffer.add({
+        "type": log_type, "message": message, "user_id": user_id,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    })
 
 async def get_recent_logs(
     limit: int = 20,
@@ -709,9 +1531,9 @@ async def get_recent_logs(
     - log_type: Filtra por um tipo de log específico (ex: 'error').
     - days_ago: Filtra logs dos últimos X dias.
     """
-    if not supabase: return []
+    if not supabase_async: return []
     try:
-        query = supabase.table('logs').select('*').order('created_at', desc=True).limit(limit)
+        query = supabase_async.table('logs').select('*').order('created_at', desc=True).limit(limit)
 
         if log_type:
             query = query.eq('type', log_type)
@@ -723,81 +1545,86 @@ async def get_recent_logs(
             start_date = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
             query = query.gte('created_at', start_date.isoformat())
 
-        response = await asyncio.to_thread(lambda: query.execute())
+        response = await _execute(query)
         return response.data or []
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao buscar logs com filtros: {e}", exc_info=True)
         return []
 
-async def get_system_stats() -> Dict[str, Any]:
-    """Retorna estatísticas completas do sistema usando funções SQL para eficiência."""
-    if not supabase: return {}
-    try:
-        # Define um dicionário base com todos os valores zerados
-        stats = {
-            'total_users': 0, 'total_groups': 0, 'active_coupons': 0,
-            'active_subscriptions': 0, 'pending_subscriptions': 0, 'expired_subscriptions': 0,
-            'total_revenue': 0.0, 'monthly_revenue': 0.0, 'daily_revenue': 0.0,
-            'conversion_rate': 0.0, 'total_trials_used': 0
-        }
+def _empty_system_stats() -> Dict[str, Any]:
+    """Dicionário de estatísticas com todos os valores zerados."""
+    return {
+        'total_users': 0, 'total_groups': 0, 'active_coupons': 0,
+        'active_subscriptions': 0, 'pending_subscriptions': 0, 'expired_subscriptions': 0,
+        'total_revenue': 0.0, 'monthly_revenue': 0.0, 'daily_revenue': 0.0,
+        'conversion_rate': 0.0, 'total_trials_used': 0
+    }
 
-        # Contagens de usuários, grupos, cupons
-        users_resp = await asyncio.to_thread(lambda: supabase.table('users').select('id', count='exact').execute())
-        stats['total_users'] = users_resp.count or 0
+async def _compute_system_stats() -> Dict[str, Any]:
+    """
+    Calcula as estatísticas do sistema. As seis consultas são independentes e rodam em paralelo.
+    As contagens usam `limit(1)`: o PostgREST devolve o total no cabeçalho sem trafegar as linhas.
+    """
+    stats = _empty_system_stats()
+
+    (users_resp, trials_resp, groups_resp, coupons_resp, subs_counts, revenue_stats) = await asyncio.gather(
+        # Contagens de usuários, degustações, grupos, cupons
+        _execute(supabase_async.table('users').select('id', count='exact').limit(1)),
+        _execute(supabase_async.table('users').select('id', count='exact').eq('has_used_trial', True).limit(1)),
+        _execute(supabase_async.table('groups').select('id', count='exact').limit(1)),
+        _execute(supabase_async.table('coupons').select('id', count='exact').eq('is_active', True).limit(1)),
+        # Contagens de assinaturas por status e receita via RPC
+        _execute(supabase_async.rpc('count_subscriptions_by_status', {})),
+        _execute(supabase_async.rpc('get_revenue_stats', {})),
+    )
+    stats['total_users'] = users_resp.count or 0
+    stats['total_trials_used'] = trials_resp.count or 0
+    stats['total_groups'] = groups_resp.count or 0
+    stats['active_coupons'] = coupons_resp.count or 0
+
+    if subs_counts.data:
+        for item in subs_counts.data:
+            status_key = f"{item.get('status', '').lower()}_subscriptions"
+            # Garante que a chave exista no dicionário de stats
+            if status_key in stats:
+                stats[status_key] = item.get('count', 0)
+
+    if revenue_stats.data and revenue_stats.data[0]:
+        revenue_data = revenue_stats.data[0]
+        # Atualiza apenas se o valor não for None, caso contrário mantém o 0.0 do padrão
+        stats['total_revenue'] = revenue_data.get('total_revenue') or 0.0
+        stats['monthly_revenue'] = revenue_data.get('monthly_revenue') or 0.0
+        stats['daily_revenue'] = revenue_data.get('daily_revenue') or 0.0
+
+    # Cálculo da taxa de conversão
+    total_paying_users = stats['active_subscriptions'] + stats['expired_subscriptions']
+    if stats['total_users'] > 0:
+        stats['conversion_rate'] = (total_paying_users / stats['total_users'] * 100)
+
+    return stats
+
+# Snapshot das estatísticas do dashboard. Aberturas repetidas são servidas da memória;
+# quando o snapshot expira, ele é servido mesmo assim e recalculado em segundo plano.
+system_stats_snapshot = SnapshotCache('system_stats', _compute_system_stats, STATS_CACHE_TTL)
 
-        # --- NOVA CONSULTA PARA DEGUSTAÇÕES ---
-        trials_resp = await asyncio.to_thread(
-            lambda: supabase.table('users').select('id', count='exact').eq('has_used_trial', True).execute()
-        )
-        stats['total_trials_used'] = trials_resp.count or 0
-        # --- FIM DA NOVA CONSULTA ---
-
-        groups_resp = await asyncio.to_thread(lambda: supabase.table('groups').select('id', count='exact').execute())
-        stats['total_groups'] = groups_resp.count or 0
-
-        coupons_resp = await asyncio.to_thread(lambda: supabase.table('coupons').select('id', count='exact').eq('is_active', True).execute())
-        stats['active_coupons'] = coupons_resp.count or 0
-
-        # Contagens de assinaturas por status via RPC
-        subs_counts = await asyncio.to_thread(lambda: supabase.rpc('count_subscriptions_by_status').execute())
-        if subs_counts.data:
-            for item in subs_counts.data:
-                status_key = f"{item.get('status', '').lower()}_subscriptions"
-                # Garante que a chave exista no dicionário de stats
-                if status_key in stats:
-                    stats[status_key] = item.get('count', 0)
-
-        # Contagens de receita via RPC
-        revenue_stats = await asyncio.to_thread(lambda: supabase.rpc('get_revenue_stats').execute())
-        if revenue_stats.data and revenue_stats.data[0]:
-            revenue_data = revenue_stats.data[0]
-            # Atualiza apenas se o valor não for None, caso contrário mantém o 0.0 do padrão
-            stats['total_revenue'] = revenue_data.get('total_revenue') or 0.0
-            stats['monthly_revenue'] = revenue_data.get('monthly_revenue') or 0.0
-            stats['daily_revenue'] = revenue_data.get('daily_revenue') or 0.0
-
-        # Cálculo da taxa de conversão
-        total_paying_users = stats['active_subscriptions'] + stats['expired_subscriptions']
-        if stats['total_users'] > 0:
-            stats['conversion_rate'] = (total_paying_users / stats['total_users'] * 100)
-
-        return stats
-
-    except Exception as e:
-        logger.error(f"❌ [DB] Erro ao buscar estatísticas do sistema: {e}", exc_info=True)
-        # Em caso de erro, retorna o dicionário zerado para não quebrar a interface
-        return {
-            'total_users': 0, 'total_groups': 0, 'active_coupons': 0,
-            'active_subscriptions': 0, 'pending_subscriptions': 0, 'expired_subscriptions': 0,
-            'total_revenue': 0.0, 'monthly_revenue': 0.0, 'daily_revenue': 0.0,
-            'conversion_rate': 0.0
-        }
+async def get_system_stats() -> Dict[str, Any]:
+    """
+    Retorna as estatísticas do sistema a partir do snapshot em memória.
+    O campo 'updated_at' (datetime UTC) indica quando o snapshot foi calculado.
+    """
+    if not supabase_async: return {}
+    stats = await system_stats_snapshot.get_stale()
+    if stats is None:
+        # Nunca houve um cálculo bem-sucedido (o erro já foi registrado pelo cache).
+        # Retorna o dicionário zerado para não quebrar a interface.
+        return {**_empty_system_stats(), 'updated_at': None}
+    return {**stats, 'updated_at': system_stats_snapshot.updated_at}
 
 async def get_referral_stats() -> dict:
     """Busca estatísticas do sistema de indicação para o painel de admin."""
-    if not supabase: return {}
+    if not supabase_async: return {}
     try:
-        response = await asyncio.to_thread(lambda: supabase.rpc('get_referral_dashboard_stats').execute())
+        response = await _execute(supabase_async.rpc('get_referral_dashboard_stats', {}))
         return response.data[0] if response.data else {}
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao buscar estatísticas de indicação: {e}", exc_info=True)
@@ -805,9 +1632,9 @@ async def get_referral_stats() -> dict:
 
 async def search_transactions(search_term: str) -> List[dict]:
     """Busca transações por diversos critérios."""
-    if not supabase: return []
+    if not supabase_async: return []
     try:
-        query = supabase.table('subscriptions')
+        query = supabase_async.table('subscriptions')
         if search_term == 'hoje':
             today = datetime.now(TIMEZONE_BR).date().isoformat()
             query = query.select('*, user:users(*), product:products(*)').gte('created_at', today)
@@ -821,7 +1648,7 @@ async def search_transactions(search_term: str) -> List[dict]:
             query = query.select('*, user:users!inner(*), product:products(*)').eq('users.username', username)
         else:
             query = query.select('*, user:users(*), product:products(*)').ilike('mp_payment_id', f'%{search_term}%')
-        response = await asyncio.to_thread(lambda: query.order('created_at', desc=True).execute())
+        response = await _execute(query.order('created_at', desc=True))
         return response.data or []
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao buscar transações com termo '{search_term}': {e}", exc_info=True)
@@ -833,31 +1660,58 @@ async def check_and_set_trial_used(db_user_id: int) -> bool:
     """
     Verifica se o usuário já usou o trial. Se não, marca como usado e retorna True.
     Se já usou, retorna False.
+    A verificação e a marcação são um único UPDATE condicional: entre chamadas concorrentes,
+    apenas uma altera a linha e recebe True.
     """
-    if not supabase: return False
+    if not supabase_async: return False
     try:
-        # Primeiro, verifica o status atual
-        user_response = await asyncio.to_thread(
-            lambda: supabase.table('users').select('has_used_trial').eq('id', db_user_id).single().execute()
+        response = await _execute(
+            supabase_async.table('users')
+            .update({'has_used_trial': True})
+            .eq('id', db_user_id)
+            .not_.is_('has_used_trial', 'true')
         )
-        if not user_response.data or user_response.data.get('has_used_trial'):
-            return False # Usuário não encontrado ou trial já usado
-
-        # Se chegou aqui, o trial não foi usado. Marca como usado.
-        await asyncio.to_thread(
-            lambda: supabase.table('users').update({'has_used_trial': True}).eq('id', db_user_id).execute()
-        )
-        return True # Sucesso, pode prosseguir com o trial
+        return bool(response.data) # Nenhuma linha alterada: usuário não encontrado ou trial já usado
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao verificar e marcar trial para user_id {db_user_id}: {e}", exc_info=True)
         return False
 
+async def claim_trial(db_user_id: int) -> tuple[bool, dict | None]:
+    """
+    Resgata a degustação em uma única chamada: marca o trial como usado e cria a assinatura
+    na mesma transação, via função `claim_trial` (sql/claim_trial.sql).
+    Retorna (venceu, assinatura): `venceu` é False se o usuário já tinha usado a degustação
+    (ou se outra chamada concorrente ganhou); a assinatura é None se a criação falhou.
+    """
+    if not supabase_async: return False, None
+    try:
+        response = await _execute_rpc('claim_trial', {
+            'p_user_id': db_user_id, 'p_product_id': TRIAL_PRODUCT_ID,
+            'p_duration_minutes': TRIAL_DURATION_MINUTES
+        })
+        if response is None:
+            # Função ainda não criada no banco: resgate atômico + criação em duas chamadas.
+            if not await check_and_set_trial_used(db_user_id):
+                return False, None
+            return True, await create_trial_subscription(db_user_id)
+
+        if not response.data:
+            return False, None
+
+        created_subscription = response.data[0]
+        await _invalidate_active_subscription_for_db_user(db_user_id)
+        await create_log('trial_started', f"Trial de {TRIAL_DURATION_MINUTES} min iniciado para o usuário {db_user_id}.")
+        return True, created_subscription
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao resgatar a degustação para user_id {db_user_id}: {e}", exc_info=True)
+        return False, None
+
 async def create_trial_subscription(db_user_id: int) -> dict | None:
     """Cria uma assinatura de degustação de 30 minutos."""
-    if not supabase: return None
+    if not supabase_async: return None
     try:
         start_date = datetime.now(TIMEZONE_BR)
-        end_date = start_date + timedelta(minutes=30)
+        end_date = start_date + timedelta(minutes=TRIAL_DURATION_MINUTES)
         trial_notes = f"trial_access_{db_user_id}_{start_date.timestamp()}"
 
         insert_data = {
@@ -872,8 +1726,8 @@ async def create_trial_subscription(db_user_id: int) -> dict | None:
 
         # --- CORREÇÃO APLICADA ---
         # 1. Apenas executa a inserção. A biblioteca já retorna os dados por padrão.
-        insert_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions').insert(insert_data).execute()
+        insert_response = await _execute(
+            supabase_async.table('subscriptions').insert(insert_data)
         )
 
         # 2. Verifica se a inserção foi bem-sucedida e se retornou dados
@@ -885,23 +1739,56 @@ async def create_trial_subscription(db_user_id: int) -> dict | None:
         created_subscription = insert_response.data[0]
         # --- FIM DA CORREÇÃO ---
 
-        await create_log('trial_started', f"Trial de 30 min iniciado para o usuário {db_user_id}.")
+        await _invalidate_active_subscription_for_db_user(db_user_id)
+        await create_log('trial_started', f"Trial de {TRIAL_DURATION_MINUTES} min iniciado para o usuário {db_user_id}.")
         return created_subscription
 
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao criar assinatura de trial: {e}", exc_info=True)
         return None
 
+async def iter_user_id_pages(page_size: int = DB_PAGE_SIZE, after_id: int = 0) -> AsyncIterator[List[int]]:
+    """Gera, página a página, todos os Telegram User IDs cadastrados na tabela 'users'."""
+    if not supabase_async: return
+    try:
+        async for rows in _iter_pages(
+            lambda: supabase_async.table('users').select('id, telegram_user_id'),
+            page_size, after_id
+        ):
+            yield [row['telegram_user_id'] for row in rows]
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao paginar IDs de usuário: {e}", exc_info=True)
+        raise
+
+async def iter_inactive_user_id_pages(page_size: int = DB_PAGE_SIZE, after_id: int = 0) -> AsyncIterator[List[int]]:
+    """
+    Gera, página a página, os Telegram User IDs dos usuários SEM assinatura ativa.
+    As assinaturas ativas vêm embutidas (join externo filtrado) em cada página de usuários,
+    então a auditoria não precisa carregar a lista de assinantes inteira na memória.
+    """
+    if not supabase_async: return
+    try:
+        async for rows in _iter_pages(
+            lambda: supabase_async.table('users')
+            .select('id, telegram_user_id, subscriptions(id)')
+            .eq('subscriptions.status', 'active'),
+            page_size, after_id
+        ):
+            yield [row['telegram_user_id'] for row in rows if not row.get('subscriptions')]
+    except Exception as e:
+        logger.error(f"❌ [DB] Erro ao paginar usuários sem assinatura ativa: {e}", exc_info=True)
+        raise
+
 async def get_all_user_ids_from_db() -> list[int]:
     """Retorna uma lista de todos os Telegram User IDs cadastrados na tabela 'users'."""
-    if not supabase: return []
     try:
-        response = await asyncio.to_thread(
-            lambda: supabase.table('users').select('telegram_user_id').execute()
-        )
-        if not response.data: return []
-        return [item['telegram_user_id'] for item in response.data]
+        return [uid async for page in iter_user_id_pages() for uid in page]
     except Exception as e:
         logger.error(f"❌ [DB] Erro ao buscar todos os IDs de usuário: {e}", exc_info=True)
         return []
 
+
+# --- INSTRUMENTAÇÃO ---
+# Envolve todas as funções assíncronas públicas deste módulo com métricas de latência, erros e linhas.
+# Precisa ficar no fim do arquivo, depois de todas as definições.
+metrics.instrument_module(sys.modules[__name__], 'db')
@@ -0,0 +1,820 @@
+# --- fake_supabase.py (BACKEND SUPABASE EM MEMÓRIA PARA BENCHMARKS E TESTES DE CARGA) ---
+#
+# Implementa, em processo, o subconjunto do query builder do PostgREST que o db_supabase usa:
+#   table().select/insert/update/upsert/delete
+#          .eq/neq/lt/lte/gt/gte/like/ilike/is_/in_/not_
+#          .order/limit/range/single/maybe_single/execute
+# com joins embutidos (`user:users(...)`, `users!inner(...)`, `subscriptions(...)`),
+# `count='exact'` e as funções SQL (RPCs) chamadas pelo bot.
+#
+# Uso:
+#     import db_supabase as db
+#     import fake_supabase
+#     fake_db = fake_supabase.install(db, latency=0.02)
+#     fake_supabase.seed(fake_db, users=100_000)
+#
+# Nada aqui é usado em produção.
+
+import re
+import time
+import random
+import asyncio
+import logging
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from postgrest.exceptions import APIError
+
+logger = logging.getLogger(__name__)
+
+TIMEZONE_BR = timezone(timedelta(hours=-3))
+
+# Colunas com índice (busca por igualdade sem varrer a tabela)
+INDEXED_COLUMNS = {
+    'users': ('telegram_user_id', 'referral_code', 'username'),
+    'subscriptions': ('user_id', 'mp_payment_id', 'status'),
+    'products': (),
+    'groups': ('telegram_chat_id',),
+    'coupons': ('code',),
+    'coupon_usage': ('coupon_id', 'user_id'),
+    'referrals': ('referrer_id', 'referred_id'),
+    'settings': ('key',),
+    'logs': (),
+}
+
+# Restrições de unicidade (violação gera o mesmo erro 23505 do Postgres)
+UNIQUE_COLUMNS = {
+    'users': ('telegram_user_id',),
+    'subscriptions': ('mp_payment_id',),
+    'groups': ('telegram_chat_id',),
+    'coupons': ('code',),
+    'settings': ('key',),
+}
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _singular(table: str) -> str:
+    return table[:-1] if table.endswith('s') else table
+
+
+# --- ARMAZENAMENTO ---
+
+class FakeTable:
+    """Linhas de uma tabela, ordenadas por `id`, com índices de igualdade por coluna."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows: List[dict] = []
+        self.ids: List[int] = []
+        self.next_id = 1
+        self.indexes: Dict[str, Dict[Any, Dict[int, dict]]] = {
+            col: defaultdict(dict) for col in ('id',) + INDEXED_COLUMNS.get(name, ())
+        }
+
+    def _index_add(self, row: dict) -> None:
+        for col, index in self.indexes.items():
+            index[row.get(col)][row['id']] = row
+
+    def _index_remove(self, row: dict) -> None:
+        for col, index in self.indexes.items():
+            bucket = index.get(row.get(col))
+            if bucket is not None:
+                bucket.pop(row['id'], None)
+                if not bucket:
+                    del index[row.get(col)]
+
+    def add(self, row: dict) -> dict:
+        if row.get('id') is None:
+            row['id'] = self.next_id
+        self.next_id = max(self.next_id, row['id'] + 1)
+        for col in UNIQUE_COLUMNS.get(self.name, ()):
+            if row.get(col) is not None and self.find(col, row[col]):
+                raise APIError({
+                    'code': '23505', 'message': f'duplicate key value violates unique constraint "{self.name}_{col}_key"',
+                    'details': f'Key ({col})=({row[col]}) already exists.', 'hint': None,
+                })
+        position = bisect_left(self.ids, row['id'])
+        self.ids.insert(position, row['id'])
+        self.rows.insert(position, row)
+        self._index_add(row)
+        return row
+
+    def change(self, row: dict, values: dict) -> None:
+        self._index_remove(row)
+        row.update(values)
+        self._index_add(row)
+
+    def remove(self, row: dict) -> None:
+        self._index_remove(row)
+        position = bisect_left(self.ids, row['id'])
+        del self.ids[position]
+        del self.rows[position]
+
+    def find(self, column: str, value: Any) -> List[dict]:
+        """Busca por igualdade, usando o índice quando existir."""
+        index = self.indexes.get(column)
+        if index is not None:
+            return sorted(index.get(value, {}).values(), key=lambda r: r['id'])
+        return [r for r in self.rows if r.get(column) == value]
+
+    def id_range(self, low: Optional[tuple], high: Optional[tuple]) -> List[dict]:
+        """Fatia das linhas por intervalo de id (usada pela paginação por chave)."""
+        start, end = 0, len(self.rows)
+        if low is not None:
+            value, inclusive = low
+            start = bisect_left(self.ids, value) if inclusive else bisect_right(self.ids, value)
+        if high is not None:
+            value, inclusive = high
+            end = bisect_right(self.ids, value) if inclusive else bisect_left(self.ids, value)
+        return self.rows[start:end]
+
+
+class FakeDatabase:
+    """
+    Banco em memória compartilhado pelos clientes falsos (assíncrono e síncrono).
+    - `latency`/`jitter`: atraso simulado, em segundos, aplicado a cada chamada (ida e volta de rede).
+    - `calls`: contador de chamadas por (tabela ou rpc, operação), para medir round trips.
+    - `disabled_rpcs`: nomes de RPCs que devem responder como inexistentes (testa os caminhos alternativos).
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.tables: Dict[str, FakeTable] = {}
+        self.calls: Counter = Counter()
+        self.disabled_rpcs: set = set()
+        self.rpcs: Dict[str, Callable[['FakeDatabase', dict], Any]] = dict(DEFAULT_RPCS)
+
+    def table(self, name: str) -> FakeTable:
+        if name not in self.tables:
+            self.tables[name] = FakeTable(name)
+        return self.tables[name]
+
+    def delay(self) -> float:
+        if not self.latency and not self.jitter:
+            return 0.0
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def insert(self, table: str, row: dict) -> dict:
+        """Insere uma linha diretamente (sem latência), preenchendo `created_at`."""
+        row = dict(row)
+        row.setdefault('created_at', _now_iso())
+        return self.table(table).add(row)
+
+
+# --- PARSER DO SELECT ---
+
+class _Embed:
+    """Recurso embutido do select: `alias:tabela!inner(colunas)`."""
+
+    def __init__(self, alias: str, table: str, inner: bool, spec: '_Select'):
+        self.alias, self.table, self.inner, self.spec = alias, table, inner, spec
+
+
+class _Select:
+    def __init__(self, columns: List[str], embeds: List[_Embed]):
+        self.columns, self.embeds = columns, embeds
+
+
+def _split_top_level(text: str) -> List[str]:
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+_EMBED_RE = re.compile(r'^(?:(\w+):)?(\w+)(?:!(\w+))?\((.*)\)$', re.S)
+
+
+def parse_select(text: str) -> _Select:
+    columns, embeds = [], []
+    for part in _split_top_level(text or '*'):
+        match = _EMBED_RE.match(part)
+        if match:
+            alias, table, hint, inner_text = match.groups()
+            embeds.append(_Embed(alias or table, table, hint == 'inner', parse_select(inner_text)))
+        else:
+            columns.append(part)
+    return _Select(columns or ['*'], embeds)
+
+
+# --- COMPARAÇÃO DE VALORES ---
+
+def _as_datetime(value: Any) -> Optional[datetime]:
+    if isinstance(value, datetime):
+        return value
+    if isinstance(value, str) and len(value) >= 10 and value[4] == '-' and value[7] == '-':
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+
+def _coerce(stored: Any, value: Any) -> tuple:
+    """Converte o valor do filtro para o tipo da coluna, como o Postgres faria."""
+    if stored is None or value is None:
+        return stored, value
+    if isinstance(stored, bool):
+        return stored, value if isinstance(value, bool) else str(value).lower() == 'true'
+    if isinstance(stored, (int, float)) and not isinstance(value, (int, float)):
+        try:
+            return stored, type(stored)(value)
+        except (TypeError, ValueError):
+            return str(stored), str(value)
+    stored_dt, value_dt = _as_datetime(stored), _as_datetime(value)
+    if stored_dt and value_dt:
+        return stored_dt, value_dt
+    return stored, value
+
+
+def _like_to_regex(pattern: str, case_insensitive: bool) -> re.Pattern:
+    regex = ''.join('.*' if c in '%*' else '.' if c == '_' else re.escape(c) for c in pattern)
+    return re.compile(f'^{regex}$', (re.I | re.S) if case_insensitive else re.S)
+
+
+def _compare(operator: str, stored: Any, value: Any) -> bool:
+    if operator == 'is':
+        target = {'null': None, 'true': True, 'false': False}.get(str(value).lower(), value)
+        return stored is target if target is None else stored == target
+    if operator == 'in':
+        return any(_compare('eq', stored, item) for item in value)
+    if operator in ('like', 'ilike'):
+        return stored is not None and bool(_like_to_regex(str(value), operator == 'ilike').match(str(stored)))
+    stored, value = _coerce(stored, value)
+    if operator == 'eq':
+        return stored == value
+    if operator == 'neq':
+        return stored is not None and stored != value
+    if stored is None or value is None:
+        return False
+    return {
+        'lt': stored < value, 'lte': stored <= value,
+        'gt': stored > value, 'gte': stored >= value,
+    }[operator]
+
+
+class _Filter:
+    def __init__(self, column: str, operator: str, value: Any, negate: bool):
+        self.operator, self.value, self.negate = operator, value, negate
+        # `users.telegram_user_id` filtra o recurso embutido `users`
+        self.path, _, self.column = column.rpartition('.')
+
+    def matches(self, row: dict) -> bool:
+        result = _compare(self.operator, row.get(self.column), self.value)
+        return not result if self.negate else result
+
+
+# --- QUERY BUILDER ---
+
+class FakeResponse:
+    """Resposta no mesmo formato do postgrest (`.data` e `.count`)."""
+
+    def __init__(self, data: Any, count: Optional[int] = None):
+        self.data, self.count = data, count
+
+    def __repr__(self) -> str:
+        return f"FakeResponse(data={self.data!r}, count={self.count!r})"
+
+
+class _Negator:
+    """Suporte a `.not_.eq(...)`, `.not_.is_(...)` etc."""
+
+    def __init__(self, builder: 'FakeQueryBuilder'):
+        self._builder = builder
+
+    def __getattr__(self, name: str):
+        method = getattr(self._builder, name)
+
+        def negated(*args, **kwargs):
+            self._builder._negate_next = True
+            return method(*args, **kwargs)
+        return negated
+
+
+class FakeQueryBuilder:
+    """Encadeamento de uma query sobre uma tabela do FakeDatabase."""
+
+    def __init__(self, database: FakeDatabase, table: str, is_async: bool):
+        self._db = database
+        self._table = table
+        self._async = is_async
+        self._operation = 'select'
+        self._select = parse_select('*')
+        self._payload: Any = None
+        self._on_conflict: Optional[str] = None
+        self._returning = True
+        self._count: Optional[str] = None
+        self._filters: List[_Filter] = []
+        self._order: List[tuple] = []
+        self._limit: Optional[int] = None
+        self._offset = 0
+        self._single: Optional[str] = None
+        self._negate_next = False
+
+    # Operações
+    def select(self, *columns: str, count: Optional[str] = None) -> 'FakeQueryBuilder':
+        self._select = parse_select(','.join(columns) or '*')
+        self._count = count
+        return self
+
+    def insert(self, json: Any, *, count: Optional[str] = None, returning: Any = None,
+               upsert: bool = False, default_to_null: bool = True) -> 'FakeQueryBuilder':
+        self._operation = 'upsert' if upsert else 'insert'
+        self._payload = json
+        self._set_returning(returning)
+        return self
+
+    def upsert(self, json: Any, *, count: Optional[str] = None, returning: Any = None,
+               ignore_duplicates: bool = False, on_conflict: str = '', default_to_null: bool = True) -> 'FakeQueryBuilder':
+        self._operation = 'upsert'
+        self._payload = json
+        self._on_conflict = on_conflict or None
+        self._set_returning(returning)
+        return self
+
+    def update(self, json: dict, *, count: Optional[str] = None, returning: Any = None) -> 'FakeQueryBuilder':
+        self._operation = 'update'
+        self._payload = json
+        self._set_returning(returning)
+        return self
+
+    def delete(self, *, count: Optional[str] = None, returning: Any = None) -> 'FakeQueryBuilder':
+        self._operation = 'delete'
+        self._set_returning(returning)
+        return self
+
+    def _set_returning(self, returning: Any) -> None:
+        self._returning = returning is None or getattr(returning, 'value', returning) != 'minimal'
+
+    # Filtros
+    def _filter(self, column: str, operator: str, value: Any) -> 'FakeQueryBuilder':
+        self._filters.append(_Filter(column, operator, value, self._negate_next))
+        self._negate_next = False
+        return self
+
+    def eq(self, column, value): return self._filter(column, 'eq', value)
+    def neq(self, column, value): return self._filter(column, 'neq', value)
+    def lt(self, column, value): return self._filter(column, 'lt', value)
+    def lte(self, column, value): return self._filter(column, 'lte', value)
+    def gt(self, column, value): return self._filter(column, 'gt', value)
+    def gte(self, column, value): return self._filter(column, 'gte', value)
+    def like(self, column, pattern): return self._filter(column, 'like', pattern)
+    def ilike(self, column, pattern): return self._filter(column, 'ilike', pattern)
+    def is_(self, column, value): return self._filter(column, 'is', value)
+    def in_(self, column, values): return self._filter(column, 'in', list(values))
+
+    @property
+    def not_(self) -> _Negator:
+        return _Negator(self)
+
+    # Modificadores
+    def order(self, column: str, *, desc: bool = False, nullsfirst: bool = False, foreign_table: Optional[str] = None) -> 'FakeQueryBuilder':
+        self._order.append((column, desc, nullsfirst))
+        return self
+
+    def limit(self, size: int, *, foreign_table: Optional[str] = None) -> 'FakeQueryBuilder':
+        self._limit = size
+        return self
+
+    def range(self, start: int, end: int, foreign_table: Optional[str] = None) -> 'FakeQueryBuilder':
+        self._offset, self._limit = start, end - start + 1
+        return self
+
+    def single(self) -> 'FakeQueryBuilder':
+        self._single = 'single'
+        return self
+
+    def maybe_single(self) -> 'FakeQueryBuilder':
+        self._single = 'maybe'
+        return self
+
+    # Execução
+    def execute(self):
+        if self._async:
+            return self._execute_async()
+        time.sleep(self._db.delay())
+        return self._run()
+
+    async def _execute_async(self):
+        delay = self._db.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        return self._run()
+
+    def _run(self):
+        self._db.calls[(self._table, self._operation)] += 1
+        handler = getattr(self, f'_run_{self._operation}')
+        rows, count = handler()
+        return self._shape(rows, count)
+
+    def _shape(self, rows: List[dict], count: Optional[int]):
+        if self._single is None:
+            return FakeResponse(rows, count)
+        if len(rows) == 1:
+            return FakeResponse(rows[0], count)
+        if self._single == 'maybe' and not rows:
+            return None
+        raise APIError({
+            'code': 'PGRST116', 'message': 'JSON object requested, multiple (or no) rows returned',
+            'details': f'The result contains {len(rows)} rows', 'hint': None,
+        })
+
+    def _candidates(self) -> List[dict]:
+        """Linhas que podem casar com os filtros de topo, usando índice ou intervalo de id."""
+        table = self._db.table(self._table)
+        for embed in self._select.embeds:
+            # Join interno muitos-para-um filtrado por igualdade (ex.: users!inner + user.telegram_user_id):
+            # resolve primeiro o lado embutido pelo índice e parte só das linhas que apontam para ele.
+            foreign_key = f"{_singular(embed.table)}_id"
+            target = self._db.table(embed.table)
+            for f in self._filters:
+                if (embed.inner and f.path in (embed.alias, embed.table) and f.operator == 'eq'
+                        and not f.negate and f.column in target.indexes and foreign_key in table.indexes):
+                    rows = []
+                    for related in target.find(f.column, f.value):
+                        rows.extend(table.find(foreign_key, related['id']))
+                    return sorted(rows, key=lambda r: r['id'])
+        low = high = None
+        for f in self._filters:
+            if f.path or f.negate:
+                continue
+            if f.operator == 'eq' and f.column in table.indexes:
+                return table.find(f.column, _coerce(0, f.value)[1] if f.column == 'id' else f.value)
+            if f.operator == 'in' and f.column in table.indexes:
+                # in_('id', [...]) e afins: uma busca no índice por valor, sem varrer a tabela
+                rows = {}
+                for value in f.value:
+                    for row in table.find(f.column, _coerce(0, value)[1] if f.column == 'id' else value):
+                        rows[row['id']] = row
+                return [rows[row_id] for row_id in sorted(rows)]
+            if f.column == 'id' and f.operator in ('gt', 'gte'):
+                low = (int(f.value), f.operator == 'gte')
+            if f.column == 'id' and f.operator in ('lt', 'lte'):
+                high = (int(f.value), f.operator == 'lte')
+        return table.id_range(low, high)
+
+    def _matching(self):
+        top_filters = [f for f in self._filters if not f.path]
+        return (row for row in self._candidates() if all(f.matches(row) for f in top_filters))
+
+    def _run_select(self):
+        # As candidatas já vêm ordenadas por id: sem contagem e sem outra ordenação,
+        # dá para parar assim que a página estiver completa (paginação por chave fica O(página)).
+        stop_at = None
+        if self._count is None and self._limit is not None and all(
+            column == 'id' and not desc for column, desc, _ in self._order
+        ):
+            stop_at = self._offset + self._limit
+        rows = []
+        for row in self._matching():
+            shaped = self._project(self._table, row, self._select, self._filters)
+            if shaped is not None:
+                rows.append(shaped)
+                if stop_at is not None and len(rows) >= stop_at:
+                    break
+        rows = self._sorted(rows)
+        count = len(rows) if self._count else None
+        if self._offset:
+            rows = rows[self._offset:]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        return rows, count
+
+    def _sorted(self, rows: List[dict]) -> List[dict]:
+        for column, desc, nullsfirst in reversed(self._order):
+            present = [r for r in rows if r.get(column) is not None]
+            missing = [r for r in rows if r.get(column) is None]
+            present.sort(key=lambda r: _coerce(r[column], r[column])[0], reverse=desc)
+            # Como no Postgres: NULLs vêm por último em ASC e primeiro em DESC
+            nulls_first = nullsfirst or desc
+            rows = missing + present if nulls_first else present + missing
+        return rows
+
+    def _project(self, table: str, row: dict, spec: _Select, filters: List[_Filter], path: str = '') -> Optional[dict]:
+        """Monta a linha de saída com as colunas pedidas e os recursos embutidos."""
+        if '*' in spec.columns:
+            result = dict(row)
+        else:
+            result = {col: row.get(col) for col in spec.columns}
+        for embed in spec.embeds:
+            # O filtro pode referenciar o recurso pelo alias (`user.x`) ou pelo nome da tabela (`users.x`)
+            embed_paths = {f"{path}.{name}" if path else name for name in (embed.alias, embed.table)}
+            embed_path = f"{path}.{embed.alias}" if path else embed.alias
+            embed_filters = [f for f in filters if f.path in embed_paths]
+            value = self._embed(table, row, embed, filters, embed_filters, embed_path)
+            if embed.inner and not value:
+                return None
+            result[embed.alias] = value
+        return result
+
+    def _embed(self, table: str, row: dict, embed: _Embed, filters, embed_filters, embed_path):
+        target = self._db.table(embed.table)
+        foreign_key = f"{_singular(embed.table)}_id"
+        if foreign_key in row:
+            # Muitos-para-um: subscriptions.user_id -> users
+            related = target.find('id', row.get(foreign_key)) if row.get(foreign_key) is not None else []
+            related = [r for r in related if all(f.matches(r) for f in embed_filters)]
+            if not related:
+                return None
+            return self._project(embed.table, related[0], embed.spec, filters, embed_path)
+        # Um-para-muitos: users -> subscriptions.user_id
+        related = target.find(f"{_singular(table)}_id", row['id'])
+        result = []
+        for child in related:
+            if all(f.matches(child) for f in embed_filters):
+                shaped = self._project(embed.table, child, embed.spec, filters, embed_path)
+                if shaped is not None:
+                    result.append(shaped)
+        return result
+
+    def _prepare(self, row: dict) -> dict:
+        row = dict(row)
+        row.setdefault('created_at', _now_iso())
+        return row
+
+    def _run_insert(self):
+        payload = self._payload if isinstance(self._payload, list) else [self._payload]
+        table = self._db.table(self._table)
+        inserted = [dict(table.add(self._prepare(row))) for row in payload]
+        return (inserted if self._returning else []), None
+
+    def _run_upsert(self):
+        payload = self._payload if isinstance(self._payload, list) else [self._payload]
+        table = self._db.table(self._table)
+        conflict_columns = [c.strip() for c in (self._on_conflict or 'id').split(',')]
+        result = []
+        for row in payload:
+            existing = []
+            if all(row.get(c) is not None for c in conflict_columns):
+                # Chave composta (ex.: 'chat_id,user_id'): busca pela primeira coluna e confere as demais
+                existing = [
+                    r for r in table.find(conflict_columns[0], row[conflict_columns[0]])
+                    if all(r.get(c) == row[c] for c in conflict_columns[1:])
+                ]
+            if existing:
+                table.change(existing[0], row)
+                result.append(dict(existing[0]))
+            else:
+                result.append(dict(table.add(self._prepare(row))))
+        return (result if self._returning else []), None
+
+    def _run_update(self):
+        table = self._db.table(self._table)
+        updated = []
+        for row in list(self._matching()):
+            table.change(row, self._payload)
+            updated.append(dict(row))
+        return (updated if self._returning else []), None
+
+    def _run_delete(self):
+        table = self._db.table(self._table)
+        deleted = list(self._matching())
+        for row in deleted:
+            table.remove(row)
+        return ([dict(r) for r in deleted] if self._returning else []), None
+
+
+class FakeRPCBuilder:
+    """Chamada a uma função SQL registrada no FakeDatabase."""
+
+    def __init__(self, database: FakeDatabase, name: str, params: dict, is_async: bool):
+        self._db, self._name, self._params, self._async = database, name, params or {}, is_async
+
+    def execute(self):
+        if self._async:
+            return self._execute_async()
+        time.sleep(self._db.delay())
+        return self._run()
+
+    async def _execute_async(self):
+        delay = self._db.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        return self._run()
+
+    def _run(self) -> FakeResponse:
+        self._db.calls[('rpc', self._name)] += 1
+        function = self._db.rpcs.get(self._name)
+        if function is None or self._name in self._db.disabled_rpcs:
+            raise APIError({
+                'code': 'PGRST202', 'message': f'Could not find the function public.{self._name} in the schema cache',
+                'details': None, 'hint': None,
+            })
+        return FakeResponse(function(self._db, self._params))
+
+
+# --- CLIENTES ---
+
+class FakeAsyncClient:
+    """Substituto do `AsyncPostgrestClient` (db_supabase.supabase_async)."""
+
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+
+    def table(self, name: str) -> FakeQueryBuilder:
+        return FakeQueryBuilder(self.database, name, is_async=True)
+
+    from_ = table
+
+    def rpc(self, name: str, params: dict) -> FakeRPCBuilder:
+        return FakeRPCBuilder(self.database, name, params, is_async=True)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class FakeSyncClient:
+    """Substituto do `supabase.Client` síncrono (db_supabase.supabase, usado pelo scheduler)."""
+
+    def __init__(self, database: FakeDatabase):
+        self.database = database
+
+    def table(self, name: str) -> FakeQueryBuilder:
+        return FakeQueryBuilder(self.database, name, is_async=False)
+
+    from_ = table
+
+    def rpc(self, name: str, params: Optional[dict] = None) -> FakeRPCBuilder:
+        return FakeRPCBuilder(self.database, name, params or {}, is_async=False)
+
+
+# --- FUNÇÕES SQL (RPCs) ---
+# Equivalentes em Python das funções do banco. As que têm arquivo em sql/ seguem a mesma lógica.
+
+def _rpc_count_subscriptions_by_status(database: FakeDatabase, params: dict) -> List[dict]:
+    counts = Counter(row.get('status') for row in database.table('subscriptions').rows)
+    return [{'status': status, 'count': count} for status, count in counts.items()]
+
+
+def _rpc_get_revenue_stats(database: FakeDatabase, params: dict) -> List[dict]:
+    now = datetime.now(TIMEZONE_BR)
+    total = monthly = daily = 0.0
+    for row in database.table('subscriptions').rows:
+        if row.get('status') not in ('active', 'expired'):
+            continue
+        price = float(row.get('final_price') or 0)
+        total += price
+        started = _as_datetime(row.get('start_date') or row.get('created_at'))
+        if started:
+            started = started.astimezone(TIMEZONE_BR)
+            if (started.year, started.month) == (now.year, now.month):
+                monthly += price
+                if started.date() == now.date():
+                    daily += price
+    return [{'total_revenue': total, 'monthly_revenue': monthly, 'daily_revenue': daily}]
+
+
+def _rpc_get_referral_dashboard_stats(database: FakeDatabase, params: dict) -> List[dict]:
+    referrals = database.table('referrals').rows
+    rewarded = [r for r in referrals if r.get('reward_granted')]
+    top = Counter(r.get('referrer_id') for r in referrals).most_common(5)
+    return [{
+        'total_referrals': len(referrals),
+        'converted_referrals': len(rewarded),
+        'rewards_granted_days': 7 * len(rewarded),
+        'top_referrers': [{'referrer_id': user_id, 'count': count} for user_id, count in top],
+    }]
+
+
+def _rpc_extend_subscription_days(database: FakeDatabase, params: dict) -> List[dict]:
+    table = database.table('subscriptions')
+    active = [r for r in table.find('user_id', params['p_user_id']) if r.get('status') == 'active' and r.get('end_date')]
+    if not active:
+        return []
+    latest = max(active, key=lambda r: _as_datetime(r['end_date']))
+    new_end = _as_datetime(latest['end_date']) + timedelta(days=params['p_days'])
+    table.change(latest, {'end_date': new_end.isoformat()})
+    return [dict(latest)]
+
+
+def _rpc_activate_subscription(database: FakeDatabase, params: dict) -> List[dict]:
+    """Mesma lógica de sql/activate_subscription.sql (o GIL faz o papel do FOR UPDATE)."""
+    subscriptions = database.table('subscriptions')
+    found = subscriptions.find('mp_payment_id', params['p_mp_payment_id'])
+    if not found:
+        return []
+    sub = found[0]
+    already_active = sub.get('status') == 'active'
+    if not already_active:
+        products = database.table('products').find('id', sub.get('product_id'))
+        duration_days = products[0].get('duration_days') if products else None
+        now = datetime.now(timezone.utc)
+        base = now
+        ends = [_as_datetime(r['end_date']) for r in subscriptions.find('user_id', sub['user_id'])
+                if r.get('status') == 'active' and r.get('end_date')]
+        if ends and max(ends) > base:
+            base = max(ends)
+        subscriptions.change(sub, {
+            'status': 'active', 'start_date': now.isoformat(),
+            'end_date': (base + timedelta(days=duration_days)).isoformat() if duration_days else None,
+        })
+    users = database.table('users').find('id', sub['user_id'])
+    products = database.table('products').find('id', sub.get('product_id'))
+    return [{
+        **sub, 'already_active': already_active,
+        'user': dict(users[0]) if users else None,
+        'product': dict(products[0]) if products else None,
+    }]
+
+
+def _rpc_claim_trial(database: FakeDatabase, params: dict) -> List[dict]:
+    """Mesma lógica de sql/claim_trial.sql."""
+    users = database.table('users').find('id', params['p_user_id'])
+    if not users or users[0].get('has_used_trial') is True:
+        return []
+    database.table('users').change(users[0], {'has_used_trial': True})
+    now = datetime.now(timezone.utc)
+    row = database.insert('subscriptions', {
+        'user_id': params['p_user_id'], 'product_id': params['p_product_id'],
+        'mp_payment_id': f"trial_access_{params['p_user_id']}_{now.timestamp()}",
+        'status': 'active', 'start_date': now.isoformat(),
+        'end_date': (now + timedelta(minutes=params.get('p_duration_minutes', 30))).isoformat(),
+        'final_price': 0,
+    })
+    return [dict(row)]
+
+
+DEFAULT_RPCS: Dict[str, Callable[[FakeDatabase, dict], Any]] = {
+    'count_subscriptions_by_status': _rpc_count_subscriptions_by_status,
+    'get_revenue_stats': _rpc_get_revenue_stats,
+    'get_referral_dashboard_stats': _rpc_get_referral_dashboard_stats,
+    'extend_subscription_days': _rpc_extend_subscription_days,
+    'activate_subscription': _rpc_activate_subscription,
+    'claim_trial': _rpc_claim_trial,
+}
+
+
+# --- INSTALAÇÃO E DADOS DE EXEMPLO ---
+
+def install(db_module, latency: float = 0.0, jitter: float = 0.0, database: Optional[FakeDatabase] = None) -> FakeDatabase:
+    """
+    Troca os clientes do módulo db_supabase pelos clientes falsos e limpa os caches em memória.
+    Retorna o FakeDatabase para que o chamador popule e inspecione os dados.
+    """
+    database = database or FakeDatabase(latency=latency, jitter=jitter)
+    db_module.supabase_async = FakeAsyncClient(database)
+    db_module.supabase = FakeSyncClient(database)
+    db_module._missing_rpcs.clear()
+    db_module.product_catalog.invalidate()
+    db_module.settings_store.invalidate()
+    db_module.group_registry.invalidate()
+    db_module.system_stats_snapshot.invalidate()
+    db_module.active_subscription_cache.clear()
+    db_module._group_roster.clear()
+    db_module._roster_stats.update(hits=0, misses=0)
+    return database
+
+
+def seed(database: FakeDatabase, users: int = 1000, groups: int = 10, active_ratio: float = 0.3,
+         expired_ratio: float = 0.2, trial_product_id: int = 3) -> None:
+    """
+    Popula o banco com produtos, grupos, configurações e `users` usuários.
+    Uma fração `active_ratio` recebe assinatura ativa e `expired_ratio` uma assinatura vencida.
+    """
+    now = datetime.now(TIMEZONE_BR)
+    for product in (
+        {'id': 1, 'name': 'Assinatura Mensal', 'price': 29.9, 'duration_days': 30},
+        {'id': 2, 'name': 'Acesso Vitalício', 'price': 99.9, 'duration_days': None},
+        {'id': trial_product_id, 'name': 'Degustação', 'price': 0.0, 'duration_days': None},
+    ):
+        database.insert('products', product)
+    for i in range(groups):
+        database.insert('groups', {'telegram_chat_id': -1001000000000 - i, 'name': f'Grupo {i + 1}'})
+    database.insert('settings', {'key': 'trial_offer', 'value': {'enabled': True}})
+
+    rng = random.Random(42)
+    for i in range(users):
+        user = database.insert('users', {
+            'telegram_user_id': 100_000_000 + i, 'first_name': f'User{i}', 'username': f'user{i}',
+            'has_used_trial': False, 'referral_code': None,
+        })
+        roll = rng.random()
+        if roll < active_ratio:
+            status, end = 'active', now + timedelta(days=rng.randint(1, 30))
+        elif roll < active_ratio + expired_ratio:
+            status, end = 'expired', now - timedelta(days=rng.randint(1, 90))
+        else:
+            continue
+        database.insert('subscriptions', {
+            'user_id': user['id'], 'product_id': 1, 'mp_payment_id': f'seed_{i}',
+            'status': status, 'start_date': (end - timedelta(days=30)).isoformat(),
+            'end_date': end.isoformat(), 'original_price': 29.9, 'final_price': 29.9,
+            'expiry_processed_at': end.isoformat() if status == 'expired' else None,
+        })
@@ -0,0 +1,215 @@
+# --- http_pool.py (POOLS DE CONEXÕES HTTP POR SERVIÇO EXTERNO) ---
+#
+# Um único gerenciador é dono dos clientes httpx de longa duração usados pelo bot:
+# - 'supabase'    -> cliente PostgREST assíncrono do db_supabase
+# - 'mercadopago' -> criação de cobranças PIX e consulta de pagamentos
+# - 'telegram'    -> requisições do python-telegram-bot (via PooledHTTPXRequest)
+# Cada serviço tem seu próprio pool (tamanho, keep-alive e HTTP/2 configuráveis por variável de
+# ambiente) e contadores de uso, expostos em /metrics/db.
+
+import os
+import time
+import logging
+import importlib.util
+from typing import Any, Dict, List
+
+import httpx
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 exige o pacote 'h2'; sem ele, os pools caem para HTTP/1.1 em vez de falhar.
+H2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+class _MeteredTransport(httpx.AsyncBaseTransport):
+    """Transporte que repassa as requisições ao pool real, contando uso, erros e latência do serviço."""
+
+    def __init__(self, upstream: 'Upstream', transport: httpx.AsyncHTTPTransport):
+        self.upstream = upstream
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        upstream = self.upstream
+        upstream.requests += 1
+        upstream.in_flight += 1
+        upstream.peak_in_flight = max(upstream.peak_in_flight, upstream.in_flight)
+        start = time.perf_counter()
+        try:
+            return await self.transport.handle_async_request(request)
+        except Exception:
+            upstream.errors += 1
+            raise
+        finally:
+            upstream.in_flight -= 1
+            upstream.total_ms += (time.perf_counter() - start) * 1000
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class Upstream:
+    """Configuração, clientes e contadores do pool de conexões de um serviço externo."""
+
+    def __init__(self, name: str, pool_size: int, keepalive_connections: int, keepalive_expiry: float,
+                 http2: bool = False, base_url: str = "", timeout: float = 10.0):
+        self.name = name
+        self.pool_size = pool_size
+        self.keepalive_connections = min(keepalive_connections, pool_size)
+        self.keepalive_expiry = keepalive_expiry
+        if http2 and not H2_AVAILABLE:
+            logger.warning(f"⚠️ [HTTP] HTTP/2 pedido para '{name}', mas o pacote 'h2' não está instalado. Usando HTTP/1.1.")
+        self.http2 = http2 and H2_AVAILABLE
+        self.base_url = base_url
+        self.timeout = timeout
+        self._clients: List[httpx.AsyncClient] = []
+        self.requests = 0        # Requisições enviadas (incluindo as que falharam)
+        self.errors = 0          # Falhas de transporte (conexão, timeout...), não respostas 4xx/5xx
+        self.in_flight = 0       # Requisições aguardando resposta neste momento
+        self.peak_in_flight = 0
+        self.total_ms = 0.0
+
+    def create_client(self, **kwargs: Any) -> httpx.AsyncClient:
+        """Cria um cliente httpx sobre um pool próprio deste serviço. `kwargs` vão para o httpx.AsyncClient."""
+        transport = httpx.AsyncHTTPTransport(
+            http1=True,
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+        kwargs.setdefault('timeout', self.timeout)
+        if self.base_url:
+            kwargs.setdefault('base_url', self.base_url)
+        client = httpx.AsyncClient(transport=_MeteredTransport(self, transport), **kwargs)
+        # Clientes fechados (ex.: recriados pelo PTB num novo initialize) saem da contagem
+        self._clients = [c for c in self._clients if not c.is_closed] + [client]
+        return client
+
+    def _connection_counts(self) -> tuple[int, int]:
+        """Conexões abertas e ociosas nos pools dos clientes vivos (lidas do httpcore)."""
+        opened = idle = 0
+        for client in self._clients:
+            if client.is_closed:
+                continue
+            pool = getattr(getattr(client._transport, 'transport', None), '_pool', None)
+            for connection in getattr(pool, 'connections', []):
+                opened += 1
+                idle += connection.is_idle()
+        return opened, idle
+
+    def stats(self) -> Dict[str, Any]:
+        opened, idle = self._connection_counts()
+        return {
+            'pool_size': self.pool_size,
+            'http2': self.http2,
+            'requests': self.requests,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'peak_in_flight': self.peak_in_flight,
+            'avg_ms': round(self.total_ms / self.requests, 1) if self.requests else 0.0,
+            'connections': opened,
+            'idle_connections': idle,
+            'utilization': round(self.in_flight / self.pool_size, 2),
+            'peak_utilization': round(self.peak_in_flight / self.pool_size, 2),
+        }
+
+    async def aclose(self) -> None:
+        for client in self._clients:
+            if not client.is_closed:
+                await client.aclose()
+        self._clients = []
+
+
+class HTTPPoolManager:
+    """
+    Dono dos pools HTTP de todos os serviços externos.
+    - `client(name)` retorna o cliente compartilhado do serviço (criado no `start()` ou no primeiro uso).
+    - `create_client(name, ...)` cria um cliente extra sobre as mesmas configurações, para bibliotecas
+      que gerenciam a própria sessão (PostgREST, python-telegram-bot). Ele também entra nas métricas.
+    - `close()` fecha todos os clientes; é seguro chamá-lo mesmo se a biblioteca já fechou os seus.
+    """
+
+    def __init__(self, upstreams: List[Upstream]):
+        self.upstreams: Dict[str, Upstream] = {u.name: u for u in upstreams}
+        self._shared: Dict[str, httpx.AsyncClient] = {}
+
+    def create_client(self, name: str, **kwargs: Any) -> httpx.AsyncClient:
+        return self.upstreams[name].create_client(**kwargs)
+
+    def client(self, name: str) -> httpx.AsyncClient:
+        client = self._shared.get(name)
+        if client is None or client.is_closed:
+            client = self._shared[name] = self.create_client(name)
+        return client
+
+    async def start(self) -> None:
+        """Abre os clientes compartilhados (os serviços com `base_url`), para o primeiro pagamento não pagar a criação."""
+        for name, upstream in self.upstreams.items():
+            if upstream.base_url:
+                self.client(name)
+        logger.info(f"✅ [HTTP] Pools de conexões prontos: {', '.join(f'{n}={u.pool_size}' for n, u in self.upstreams.items())}.")
+
+    async def close(self) -> None:
+        for upstream in self.upstreams.values():
+            await upstream.aclose()
+        self._shared.clear()
+        logger.info("[HTTP] Pools de conexões encerrados.")
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: upstream.stats() for name, upstream in self.upstreams.items()}
+
+
+pool = HTTPPoolManager([
+    Upstream(
+        'supabase',
+        pool_size=int(os.getenv("DB_POOL_SIZE", 20)),
+        keepalive_connections=int(os.getenv("DB_KEEPALIVE_CONNECTIONS", 10)),
+        keepalive_expiry=float(os.getenv("DB_KEEPALIVE_EXPIRY", 30)),  # Segundos que uma conexão ociosa fica aberta
+        http2=_env_bool("DB_HTTP2", True),
+    ),
+    Upstream(
+        'mercadopago',
+        pool_size=int(os.getenv("MP_POOL_SIZE", 10)),
+        keepalive_connections=int(os.getenv("MP_KEEPALIVE_CONNECTIONS", 5)),
+        keepalive_expiry=float(os.getenv("MP_KEEPALIVE_EXPIRY", 30)),
+        http2=_env_bool("MP_HTTP2", False),
+        base_url="https://api.mercadopago.com",
+        timeout=float(os.getenv("MP_TIMEOUT", 10)),
+    ),
+    Upstream(
+        'telegram',
+        pool_size=int(os.getenv("TELEGRAM_POOL_SIZE", 32)),
+        keepalive_connections=int(os.getenv("TELEGRAM_KEEPALIVE_CONNECTIONS", 32)),
+        keepalive_expiry=float(os.getenv("TELEGRAM_KEEPALIVE_EXPIRY", 30)),
+        http2=_env_bool("TELEGRAM_HTTP2", False),
+    ),
+])
+
+
+class PooledHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest do python-telegram-bot que usa o pool 'telegram' do gerenciador (tamanho, keep-alive e métricas)."""
+
+    def __init__(self, upstream: str = 'telegram', **kwargs: Any):
+        self._upstream = upstream
+        settings = pool.upstreams[upstream]
+        kwargs.setdefault('connection_pool_size', settings.pool_size)
+        kwargs.setdefault('http_version', '2' if settings.http2 else '1.1')
+        super().__init__(**kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        # 'limits' e 'transport' do PTB são substituídos pelos do pool; timeouts e proxy são mantidos
+        return pool.create_client(
+            self._upstream,
+            timeout=self._client_kwargs['timeout'],
+            proxy=self._client_kwargs.get('proxy'),
+        )
@@ -0,0 +1,144 @@
+# --- invite_pool.py (ESTOQUE DE LINKS DE CONVITE DE USO ÚNICO POR GRUPO) ---
+#
+# Mantém, para cada grupo cadastrado, alguns links de convite (member_limit=1) já criados, para que a
+# entrega após o pagamento não espere um create_chat_invite_link por grupo.
+# - Uma tarefa em segundo plano repõe o estoque (INVITE_POOL_SIZE por grupo), usando a fatia de envios
+#   em massa do rate_limiter, e é acordada sempre que um link é retirado.
+# - Links com menos de INVITE_RETIRE_MARGIN de validade saem do estoque antes de expirar; quem recebe
+#   um link tem sempre pelo menos essa margem para usá-lo.
+# - Se o estoque de um grupo estiver vazio, o link é criado na hora, como antes.
+# O estoque vive só em memória: num reinício, os links não entregues simplesmente expiram.
+
+import os
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden
+
+import db_supabase as db
+import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+INVITE_POOL_SIZE = int(os.getenv("INVITE_POOL_SIZE", 5))                    # Links prontos por grupo
+INVITE_LINK_TTL = int(os.getenv("INVITE_LINK_TTL", 2 * 3600))                # Validade de cada link, em segundos
+INVITE_RETIRE_MARGIN = int(os.getenv("INVITE_RETIRE_MARGIN", 30 * 60))      # Validade mínima restante para entregar
+INVITE_REFILL_INTERVAL = int(os.getenv("INVITE_REFILL_INTERVAL", 5 * 60))   # Revisão periódica do estoque, em segundos
+
+
+class InvitePool:
+    """Estoque de links de convite de uso único, por grupo."""
+
+    def __init__(self, size: int = INVITE_POOL_SIZE, ttl: int = INVITE_LINK_TTL,
+                 retire_margin: int = INVITE_RETIRE_MARGIN, refill_interval: int = INVITE_REFILL_INTERVAL):
+        self.size = size
+        self.ttl = timedelta(seconds=ttl)
+        self.retire_margin = timedelta(seconds=min(retire_margin, ttl // 2))
+        self.refill_interval = refill_interval
+        self._links: Dict[int, Deque[Tuple[str, datetime]]] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.hits = 0      # Links entregues direto do estoque
+        self.misses = 0    # Links criados na hora por falta de estoque
+        self.minted = 0    # Links criados pela reposição
+        self.retired = 0   # Links descartados perto de expirar
+
+    async def _mint(self, bot: Bot, chat_id: int, bulk: bool) -> Tuple[str, datetime]:
+        expire_date = datetime.now(timezone.utc) + self.ttl
+        link = await bot.create_chat_invite_link(
+            chat_id=chat_id,
+            expire_date=expire_date,
+            member_limit=1,
+            rate_limit_args=rate_limiter.BULK if bulk else None,
+        )
+        return link.invite_link, expire_date
+
+    def _retire(self, links: Deque[Tuple[str, datetime]]) -> None:
+        deadline = datetime.now(timezone.utc) + self.retire_margin
+        # Os links entram em ordem de validade, então os mais próximos de expirar ficam no início
+        while links and links[0][1] <= deadline:
+            links.popleft()
+            self.retired += 1
+
+    def take(self, chat_id: int) -> Optional[str]:
+        """Retira um link do estoque do grupo (sem chamar a API), ou None se não houver."""
+        links = self._links.get(chat_id)
+        if not links:
+            return None
+        self._retire(links)
+        self._wake.set()
+        if not links:
+            return None
+        return links.pop()[0]  # O mais novo: quem recebe tem o máximo de validade
+
+    async def get_link(self, bot: Bot, chat_id: int, bulk: bool = False) -> str:
+        """
+        Entrega um link de uso único para o grupo: do estoque, ou criado na hora se o estoque acabou.
+        `bulk=True` (envios em massa) cria os links que faltarem na fatia de massa do rate_limiter.
+        """
+        link = self.take(chat_id)
+        if link:
+            self.hits += 1
+            return link
+        self.misses += 1
+        invite_link, _ = await self._mint(bot, chat_id, bulk=bulk)
+        return invite_link
+
+    async def _refill_group(self, bot: Bot, chat_id: int) -> None:
+        links = self._links.setdefault(chat_id, deque())
+        self._retire(links)
+        while len(links) < self.size:
+            try:
+                links.append(await self._mint(bot, chat_id, bulk=True))
+                self.minted += 1
+            except (Forbidden, BadRequest) as e:
+                logger.warning(f"[INVITES] Não foi possível criar links para o grupo {chat_id}: {e}")
+                return
+
+    async def refill(self, bot: Bot) -> None:
+        """Descarta links perto de expirar e completa o estoque de todos os grupos cadastrados."""
+        group_ids = await db.get_all_group_ids()
+        for chat_id in list(self._links):
+            if chat_id not in group_ids:
+                del self._links[chat_id]
+        await asyncio.gather(*(self._refill_group(bot, chat_id) for chat_id in group_ids))
+
+    async def _run(self, bot: Bot) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                await self.refill(bot)
+            except Exception as e:
+                logger.error(f"[INVITES] Erro ao repor o estoque de links: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot: Bot) -> None:
+        """Inicia a reposição em segundo plano (chamado no início do app)."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(bot))
+            logger.info(f"✅ [INVITES] Estoque de links iniciado ({self.size} por grupo).")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'stock': {chat_id: len(links) for chat_id, links in self._links.items()},
+            'hits': self.hits,
+            'misses': self.misses,
+            'minted': self.minted,
+            'retired': self.retired,
+        }
+
+
+pool = InvitePool()
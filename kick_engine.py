@@ -0,0 +1,226 @@
+# --- kick_engine.py (MOTOR DE REMOÇÕES CONCORRENTES USUÁRIO x GRUPO) ---
+#
+# Executa pares (usuário, grupo) de ban + unban com vários workers ao mesmo tempo, em vez de um
+# grupo por vez e um usuário por vez. O ritmo é ditado por dois orçamentos:
+# - o rate_limiter global (as chamadas usam rate_limit_args=BULK, deixando folga para os usuários);
+# - um balde por grupo (KICK_GROUP_RATE remoções/s), para não concentrar a rajada num único grupo; os
+#   baldes são do módulo, então execuções simultâneas (ex.: auditoria e expiração) dividem o orçamento.
+# Cada par termina com um resultado estruturado (REMOVED, NOT_MEMBER, FORBIDDEN, OWNER, FAILED), e a
+# última execução de cada rotina ('expiry', 'audit', 'manual') fica em `runs` para o /metrics/db.
+
+import os
+import time
+import asyncio
+import logging
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden
+
+import db_supabase as db
+import rate_limiter
+
+logger = logging.getLogger(__name__)
+
+KICK_CONCURRENCY = int(os.getenv("KICK_CONCURRENCY", 16))    # Pares (usuário, grupo) em voo ao mesmo tempo
+KICK_GROUP_RATE = float(os.getenv("KICK_GROUP_RATE", 5))     # Remoções por segundo em cada grupo
+
+# Resultados possíveis de um par (usuário, grupo)
+REMOVED = 'removed'          # Estava no grupo e foi removido (ban + unban)
+NOT_MEMBER = 'not_member'    # Já não estava no grupo
+FORBIDDEN = 'forbidden'      # O bot não tem permissão de banir no grupo
+OWNER = 'owner'              # O usuário é o dono do grupo
+FAILED = 'failed'            # Outro erro do Telegram ou inesperado
+
+PRESENT_STATUSES = db.MEMBER_STATUSES + ('restricted',)  # Status do roster que contam como "estava no grupo"
+
+_DONE = object()  # Sentinela que encerra cada worker
+
+
+class KickRun:
+    """
+    Resultado de uma execução: o resultado de cada par e os contadores de vazão.
+    Pode acumular várias chamadas a kick_pairs (ex.: os blocos da expiração); o tempo contado é só
+    o que o motor passou trabalhando, para que a vazão não inclua o que a rotina faz entre os blocos.
+    """
+
+    def __init__(self, name: str = 'default'):
+        self.name = name
+        self.pairs = 0
+        self.outcomes: Dict[int, Dict[int, str]] = {}  # user_id -> {group_id: resultado}
+        self.counts: Counter = Counter()
+        self.api_calls = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.active_seconds = 0.0
+        self._segment_start: Optional[float] = None
+
+    def removed_from(self, user_id: int) -> int:
+        """Em quantos grupos o usuário foi removido nesta execução."""
+        return sum(1 for outcome in self.outcomes.get(user_id, {}).values() if outcome == REMOVED)
+
+    @property
+    def processed(self) -> int:
+        return sum(self.counts.values())
+
+    @property
+    def elapsed(self) -> float:
+        running = time.monotonic() - self._segment_start if self._segment_start is not None else 0.0
+        return self.active_seconds + running
+
+    @property
+    def rate(self) -> float:
+        """Pares processados por segundo."""
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'pairs': self.pairs,
+            'processed': self.processed,
+            'outcomes': dict(self.counts),
+            'api_calls': self.api_calls,
+            'peak_in_flight': self.peak_in_flight,
+            'elapsed_s': round(self.elapsed, 2),
+            'pairs_per_s': round(self.rate, 2),
+        }
+
+
+# Última execução de cada rotina (exposta no /metrics/db)
+runs: Dict[str, KickRun] = {}
+
+# Balde de cada grupo, compartilhado por todas as execuções em andamento
+_group_buckets: Dict[int, rate_limiter.TokenBucket] = {}
+
+
+def _group_bucket(group_id: int, rate: float) -> rate_limiter.TokenBucket:
+    """Balde do grupo, criado com `rate` remoções/s na primeira vez que o grupo é usado."""
+    bucket = _group_buckets.get(group_id)
+    if bucket is None:
+        bucket = _group_buckets[group_id] = rate_limiter.TokenBucket(rate, max(1.0, rate))
+    return bucket
+
+
+def _record_left(user_id: int, group_id: int) -> None:
+    """
+    Marca a saída no roster só se ele conhecia o usuário como presente no grupo: pares desconhecidos
+    (a maioria numa expiração) não ganham linhas 'left' nem no índice nem no banco.
+    A gravação no banco fica no buffer do roster e é feita em lote ao fim de cada kick_pairs.
+    """
+    if db.get_group_member_status(group_id, user_id) in PRESENT_STATUSES:
+        db.record_group_member(group_id, user_id, 'left')
+
+
+async def kick(bot: Bot, user_id: int, group_id: int) -> Tuple[str, int]:
+    """Expulsa e desbane o usuário de um grupo. Retorna o resultado e quantas chamadas à API foram feitas."""
+    calls = 0
+    try:
+        calls += 1
+        await bot.ban_chat_member(chat_id=group_id, user_id=user_id, rate_limit_args=rate_limiter.BULK)
+        calls += 1
+        await bot.unban_chat_member(chat_id=group_id, user_id=user_id, only_if_banned=True, rate_limit_args=rate_limiter.BULK)
+        logger.info(f"[KICK] Usuário {user_id} removido do grupo {group_id}.")
+        _record_left(user_id, group_id)
+        return REMOVED, calls
+    except Forbidden:
+        logger.warning(f"[KICK] Sem permissão para remover {user_id} do grupo {group_id}.")
+        return FORBIDDEN, calls
+    except BadRequest as e:
+        error_text = str(e).lower()
+        if "user not found" in error_text or "member not found" in error_text:
+            logger.info(f"[KICK] Usuário {user_id} já não estava no grupo {group_id}.")
+            _record_left(user_id, group_id)
+            return NOT_MEMBER, calls
+        if "can't remove chat owner" in error_text:
+            logger.warning(f"[KICK] Não é possível remover o usuário {user_id} do grupo {group_id} porque ele é o proprietário.")
+            return OWNER, calls
+        logger.error(f"[KICK] Erro do Telegram ao remover {user_id} do {group_id}: {e}")
+        return FAILED, calls
+    except Exception as e:
+        logger.error(f"[KICK] Erro inesperado ao remover {user_id} do {group_id}: {e}")
+        return FAILED, calls
+
+
+async def kick_pairs(
+    bot: Bot,
+    pairs: Iterable[Tuple[int, int]],
+    concurrency: int = KICK_CONCURRENCY,
+    group_rate: float = KICK_GROUP_RATE,
+    on_result: Optional[Callable[[KickRun, int, int, str], Awaitable[None]]] = None,
+    run: Optional[KickRun] = None,
+    name: str = 'default',
+) -> KickRun:
+    """
+    Remove cada usuário de cada grupo dos `pairs` (user_id, group_id), com até `concurrency` pares em voo.
+    - Cada grupo tem seu próprio balde de `group_rate` remoções/s, compartilhado com outras execuções
+      simultâneas; o rate_limiter cuida do orçamento global.
+    - `on_result(run, user_id, group_id, resultado)` é chamado a cada par concluído (ex.: progresso).
+    - `run`: acumula o resultado numa execução existente (ex.: vários blocos); senão, cria uma com `name`.
+    Erros nunca interrompem a execução: cada par termina com um dos resultados do módulo.
+    Ao fim, as mudanças de roster dos pares removidos são gravadas de uma vez (db.flush_group_members).
+    """
+    pairs = list(pairs)
+    run = run or KickRun(name)
+    runs[run.name] = run
+    run.pairs += len(pairs)
+    if not pairs:
+        return run
+
+    pending = iter(pairs)  # Compartilhado pelos workers (um único loop de eventos: sem disputa)
+
+    async def worker() -> None:
+        while True:
+            item = next(pending, _DONE)
+            if item is _DONE:
+                return
+            user_id, group_id = item
+            await _group_bucket(group_id, group_rate).acquire()
+            run.in_flight += 1
+            run.peak_in_flight = max(run.peak_in_flight, run.in_flight)
+            try:
+                outcome, calls = await kick(bot, user_id, group_id)
+            finally:
+                run.in_flight -= 1
+            run.api_calls += calls
+            run.counts[outcome] += 1
+            run.outcomes.setdefault(user_id, {})[group_id] = outcome
+            if on_result:
+                try:
+                    await on_result(run, user_id, group_id, outcome)
+                except Exception as e:
+                    logger.error(f"[KICK] Erro no callback de resultado: {e}")
+
+    run._segment_start = time.monotonic()
+    workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(pairs)))]
+    try:
+        await asyncio.gather(*workers)
+    except asyncio.CancelledError:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+    finally:
+        run.active_seconds += time.monotonic() - run._segment_start
+        run._segment_start = None
+
+    # As saídas registradas pelos workers vão para o banco num único upsert em lote
+    await db.flush_group_members()
+
+    logger.info(
+        f"[KICK][{run.name}] {run.processed} pares em {run.elapsed:.1f}s ({run.rate:.1f}/s, pico de {run.peak_in_flight} em voo): "
+        f"{dict(run.counts)}, {run.api_calls} chamadas à API."
+    )
+    return run
+
+
+async def kick_users(bot: Bot, user_ids: Iterable[int], group_ids: Optional[Iterable[int]] = None, **kwargs) -> KickRun:
+    """Remove cada usuário de todos os grupos (por padrão, todos os grupos cadastrados)."""
+    group_ids = list(group_ids) if group_ids is not None else await db.get_all_group_ids()
+    # Pares em ordem de usuário: os grupos de um mesmo usuário saem juntos, cada um no seu balde
+    return await kick_pairs(bot, ((user_id, group_id) for user_id in user_ids for group_id in group_ids), **kwargs)
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """Contadores da última execução de cada rotina (vazio se o motor ainda não rodou)."""
+    return {name: run.stats() for name, run in runs.items()}
@@ -0,0 +1,193 @@
+# --- metrics.py (MÉTRICAS DE LATÊNCIA E ERROS EM PROCESSO) ---
+
+import os
+import time
+import inspect
+import logging
+import functools
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Chamadas acima deste tempo geram um log de "consulta lenta"
+SLOW_CALL_MS = float(os.getenv("DB_SLOW_CALL_MS", 500))
+
+# Limites superiores (em ms) dos baldes do histograma de latência
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Lista de erros da chamada instrumentada em andamento. As funções do db_supabase engolem as exceções
+# e retornam None/[]; o _execute registra o erro aqui antes de repassá-lo, para que ele seja contado.
+# Também marca que já há uma chamada instrumentada em andamento: as funções públicas chamadas por
+# outra (ex.: claim_trial -> create_trial_subscription) não são contadas de novo, para que o tempo e
+# as chamadas de cada entrada apareçam uma única vez no /metrics/db.
+_current_errors: ContextVar[Optional[List[str]]] = ContextVar("_current_errors", default=None)
+
+
+class CallStats:
+    """Contadores e histograma de latência de uma função."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)  # O último balde é "acima do maior limite"
+        self.last_error: Optional[str] = None
+
+    def record(self, elapsed_ms: float, rows: int, error: Optional[str]) -> None:
+        self.calls += 1
+        self.rows += rows
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        if error:
+            self.errors += 1
+            self.last_error = error
+
+    def percentile(self, fraction: float) -> float:
+        """Percentil aproximado pelo limite superior do balde (o maior balde usa o máximo observado)."""
+        if not self.calls:
+            return 0.0
+        target = fraction * self.calls
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'rows': self.rows,
+            'total_ms': round(self.total_ms, 1),
+            'avg_ms': round(self.total_ms / self.calls, 1) if self.calls else 0.0,
+            'p50_ms': self.percentile(0.50),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.max_ms, 1),
+            'histogram': {f"le_{b}": n for b, n in zip(LATENCY_BUCKETS_MS, self.buckets)} | {'inf': self.buckets[-1]},
+            'last_error': self.last_error,
+        }
+
+
+_registry: Dict[str, CallStats] = {}
+
+
+def _stats_for(name: str) -> CallStats:
+    stats = _registry.get(name)
+    if stats is None:
+        stats = _registry[name] = CallStats(name)
+    return stats
+
+
+def record_error(error: BaseException) -> None:
+    """Marca um erro na chamada instrumentada em andamento (se houver)."""
+    errors = _current_errors.get()
+    if errors is not None:
+        errors.append(f"{type(error).__name__}: {error}")
+
+
+def _count_rows(result: Any) -> int:
+    if result is None or isinstance(result, bool):
+        return 0
+    if isinstance(result, (list, tuple, set)):
+        return len(result)
+    return 1
+
+
+def _finish(name: str, elapsed_ms: float, rows: int, errors: List[str]) -> None:
+    _stats_for(name).record(elapsed_ms, rows, errors[-1] if errors else None)
+    if elapsed_ms >= SLOW_CALL_MS:
+        logger.warning(f"🐢 [METRICS] Chamada lenta: {name} levou {elapsed_ms:.0f} ms (limite {SLOW_CALL_MS:.0f} ms).")
+
+
+def instrument(name: str, func: Callable) -> Callable:
+    """
+    Envolve uma função assíncrona (ou um gerador assíncrono) registrando tempo, chamadas, erros e linhas.
+    Nos geradores, conta apenas o tempo gasto dentro do gerador, não o do consumidor entre as páginas.
+    Chamadas feitas de dentro de outra chamada instrumentada rodam sem registro próprio: o tempo e os
+    erros delas já entram na chamada de fora.
+    """
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def generator_wrapper(*args, **kwargs):
+            if _current_errors.get() is not None:
+                generator = func(*args, **kwargs)
+                try:
+                    async for item in generator:
+                        yield item
+                finally:
+                    await generator.aclose()
+                return
+            errors: List[str] = []
+            rows = 0
+            elapsed = 0.0
+            generator = func(*args, **kwargs)
+            try:
+                while True:
+                    token = _current_errors.set(errors)
+                    step_start = time.perf_counter()
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    except Exception as e:
+                        errors.append(f"{type(e).__name__}: {e}")
+                        raise
+                    finally:
+                        elapsed += time.perf_counter() - step_start
+                        _current_errors.reset(token)
+                    rows += _count_rows(item)
+                    yield item
+            finally:
+                await generator.aclose()
+                _finish(name, elapsed * 1000, rows, errors)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if _current_errors.get() is not None:
+            return await func(*args, **kwargs)
+        errors: List[str] = []
+        token = _current_errors.set(errors)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = await func(*args, **kwargs)
+            return result
+        except Exception as e:
+            errors.append(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current_errors.reset(token)
+            _finish(name, (time.perf_counter() - start) * 1000, _count_rows(result), errors)
+    return wrapper
+
+
+def instrument_module(module, prefix: str) -> int:
+    """Instrumenta todas as funções assíncronas públicas definidas no módulo. Retorna quantas foram envolvidas."""
+    count = 0
+    for attr, value in list(vars(module).items()):
+        if attr.startswith('_') or getattr(value, '__module__', None) != module.__name__:
+            continue
+        if inspect.iscoroutinefunction(value) or inspect.isasyncgenfunction(value):
+            setattr(module, attr, instrument(f"{prefix}.{attr}", value))
+            count += 1
+    return count
+
+
+def snapshot() -> Dict[str, Dict[str, Any]]:
+    """Retorna as métricas de todas as funções, da mais custosa (tempo total) para a menos."""
+    ordered = sorted(_registry.values(), key=lambda s: s.total_ms, reverse=True)
+    return {stats.name: stats.to_dict() for stats in ordered}
+
+
+def reset() -> None:
+    """Zera todas as métricas."""
+    _registry.clear()
@@ -0,0 +1,217 @@
+# --- rate_limiter.py (LIMITADOR GLOBAL DE ENVIOS PARA O TELEGRAM) ---
+#
+# Fica na frente do Bot (Application.builder().rate_limiter(...)), então toda chamada à API passa
+# por ele: broadcasts, scheduler, links de acesso, alertas e respostas aos usuários. Substitui os
+# `asyncio.sleep` fixos espalhados pelos loops, que não se coordenavam entre si.
+#
+# Orçamentos (limites documentados na FAQ de bots do Telegram, configuráveis por ambiente):
+# - global:  TG_GLOBAL_RATE requisições/s para qualquer chat
+# - chat:    TG_CHAT_RATE mensagens/s por chat privado (com rajada de TG_CHAT_BURST)
+# - grupo:   TG_GROUP_RATE_PER_MIN mensagens/min por grupo (só envios/edições; ban, convites etc. não contam)
+# - envio em massa (rate_limit_args=BULK): usa no máximo TG_BULK_SHARE do orçamento global, deixando
+#   folga para confirmações de pagamento e respostas a comandos durante um broadcast.
+# Ao receber RetryAfter, o chat afetado é pausado pelo tempo pedido e o ritmo global é reduzido;
+# ele volta a subir aos poucos enquanto não houver novos RetryAfter.
+
+import os
+import time
+import asyncio
+import logging
+import contextlib
+from typing import Any, Callable, Coroutine, Dict, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 30))
+TG_MIN_GLOBAL_RATE = float(os.getenv("TG_MIN_GLOBAL_RATE", 5))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", 1))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", 3))
+TG_GROUP_RATE_PER_MIN = float(os.getenv("TG_GROUP_RATE_PER_MIN", 20))
+TG_BULK_SHARE = float(os.getenv("TG_BULK_SHARE", 0.8))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 2))
+
+# Marca passada em `rate_limit_args` pelas rotinas de envio em massa (broadcasts, avisos do scheduler)
+BULK = 'bulk'
+
+RATE_DECREASE_FACTOR = 0.7   # Ritmo global após um RetryAfter
+RATE_RECOVERY_STEP = 1.0     # Requisições/s recuperadas a cada intervalo sem RetryAfter
+RATE_RECOVERY_INTERVAL = 10  # Segundos
+MAX_TRACKED_CHATS = 1024     # Acima disso, baldes cheios de chats inativos são descartados
+
+# Endpoints que contam no orçamento de mensagens de grupos
+_GROUP_MESSAGE_PREFIXES = ('send', 'copy', 'forward', 'edit')
+
+
+class TokenBucket:
+    """
+    Balde de fichas assíncrono: `rate` fichas por segundo, acumulando até `capacity`.
+    Quem espera é atendido em ordem de chegada. `pause()` bloqueia o balde por um tempo (RetryAfter).
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> float:
+        """Consome uma ficha, esperando se necessário. Retorna quantos segundos esperou."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        """Balde cheio, sem pausa e sem ninguém esperando: pode ser descartado e recriado depois."""
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until and not self._lock.locked()
+
+
+class TelegramRateLimiter(BaseRateLimiter[str]):
+    """Limitador de requisições do bot, compartilhado por todos os caminhos que falam com o Telegram."""
+
+    def __init__(self,
+                 global_rate: float = TG_GLOBAL_RATE,
+                 min_global_rate: float = TG_MIN_GLOBAL_RATE,
+                 chat_rate: float = TG_CHAT_RATE,
+                 chat_burst: float = TG_CHAT_BURST,
+                 group_rate_per_min: float = TG_GROUP_RATE_PER_MIN,
+                 bulk_share: float = TG_BULK_SHARE,
+                 max_retries: int = TG_MAX_RETRIES):
+        self.max_global_rate = global_rate
+        self.min_global_rate = min(min_global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_min / 60
+        self.bulk_share = bulk_share
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._bulk = TokenBucket(global_rate * bulk_share, global_rate * bulk_share)
+        self._chats: Dict[int | str, TokenBucket] = {}
+        self._last_adjust = time.monotonic()
+        self.requests = 0
+        self.retry_after_hits = 0
+        self.wait_seconds = 0.0  # Tempo total que as requisições passaram aguardando o limitador
+
+    async def initialize(self) -> None:
+        """Nada a preparar: os baldes são criados sob demanda."""
+
+    async def shutdown(self) -> None:
+        """Nada a liberar."""
+
+    # --- RITMO ADAPTATIVO ---
+
+    def _set_global_rate(self, rate: float) -> None:
+        self._global.rate = self._global.capacity = rate
+        self._bulk.rate = self._bulk.capacity = rate * self.bulk_share
+
+    def _recover(self) -> None:
+        now = time.monotonic()
+        if self._global.rate >= self.max_global_rate or now - self._last_adjust < RATE_RECOVERY_INTERVAL:
+            return
+        self._set_global_rate(min(self.max_global_rate, self._global.rate + RATE_RECOVERY_STEP))
+        self._last_adjust = now
+
+    def _on_retry_after(self, chat_id: Optional[int | str], retry_after: float) -> None:
+        self.retry_after_hits += 1
+        if chat_id is not None:
+            self._chat_bucket(chat_id, is_group=self._is_group(chat_id)).pause(retry_after)
+        else:
+            self._global.pause(retry_after)
+        self._set_global_rate(max(self.min_global_rate, self._global.rate * RATE_DECREASE_FACTOR))
+        self._last_adjust = time.monotonic()
+        logger.warning(f"⏳ [RATE] RetryAfter de {retry_after:.0f}s (chat {chat_id}). Ritmo global reduzido para {self._global.rate:.1f} req/s.")
+
+    # --- BALDES POR CHAT ---
+
+    @staticmethod
+    def _is_group(chat_id: int | str) -> bool:
+        # IDs negativos são grupos/canais; IDs em texto (@canal) também
+        return isinstance(chat_id, str) or chat_id < 0
+
+    def _chat_bucket(self, chat_id: int | str, is_group: bool) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= MAX_TRACKED_CHATS:
+                for key, old in list(self._chats.items()):
+                    if old.is_idle():
+                        del self._chats[key]
+            if is_group:
+                bucket = TokenBucket(self.group_rate, max(1.0, self.group_rate * 60))
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, endpoint: str, chat_id: Optional[int | str], bulk: bool) -> None:
+        if chat_id is None:
+            return  # answerCallbackQuery, getMe... não contam nos limites de mensagens
+        self._recover()
+        waited = 0.0
+        is_group = self._is_group(chat_id)
+        if not is_group or endpoint.startswith(_GROUP_MESSAGE_PREFIXES):
+            waited += await self._chat_bucket(chat_id, is_group).acquire()
+        if bulk:
+            waited += await self._bulk.acquire()
+        waited += await self._global.acquire()
+        self.wait_seconds += waited
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], Any]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[str],
+    ) -> Union[bool, Dict[str, Any], Any]:
+        chat_id = data.get('chat_id')
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(endpoint, chat_id, rate_limit_args == BULK)
+            self.requests += 1
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._on_retry_after(chat_id, float(e.retry_after))
+                if attempt == self.max_retries:
+                    raise
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'global_rate': round(self._global.rate, 1),
+            'max_global_rate': self.max_global_rate,
+            'requests': self.requests,
+            'retry_after_hits': self.retry_after_hits,
+            'wait_seconds': round(self.wait_seconds, 1),
+            'tracked_chats': len(self._chats),
+        }
+
+
+limiter = TelegramRateLimiter()
@@ -6,11 +6,13 @@ import logging
 import sys
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import Client
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.error import BadRequest, Forbidden, RetryAfter
 
 import db_supabase as db
+import kick_engine
+import rate_limiter
 
 # --- CONSTANTES DE PRODUTO ---
 TRIAL_PRODUCT_ID = int(os.getenv("TRIAL_PRODUCT_ID", 3))
@@ -30,38 +32,16 @@ TIMEZONE_BR = timezone(timedelta(hours=-3))
 
 # --- FUNÇÃO REUTILIZÁVEL ---
 async def kick_user_from_all_groups(user_id: int, bot: Bot):
-    """Expulsa e desbane um usuário de todos os grupos listados no DB."""
-    supabase_client = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
-    groups_response = await asyncio.to_thread(
-        lambda: supabase_client.table('groups').select('telegram_chat_id').execute()
-    )
-    group_ids = [g['telegram_chat_id'] for g in groups_response.data]
+    """Expulsa e desbane um usuário de todos os grupos listados no DB, em paralelo (kick_engine)."""
+    # Lê do registro de grupos em memória, compartilhado com o resto do bot
+    group_ids = await db.get_all_group_ids()
 
     if not group_ids:
         logger.error(f"CRÍTICO: [kick_user] Nenhum grupo encontrado no DB. Não é possível remover {user_id}.")
         return 0
 
-    removed_count = 0
-    for group_id in group_ids:
-        try:
-            await bot.ban_chat_member(chat_id=group_id, user_id=user_id)
-            await bot.unban_chat_member(chat_id=group_id, user_id=user_id, only_if_banned=True)
-            logger.info(f"[kick_user] Usuário {user_id} removido do grupo {group_id}.")
-            removed_count += 1
-        except Forbidden:
-            logger.warning(f"[kick_user] Sem permissão para remover {user_id} do grupo {group_id}.")
-        except BadRequest as e:
-            # --- LÓGICA APRIMORADA AQUI ---
-            error_text = str(e).lower()
-            if "user not found" in error_text or "member not found" in error_text:
-                logger.info(f"[kick_user] Usuário {user_id} já não estava no grupo {group_id}.")
-            elif "can't remove chat owner" in error_text:
-                logger.warning(f"[kick_user] Não é possível remover o usuário {user_id} do grupo {group_id} porque ele é o proprietário.")
-            else:
-                logger.error(f"[kick_user] Erro do Telegram ao remover {user_id} do {group_id}: {e}")
-            # --- FIM DA LÓGICA APRIMORADA ---
-
-    return removed_count
+    run = await kick_engine.kick_users(bot, [user_id], group_ids, name='manual')
+    return run.removed_from(user_id)
 # --- FUNÇÕES DO SCHEDULER (A FUNÇÃO QUE FALTAVA FOI REINSERIDA) ---
 
 async def find_and_process_expiring_subscriptions(supabase: Client, bot: Bot):
@@ -90,17 +70,15 @@ async def find_and_process_expiring_subscriptions(supabase: Client, bot: Bot):
                 end_date_br = datetime.fromisoformat(sub['end_date']).astimezone(TIMEZONE_BR).strftime('%d/%m/%Y')
                 message = f"Olá! 👋 Sua assinatura está próxima de vencer (em {end_date_br}). Para não perder o acesso, use o comando /renovar e efetue o pagamento."
                 try:
-                    await bot.send_message(chat_id=user_id, text=message)
+                    await bot.send_message(chat_id=user_id, text=message, rate_limit_args=rate_limiter.BULK)
                     logger.info(f"Aviso de vencimento enviado para o usuário {user_id}.")
 
-                    await asyncio.sleep(0.1) # Adiciona um pequeno delay proativo
-
                 # --- LÓGICA DE RETRY ADICIONADA AQUI ---
                 except RetryAfter as e:
                     logger.warning(f"Rate limit atingido ao enviar aviso para {user_id}. Aguardando {e.retry_after} segundos.")
                     await asyncio.sleep(e.retry_after)
                     try:
-                        await bot.send_message(chat_id=user_id, text=message)
+                        await bot.send_message(chat_id=user_id, text=message, rate_limit_args=rate_limiter.BULK)
                         logger.info(f"Aviso de vencimento enviado para o usuário {user_id} após retry.")
                     except Exception as e_inner:
                         logger.error(f"Falha ao reenviar aviso para {user_id} após retry: {e_inner}")
@@ -112,73 +90,108 @@ async def find_and_process_expiring_subscriptions(supabase: Client, bot: Bot):
         logger.error(f"Erro ao processar avisos de expiração: {e}", exc_info=True)
 
 
-async def find_and_process_expired_subscriptions(supabase: Client, bot: Bot):
-    """Encontra assinaturas vencidas, remove os usuários e atualiza o status."""
-    try:
-        now_iso = datetime.now(TIMEZONE_BR).isoformat()
+# Evita que duas execuções simultâneas (ex.: chamadas sobrepostas do webhook) processem as mesmas pendências
+_expiry_lock = asyncio.Lock()
 
-        # Modificamos a consulta para trazer também o product_id
-        expired_response = await asyncio.to_thread(
-            lambda: supabase.table('subscriptions')
-            .select('id, product_id, user:users(telegram_user_id)')
-            .eq('status', 'active')
-            .lt('end_date', now_iso)
-            .execute()
-        )
-
-        if not expired_response.data:
-            logger.info("Nenhuma assinatura vencida encontrada.")
-            return
 
-        logger.info(f"Encontradas {len(expired_response.data)} assinaturas vencidas para processar.")
-
-        for sub in expired_response.data:
-            user_id = sub.get('user', {}).get('telegram_user_id')
-            sub_id = sub.get('id')
-            product_id = sub.get('product_id')
-
-            if not user_id:
-                continue
-
-            logger.info(f"Processando expiração para o usuário {user_id} (assinatura {sub_id}).")
-
-            # A remoção dos grupos é a mesma para todos
-            removed_count = await kick_user_from_all_groups(user_id, bot)
-
-            # Marca a assinatura como 'expired' no banco de dados
-            await asyncio.to_thread(
-                lambda: supabase.table('subscriptions').update({'status': 'expired'}).eq('id', sub_id).execute()
+async def _notify_expired_user(user_id: int, product_id: int, bot: Bot):
+    """Avisa o usuário que a assinatura (ou a degustação) acabou."""
+    try:
+        if product_id == TRIAL_PRODUCT_ID:
+            # Mensagem personalizada para o fim da degustação
+            product_monthly = await db.get_product_by_id(PRODUCT_ID_MONTHLY)
+            product_lifetime = await db.get_product_by_id(PRODUCT_ID_LIFETIME)
+
+            text = (
+                "Seu período de degustação de 30 minutos acabou! ✨\n\n"
+                "Gostou do que viu? Garanta seu acesso permanente e não perca nenhuma novidade. "
+                "Escolha um de nossos planos abaixo para continuar na comunidade:"
             )
-            logger.info(f"Assinatura {sub_id} do usuário {user_id} marcada como 'expired'. Removido de {removed_count} grupos.")
-
-            # --- LÓGICA CONDICIONAL PARA A MENSAGEM ---
-            try:
-                if product_id == TRIAL_PRODUCT_ID:
-                    # Mensagem personalizada para o fim da degustação
-                    product_monthly = await db.get_product_by_id(PRODUCT_ID_MONTHLY)
-                    product_lifetime = await db.get_product_by_id(PRODUCT_ID_LIFETIME)
-
-                    text = (
-                        "Seu período de degustação de 30 minutos acabou! ✨\n\n"
-                        "Gostou do que viu? Garanta seu acesso permanente e não perca nenhuma novidade. "
-                        "Escolha um de nossos planos abaixo para continuar na comunidade:"
-                    )
-                    keyboard = [
-                        [InlineKeyboardButton(f"✅ Assinatura Mensal (R$ {product_monthly['price']:.2f})", callback_data=f'pay_{PRODUCT_ID_MONTHLY}')],
-                        [InlineKeyboardButton(f"💎 Acesso Vitalício (R$ {product_lifetime['price']:.2f})", callback_data=f'pay_{PRODUCT_ID_LIFETIME}')]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+            keyboard = [
+                [InlineKeyboardButton(f"✅ Assinatura Mensal (R$ {product_monthly['price']:.2f})", callback_data=f'pay_{PRODUCT_ID_MONTHLY}')],
+                [InlineKeyboardButton(f"💎 Acesso Vitalício (R$ {product_lifetime['price']:.2f})", callback_data=f'pay_{PRODUCT_ID_LIFETIME}')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup, rate_limit_args=rate_limiter.BULK)
+        else:
+            # Mensagem padrão para assinaturas pagas
+            text = "Sua assinatura expirou e seu acesso aos grupos foi removido. Para voltar, use o comando /renovar."
+            await bot.send_message(chat_id=user_id, text=text, rate_limit_args=rate_limiter.BULK)
+    except (Forbidden, BadRequest):
+        logger.warning(f"Não foi possível notificar o usuário {user_id} sobre a expiração (bloqueou o bot?).")
+    except Exception as e:
+        logger.error(f"Erro ao enviar mensagem de expiração para {user_id}: {e}")
+
+
+async def find_and_process_expired_subscriptions(bot: Bot):
+    """
+    Encontra assinaturas vencidas, atualiza o status em lote e remove os usuários.
+    1. Retoma as assinaturas já expiradas cujos efeitos não foram concluídos (execução anterior interrompida).
+    2. Marca as novas vencidas como 'expired' em blocos (um UPDATE por bloco, não por assinatura).
+    3. Remove dos grupos e avisa cada usuário; cada assinatura é confirmada assim que a remoção do seu
+       usuário de todos os grupos e o aviso terminam, e as confirmações são gravadas em lote.
+    Se o processo cair no meio, só as assinaturas ainda não confirmadas são repetidas na próxima execução.
+    """
+    async with _expiry_lock:
+        try:
+            now_iso = datetime.now(TIMEZONE_BR).isoformat()
+
+            pending = await db.get_unprocessed_expired_subscriptions()
+            if pending:
+                logger.info(f"Retomando {len(pending)} expirações com efeitos pendentes de uma execução anterior.")
+            expired = pending + await db.expire_due_subscriptions(now_iso)
+
+            if not expired:
+                logger.info("Nenhuma assinatura vencida encontrada.")
+                return
+
+            logger.info(f"Encontradas {len(expired)} assinaturas vencidas para processar.")
+
+            group_ids = await db.get_all_group_ids()
+            if not group_ids:
+                logger.error("CRÍTICO: Nenhum grupo encontrado no DB. Os usuários vencidos serão apenas notificados.")
+
+            # Uma execução do motor acumula todos os blocos: a vazão do run fica no /metrics/db
+            run = kick_engine.KickRun('expiry')
+            notify_semaphore = asyncio.Semaphore(kick_engine.KICK_CONCURRENCY)
+
+            for start in range(0, len(expired), db.EXPIRY_BATCH_SIZE):
+                subs_by_user: dict = {}
+                for sub in expired[start:start + db.EXPIRY_BATCH_SIZE]:
+                    if sub['telegram_user_id']:
+                        subs_by_user.setdefault(sub['telegram_user_id'], []).append(sub)
+                    else:
+                        db.confirm_expiry_processed(sub)  # Sem usuário do Telegram: não há o que remover
+                groups_left = {user_id: len(group_ids) for user_id in subs_by_user}
+                finishing = []
+
+                async def finish_user(user_id: int) -> None:
+                    for sub in subs_by_user[user_id]:
+                        logger.info(f"Assinatura {sub['id']} do usuário {user_id} expirada. Removido de {run.removed_from(user_id)} grupos.")
+                        async with notify_semaphore:
+                            await _notify_expired_user(user_id, sub['product_id'], bot)
+                        db.confirm_expiry_processed(sub)
+
+                async def on_result(run: kick_engine.KickRun, user_id: int, group_id: int, outcome: str) -> None:
+                    # O último grupo do usuário encerra as remoções dele: aviso e confirmação seguem na hora
+                    groups_left[user_id] -= 1
+                    if groups_left[user_id] == 0:
+                        finishing.append(asyncio.create_task(finish_user(user_id)))
+
+                # Todos os pares (usuário, grupo) do bloco rodam em paralelo, dentro dos orçamentos de cada grupo
+                if group_ids:
+                    await kick_engine.kick_users(bot, list(subs_by_user), group_ids, on_result=on_result, run=run)
                 else:
-                    # Mensagem padrão para assinaturas pagas
-                    text = "Sua assinatura expirou e seu acesso aos grupos foi removido. Para voltar, use o comando /renovar."
-                    await bot.send_message(chat_id=user_id, text=text)
-            except (Forbidden, BadRequest):
-                logger.warning(f"Não foi possível notificar o usuário {user_id} sobre a expiração (bloqueou o bot?).")
-            except Exception as e:
-                logger.error(f"Erro ao enviar mensagem de expiração para {user_id}: {e}")
-            # --- FIM DA LÓGICA CONDICIONAL ---
+                    finishing.extend(asyncio.create_task(finish_user(user_id)) for user_id in subs_by_user)
+                await asyncio.gather(*finishing)
 
-    except Exception as e:
-        logger.error(f"Erro CRÍTICO no processo de expiração: {e}", exc_info=True)
+                await db.flush_expiry_confirmations()
+
+            stats = run.stats()
+            logger.info(
+                f"Expiração concluída: {len(expired)} assinaturas, {stats['processed']} remoções tentadas em "
+                f"{stats['elapsed_s']}s ({stats['pairs_per_s']} pares/s), resultados {stats['outcomes']}."
+            )
 
+        except Exception as e:
+            logger.error(f"Erro CRÍTICO no processo de expiração: {e}", exc_info=True)
@@ -0,0 +1,67 @@
+-- --- activate_subscription (ATIVAÇÃO TRANSACIONAL EM UMA ÚNICA CHAMADA) ---
+-- Ativa (ou estende) a assinatura de um pagamento aprovado do Mercado Pago em uma única transação.
+-- - Bloqueia a linha da assinatura (FOR UPDATE): webhooks duplicados e concorrentes são serializados,
+--   e apenas o primeiro faz a transição; os demais recebem a linha com "already_active" = true.
+-- - Bloqueia também a linha do usuário, para que duas ativações do mesmo usuário não calculem
+--   a extensão a partir da mesma data final.
+-- - Retorna uma linha com a assinatura final já com "user" e "product" embutidos, ou nenhuma linha
+--   se o pagamento não existir (o cliente PostgREST em Python espera sempre uma lista).
+-- Chamado por db_supabase.activate_subscription via supabase.rpc('activate_subscription', {...}).
+
+create or replace function public.activate_subscription(p_mp_payment_id text)
+returns setof jsonb
+language plpgsql
+as $$
+declare
+    v_sub public.subscriptions%rowtype;
+    v_duration_days integer;
+    v_base timestamptz := now();
+    v_current_end timestamptz;
+    v_already_active boolean := false;
+begin
+    select * into v_sub
+    from public.subscriptions
+    where mp_payment_id = p_mp_payment_id
+    for update;
+
+    if not found then
+        return;
+    end if;
+
+    if v_sub.status = 'active' then
+        v_already_active := true;
+    else
+        perform 1 from public.users where id = v_sub.user_id for update;
+
+        select p.duration_days into v_duration_days
+        from public.products p
+        where p.id = v_sub.product_id;
+
+        -- Se o usuário já tem uma assinatura ativa que termina no futuro, estende a partir dela.
+        select max(s.end_date) into v_current_end
+        from public.subscriptions s
+        where s.user_id = v_sub.user_id and s.status = 'active';
+
+        if v_current_end is not null and v_current_end > v_base then
+            v_base := v_current_end;
+        end if;
+
+        update public.subscriptions
+        set status = 'active',
+            start_date = now(),
+            end_date = case
+                when v_duration_days is null then null
+                else v_base + make_interval(days => v_duration_days)
+            end
+        where id = v_sub.id
+        returning * into v_sub;
+    end if;
+
+    return next to_jsonb(v_sub) || jsonb_build_object(
+        'already_active', v_already_active,
+        'user', (select to_jsonb(u) from public.users u where u.id = v_sub.user_id),
+        'product', (select to_jsonb(p) from public.products p where p.id = v_sub.product_id)
+    );
+    return;
+end;
+$$;
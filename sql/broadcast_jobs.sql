@@ -0,0 +1,36 @@
+-- --- broadcast_jobs (ENVIOS EM MASSA DURÁVEIS E RETOMÁVEIS) ---
+-- Cada broadcast (mensagem global ou convite para novo grupo) vira uma linha aqui.
+-- - last_user_id: cursor sobre users.id. Todos os assinantes com id <= last_user_id já foram
+--   processados; o envio percorre os usuários em ordem de id e grava o cursor a cada lote.
+-- - status 'running' no início do app = envio interrompido por deploy/queda; é retomado do cursor.
+-- - owner / heartbeat_at: lease da instância que executa o envio. O heartbeat é renovado a cada
+--   checkpoint; outra instância só retoma um envio sem dono ou com heartbeat vencido, reivindicando-o
+--   com um UPDATE condicional, para que dois processos (ex.: num deploy) não enviem o mesmo broadcast.
+-- - counts: resultado acumulado por tipo ({"sent": .., "blocked": .., "failed": .., "already_in": ..}).
+-- Usada por db_supabase.create_broadcast_job / checkpoint_broadcast_job / finish_broadcast_job /
+-- claim_broadcast_jobs.
+
+create table if not exists public.broadcast_jobs (
+    id bigint generated by default as identity primary key,
+    kind text not null check (kind in ('message', 'new_group')),
+    status text not null default 'running' check (status in ('running', 'completed', 'interrupted')),
+    payload jsonb not null default '{}'::jsonb,
+    admin_chat_id bigint,
+    admin_message_id bigint,
+    total integer not null default 0,
+    last_user_id bigint not null default 0,
+    counts jsonb not null default '{}'::jsonb,
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default now(),
+    finished_at timestamptz,
+    owner text,
+    heartbeat_at timestamptz
+);
+
+-- Tabelas criadas antes do lease
+alter table public.broadcast_jobs add column if not exists owner text;
+alter table public.broadcast_jobs add column if not exists heartbeat_at timestamptz;
+
+create index if not exists broadcast_jobs_running_idx
+    on public.broadcast_jobs (id)
+    where status = 'running';
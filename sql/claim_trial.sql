@@ -0,0 +1,39 @@
+-- --- claim_trial (RESGATE ATÔMICO DA DEGUSTAÇÃO) ---
+-- Marca a degustação como usada e cria a assinatura de trial na mesma transação.
+-- - O UPDATE condicional (has_used_trial IS NOT TRUE) é o próprio "lock": entre cliques duplicados
+--   ou concorrentes, apenas um altera a linha; os demais não recebem nenhuma linha.
+-- - Se o INSERT falhar, a marcação é desfeita junto, e o usuário pode tentar novamente.
+-- Retorna a assinatura criada, ou nenhuma linha se o usuário não existir ou já tiver usado a degustação.
+-- Chamado por db_supabase.claim_trial via supabase.rpc('claim_trial', {...}).
+
+create or replace function public.claim_trial(
+    p_user_id bigint,
+    p_product_id bigint,
+    p_duration_minutes integer default 30
+)
+returns setof public.subscriptions
+language plpgsql
+as $$
+begin
+    update public.users
+    set has_used_trial = true
+    where id = p_user_id and has_used_trial is not true;
+
+    if not found then
+        return;
+    end if;
+
+    return query
+    insert into public.subscriptions (user_id, product_id, mp_payment_id, status, start_date, end_date, final_price)
+    values (
+        p_user_id,
+        p_product_id,
+        'trial_access_' || p_user_id || '_' || extract(epoch from now()),
+        'active',
+        now(),
+        now() + make_interval(mins => p_duration_minutes),
+        0
+    )
+    returning *;
+end;
+$$;
@@ -0,0 +1,20 @@
+-- --- expiry_processed_at (RASTREIO DOS EFEITOS DA EXPIRAÇÃO) ---
+-- O scheduler marca as assinaturas vencidas como 'expired' em lote e só depois remove os usuários
+-- dos grupos e envia o aviso. Esta coluna registra, por assinatura, quando esses efeitos foram concluídos:
+-- - 'expired' com expiry_processed_at nulo = efeitos pendentes (execução interrompida); a próxima
+--   execução do scheduler os retoma.
+-- - preenchida = nada mais a fazer.
+-- Usada por db_supabase.get_unprocessed_expired_subscriptions / confirm_expiry_processed.
+
+alter table public.subscriptions
+    add column if not exists expiry_processed_at timestamptz;
+
+-- As assinaturas expiradas antes desta migração já foram processadas pelo fluxo antigo.
+update public.subscriptions
+set expiry_processed_at = coalesce(end_date, now())
+where status = 'expired' and expiry_processed_at is null;
+
+-- Mantém barata a busca por pendências, que roda a cada execução do scheduler.
+create index if not exists subscriptions_expiry_pending_idx
+    on public.subscriptions (id)
+    where status = 'expired' and expiry_processed_at is null;
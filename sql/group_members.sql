@@ -0,0 +1,20 @@
+-- --- group_members (ROSTER LOCAL DE MEMBROS DOS GRUPOS) ---
+-- Último status conhecido de cada usuário em cada grupo cadastrado, alimentado pelos eventos
+-- chat_member do Telegram (entradas, saídas, remoções) e pelas consultas get_chat_member feitas
+-- quando o roster ainda não conhecia o par (chat_id, user_id).
+-- - status: o ChatMember.status do Telegram ('member', 'administrator', 'creator', 'restricted',
+--   'left', 'kicked').
+-- O db_supabase carrega a tabela em memória na inicialização e responde "o usuário está no grupo?"
+-- sem chamar a API (db_supabase.get_group_member_status / record_group_member).
+
+create table if not exists public.group_members (
+    id bigint generated by default as identity primary key,
+    chat_id bigint not null,
+    user_id bigint not null,
+    status text not null,
+    updated_at timestamptz not null default now(),
+    unique (chat_id, user_id)
+);
+
+create index if not exists group_members_user_idx
+    on public.group_members (user_id);
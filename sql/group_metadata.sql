@@ -0,0 +1,9 @@
+-- --- group_metadata (METADADOS DOS CHATS NO REGISTRO DE GRUPOS) ---
+-- O título do grupo continua na coluna `name`; estas colunas guardam o restante dos metadados
+-- do chat, para que o envio de links e as telas de admin não precisem chamar getChat.
+-- Mantidas por db_supabase.update_group_metadata (atualização periódica e eventos my_chat_member).
+
+alter table public.groups
+    add column if not exists chat_type text,
+    add column if not exists chat_username text,
+    add column if not exists metadata_updated_at timestamptz;
@@ -1,17 +1,21 @@
 # --- START OF FILE utils.py ---
 
 import os
+import time
 import logging
 import asyncio
+from collections import deque
 from datetime import datetime, timezone, timedelta
+from typing import Callable, Optional
 
 from telegram import Bot
 from telegram.ext import Application
 from telegram.constants import ParseMode
-from telegram.error import Forbidden, BadRequest
+from telegram.error import Forbidden, BadRequest, RetryAfter
 from telegram.helpers import escape_markdown
 
 import db_supabase as db
+import invite_pool
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +26,13 @@ ADMIN_IDS = [int(admin_id.strip()) for admin_id in ADMIN_USER_IDS.split(',')] if
 # --- Carrega o fuso horário uma vez ---
 TIMEZONE_BR = timezone(timedelta(hours=-3))
 
+# --- Grupos processados ao mesmo tempo ao gerar os links de acesso ---
+ACCESS_LINKS_CONCURRENCY = int(os.getenv("ACCESS_LINKS_CONCURRENCY", 8))
+
+# --- Mensagens de progresso dos jobs longos (broadcasts, auditoria) ---
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 5))   # Segundos mínimos entre duas edições
+PROGRESS_WINDOW = float(os.getenv("PROGRESS_WINDOW", 60))      # Janela móvel da vazão usada no ETA, em segundos
+
 async def alert_admins(bot: Bot, message: str):
     """Envia uma mensagem de alerta para todos os administradores definidos."""
     if not ADMIN_IDS:
@@ -33,12 +44,162 @@ async def alert_admins(bot: Bot, message: str):
     for admin_id in ADMIN_IDS:
         try:
             await bot.send_message(chat_id=admin_id, text=full_message, parse_mode=ParseMode.MARKDOWN)
-            await asyncio.sleep(0.1) # Pequeno delay para evitar rate limit
         except (Forbidden, BadRequest) as e:
             logger.error(f"Falha ao enviar alerta para o admin {admin_id}: {e}")
         except Exception as e:
             logger.error(f"Erro inesperado ao enviar alerta para o admin {admin_id}: {e}", exc_info=True)
 
+class ProgressReporter:
+    """
+    Mensagem de progresso de um job longo, editada no máximo a cada `interval` segundos.
+    - `update(done, total)` só registra o andamento (sem I/O): o job pode chamá-lo a cada item.
+    - Uma tarefa em segundo plano edita a mensagem com o texto de `render()`, pulando textos iguais
+      ao último publicado (evita o "message is not modified" e não gasta o orçamento do bot).
+    - `rate` e `eta_seconds` usam a vazão da janela móvel mais recente, não a média desde o início.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int, render: Callable[[], Optional[str]],
+                 interval: float = PROGRESS_INTERVAL, window: float = PROGRESS_WINDOW, parse_mode: Optional[str] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.render = render
+        self.interval = interval
+        self.window = window
+        self.parse_mode = parse_mode
+        self.done = 0
+        self.total = 0
+        self.edits = 0
+        self._samples: deque = deque()  # (instante, done) dentro da janela
+        self._last_text: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def update(self, done: int, total: Optional[int] = None) -> None:
+        """Registra quantos itens já foram processados (e o total, se mudou)."""
+        now = time.monotonic()
+        self.done = done
+        if total is not None:
+            self.total = max(total, done)
+        self._samples.append((now, done))
+        while len(self._samples) > 2 and now - self._samples[0][0] > self.window:
+            self._samples.popleft()
+
+    @property
+    def rate(self) -> float:
+        """Itens por segundo na janela móvel."""
+        if len(self._samples) < 2:
+            return 0.0
+        (first_at, first_done), (last_at, last_done) = self._samples[0], self._samples[-1]
+        return (last_done - first_done) / (last_at - first_at) if last_at > first_at else 0.0
+
+    @property
+    def eta_seconds(self) -> Optional[float]:
+        rate = self.rate
+        if not rate or not self.total:
+            return None
+        return max(0, self.total - self.done) / rate
+
+    def eta_text(self) -> str:
+        eta = self.eta_seconds
+        if eta is None:
+            return "⏱️ Restante: calculando..."
+        remaining = f"~{int(eta)} s" if eta < 60 else f"~{int(eta // 60)} min"
+        return f"⏱️ Restante: {remaining} ({self.rate:.1f}/s)"
+
+    async def _publish(self, text: Optional[str] = None, parse_mode: Optional[str] = None) -> None:
+        try:
+            text = text if text is not None else self.render()
+        except Exception as e:
+            logger.error(f"[PROGRESS] Erro ao montar o texto de progresso: {e}")
+            return
+        if not text or text == self._last_text:
+            return
+        # Com RetryAfter, espera o pedido e tenta mais uma vez, para que o texto final não se perca
+        for attempt in range(2):
+            try:
+                await self.bot.edit_message_text(
+                    chat_id=self.chat_id, message_id=self.message_id, text=text, parse_mode=parse_mode or self.parse_mode
+                )
+                self._last_text = text
+                self.edits += 1
+                return
+            except RetryAfter as e:
+                if attempt:
+                    logger.warning(f"[PROGRESS] Mensagem de progresso não editada: RetryAfter de {e.retry_after}s.")
+                    return
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    self._last_text = text
+                else:
+                    logger.warning(f"[PROGRESS] Não foi possível editar a mensagem de progresso: {e}")
+                return
+            except Exception as e:
+                logger.warning(f"[PROGRESS] Erro ao editar a mensagem de progresso: {e}")
+                return
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._publish()
+
+    def start(self) -> None:
+        """Inicia as edições periódicas em segundo plano."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Para as edições periódicas (sem publicar nada)."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def finish(self, text: Optional[str] = None, parse_mode: Optional[str] = None) -> None:
+        """Para as edições periódicas e publica o texto final (ou o último estado, se `text` não for dado)."""
+        await self.stop()
+        await self._publish(text, parse_mode)
+
+async def refresh_group_metadata(bot: Bot) -> int:
+    """
+    Consulta o Telegram (get_chat) para cada grupo cadastrado e grava título/metadados que mudaram.
+    É a única rotina que chama get_chat para os grupos; roda periodicamente pelo JobQueue.
+    Retorna quantos grupos foram atualizados.
+    """
+    updated = 0
+    for chat_id in await db.get_all_group_ids():
+        try:
+            chat = await bot.get_chat(chat_id)
+        except (Forbidden, BadRequest) as e:
+            logger.warning(f"[GROUPS] Não foi possível ler os dados do grupo {chat_id}: {e}")
+            continue
+        except Exception as e:
+            logger.error(f"[GROUPS] Erro inesperado ao ler os dados do grupo {chat_id}: {e}")
+            continue
+        if await db.update_group_metadata(chat_id, chat.title, chat.type, chat.username):
+            updated += 1
+    return updated
+
+async def get_member_status(bot: Bot, chat_id: int, user_id: int, refresh: bool = False) -> str:
+    """
+    Status do usuário no grupo ('member', 'left', 'kicked'...), respondido pelo roster local.
+    Só chama get_chat_member se o roster não conhece o par (ou com `refresh=True`), e grava a resposta nele.
+    Erros da API que não sejam "usuário não encontrado" são repassados a quem chamou.
+    """
+    if not refresh:
+        status = db.get_group_member_status(chat_id, user_id)
+        if status is not None:
+            return status
+    try:
+        member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
+        status = member.status
+    except BadRequest as e:
+        if "user not found" not in str(e).lower():
+            raise
+        status = 'left'
+    db.record_group_member(chat_id, user_id, status)
+    return status
+
 def format_date_br(dt: datetime | str | None) -> str:
     """Formata data para o padrão brasileiro."""
     if not dt:
@@ -73,49 +234,41 @@ async def send_access_links(bot: Bot, user_id: int, payment_id: str, access_type
         await bot.send_message(chat_id=user_id, text=message, parse_mode=ParseMode.MARKDOWN_V2)
         return
 
-    links_to_send_text = ""
-    groups_already_in_text = ""
-    failed_links = 0
-    new_links_generated = 0
-    expire_date = datetime.now(timezone.utc) + timedelta(hours=2)
+    # Títulos vêm do registro de grupos em memória: nenhuma chamada a get_chat por entrega
+    group_titles = await db.get_group_titles()
+    semaphore = asyncio.Semaphore(ACCESS_LINKS_CONCURRENCY)
 
-    for chat_id in group_ids:
-        try:
-            member = await bot.get_chat_member(chat_id=chat_id, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                chat = await bot.get_chat(chat_id)
-                escaped_title = escape_markdown(chat.title or f"Grupo {chat_id}", version=2)
-                groups_already_in_text += f"✅ Você já é membro do grupo: *{escaped_title}*\n\n"
-                continue
-        except BadRequest as e:
-            if "user not found" not in str(e).lower():
+    async def process_group(position: int, chat_id: int) -> tuple[str, str]:
+        """Verifica a participação e obtém o link de um grupo. Retorna ('link' | 'already_in' | 'failed', texto)."""
+        async with semaphore:
+            try:
+                # No suporte o usuário está relatando um problema de acesso: confere o status na API
+                status = await get_member_status(bot, chat_id, user_id, refresh=access_type == 'support')
+            except Exception as e:
                 logger.error(f"[JOB][{payment_id}] Erro ao verificar membro no grupo {chat_id}: {e}")
-                failed_links += 1
-                continue
-        except Exception as e:
-            logger.error(f"[JOB][{payment_id}] Erro inesperado ao verificar membro no grupo {chat_id}: {e}")
-            failed_links += 1
-            continue
+                return 'failed', ""
+            if status in db.MEMBER_STATUSES:
+                escaped_title = escape_markdown(group_titles.get(chat_id) or f"Grupo {chat_id}", version=2)
+                return 'already_in', f"✅ Você já é membro do grupo: *{escaped_title}*\n\n"
 
-        try:
-            link = await bot.create_chat_invite_link(
-                chat_id=chat_id,
-                expire_date=expire_date,
-                member_limit=1
-            )
-            chat = await bot.get_chat(chat_id)
-            group_title = chat.title or f"Grupo {group_ids.index(chat_id) + 1}"
-            escaped_title = escape_markdown(group_title, version=2)
+            try:
+                # Links de uso único saem do estoque pré-criado; só são criados na hora se o estoque acabou
+                invite_link = await invite_pool.pool.get_link(bot, chat_id)
+            except Exception as e:
+                logger.error(f"[JOB][{payment_id}] Erro ao criar link de convite para o grupo {chat_id}: {e}")
+                return 'failed', ""
+            escaped_title = escape_markdown(group_titles.get(chat_id) or f"Grupo {position + 1}", version=2)
             # CORREÇÃO: Usar formato de link inline do Markdown V2: [texto](url)
             # Isso evita ter que escapar os pontos na URL
-            links_to_send_text += f"🔗 *{escaped_title}:* [Clique aqui]({link.invite_link})\n\n"
-            new_links_generated += 1
-        except Exception as e:
-            logger.error(f"[JOB][{payment_id}] Erro ao criar link de convite para o grupo {chat_id}: {e}")
-            failed_links += 1
-
-        await asyncio.sleep(0.2)
+            return 'link', f"🔗 *{escaped_title}:* [Clique aqui]({invite_link})\n\n"
 
+    # Os grupos são processados em paralelo (até ACCESS_LINKS_CONCURRENCY por vez); o gather devolve
+    # os resultados na ordem dos grupos, então a mensagem sai sempre na mesma ordem
+    results = await asyncio.gather(*(process_group(i, chat_id) for i, chat_id in enumerate(group_ids)))
+    links_to_send_text = "".join(text for kind, text in results if kind == 'link')
+    groups_already_in_text = "".join(text for kind, text in results if kind == 'already_in')
+    new_links_generated = sum(1 for kind, _ in results if kind == 'link')
+    failed_links = sum(1 for kind, _ in results if kind == 'failed')
 
     # --- CONSTRUÇÃO ROBUSTA DA MENSAGEM ---
     message_parts = []